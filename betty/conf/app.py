@@ -46,14 +46,52 @@ DEFAULTS = {
     "BETTY_DEFAULT_IMAGE": None,
     "BETTY_MAX_WIDTH": 3200,
     "BETTY_DEFAULT_JPEG_QUALITY": 80,
+    "BETTY_DEFAULT_WEBP_QUALITY": 80,
+    "BETTY_DEFAULT_AVIF_QUALITY": 60,
+    "BETTY_WEBP_NEGOTIATION": False,  # Serve WebP for .jpg crops if client "Accept"s image/webp
     "BETTY_JPEG_MAX_ERROR": 3.5,
     "BETTY_JPEG_QUALITY_RANGE": None,
+    "BETTY_QUALITY_SEARCH_WORKERS": 1,  # Concurrent per-width searches (1 in Celery prefork)
     "BETTY_SAVE_CROPS_TO_DISK": True,  # On by default (per legacy behavior)
     "BETTY_SAVE_CROPS_TO_DISK_ROOT": None,   # If not set, will use BETTY_IMAGE_ROOT
+    "BETTY_CROP_WRITER_THREADS": 0,  # Save crops to disk in background threads, 0 to write inline
+    "BETTY_CROP_WRITER_MAX_QUEUE": 100,  # Pending background writes, past which writes are dropped
+    "BETTY_CROP_DISK_MAX_BYTES": None,  # Crop tree size budget for "evict_crops", None for no limit
+    "BETTY_CROP_DISK_MAX_FILES": None,  # Crop tree file (inode) budget, None for no limit
+    "BETTY_CROP_DISK_EVICT_TARGET": 0.9,  # Once over budget, evict down to this fraction of it
+    "BETTY_CROP_DISK_EVICT_INTERVAL_SEC": 300,  # "evict_crops --daemon" scan interval
+    "BETTY_CROP_HIT_MANIFEST": False,  # Record disk crop hits in cache, for "noatime" filesystems
+    "BETTY_CROP_HIT_MANIFEST_SEC": 30 * 24 * 60 * 60,
+    "BETTY_CROP_STATS_SAMPLE_RATE": 0,  # Fraction of crop requests counted, 0 to disable
+    "BETTY_CROP_STATS_FLUSH_SEC": 60,  # Queue per-process crop stats for DB write this often
+    "BETTY_CROP_STATS_MAX_KEYS": 10000,  # ...or once this many renditions are pending
+    "BETTY_PREWARM": False,  # Render crops (via Celery) after upload and selection changes
+    "BETTY_PREWARM_RATIOS": None,  # If not set, will use "original" + BETTY_RATIOS
+    "BETTY_PREWARM_FORMATS": ["jpg"],
+    "BETTY_PREWARM_QUEUE": "betty_prewarm",  # Celery queue, consumed by a dedicated worker
+    "BETTY_PREWARM_PRIORITY": None,  # Optional Celery task priority (broker dependent)
+    "BETTY_SERVE_CROPS_FROM_DISK": True,  # Crop view serves fresh crops saved to disk
+    "BETTY_SENDFILE_HEADER": None,  # Optional "X-Accel-Redirect" (nginx) or "X-Sendfile" (Apache)
+    "BETTY_SENDFILE_PREFIX": None,  # X-Accel-Redirect internal location for crops root
     "BETTY_CACHE_CROP_SEC": 300,
     "BETTY_CACHE_CROP_NON_BREAKPOINT_SEC": None,  # If not set, will use BETTY_CACHE_CROP_SEC
     "BETTY_CACHE_IMAGEJS_SEC": 300,
     "BETTY_CACHE_STORAGE_SEC": 3600,
+    "BETTY_CACHE_IMAGE_METADATA_SEC": 3600,  # Cached image records used by crop views
+    "BETTY_CACHE_STORAGE_CHUNK_BYTES": 1000 * 1000,  # Split larger files (memcached max is 1MB)
+    "BETTY_SOURCE_CACHE_DISK_ROOT": None,  # Local disk source cache directory, None to disable
+    "BETTY_SOURCE_CACHE_DISK_BYTES": 1024 * 1024 * 1024,
+    "BETTY_MMAP_LOCAL_STORAGE": True,  # Memory-map sources in local storage instead of caching
+    "BETTY_DECODED_IMAGE_CACHE_BYTES": 64 * 1024 * 1024,  # Per-process, 0 to disable
+    "BETTY_CROP_FROM_RENDITION_MIN_OVERSAMPLE": None,  # Resize from crops >= N x width, or None
+    "BETTY_JPEG_DRAFT_DECODE": True,  # Decode JPEGs at reduced (DCT) scale for large downscales
+    "BETTY_CROP_COALESCE": "process",  # Coalesce identical crops: None, "process" or "cache"
+    "BETTY_CROP_COALESCE_TIMEOUT": 10,  # Max seconds to wait on another request's crop
+    "BETTY_CROP_PROCESS_POOL": False,  # Render crops in a pool of worker processes
+    "BETTY_CROP_PROCESS_POOL_SIZE": None,  # If not set, will use CPU count
+    "BETTY_CROP_PROCESS_POOL_MAX_QUEUE": None,  # Pending crops, if not set will use 4 x pool size
+    "BETTY_CROP_PROCESS_POOL_TIMEOUT": 10,
+    "BETTY_BATCH_CROP_MAX": 100,  # Max crops per batch API request
 }
 
 
@@ -1,19 +1,34 @@
+from collections import defaultdict
 import json
+import zipfile
 
 from django.core.cache import cache
 from django.http import (
     HttpResponse,
     HttpResponseNotAllowed,
     HttpResponseBadRequest,
-    HttpResponseNotFound
+    HttpResponseNotFound,
+    HttpResponseServerError,
+    StreamingHttpResponse
 )
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.cache import never_cache
 
 from betty.conf.app import settings
 from .decorators import betty_token_auth
-from betty.cropper.models import Image
+from betty.cropper.cache import decoded_image_cache, source_cache
+from betty.cropper.executor import crop_executor
+from betty.cropper.models import CROP_EXTENSIONS, CropStat, Image, Ratio
+from betty.cropper.popularity import crop_stats
+from betty.cropper.tasks import queue_prewarm_crops
+from betty.cropper.views import crop_flight
+from betty.cropper.writer import crop_writer
 
+logger = __import__('logging').getLogger(__name__)
+
+
+POPULAR_ORDERS = ("hits", "renders", "render_ms")
+POPULAR_MAX_LIMIT = 1000
 
 ACC_HEADERS = {
     'Access-Control-Allow-Origin': '*',
@@ -105,6 +120,7 @@ def update_selection(request, image_id, ratio_slug):
     cache.delete(image.cache_key())
 
     image.clear_crops(ratios=[ratio_slug])
+    queue_prewarm_crops(image.id, ratios=[ratio_slug])
 
     return HttpResponse(json.dumps(image.to_native()), content_type="application/json")
 
@@ -127,6 +143,177 @@ def search(request):
     return HttpResponse(json.dumps({"results": results}), content_type="application/json")
 
 
+@never_cache
+@csrf_exempt
+@crossdomain(methods=['POST', 'OPTIONS'])
+@betty_token_auth(["server.image_read"])
+def crops(request):
+    """Renders many crops in a single request, returned as a ZIP archive of
+    "<id>/<ratio>/<width>.<format>" files.
+
+    Request body is JSON like:
+
+        {"crops": [{"id": 1, "ratio": "16x9", "width": 600, "format": "jpg"}]}
+
+    Each image is only loaded once, and widths of an image/ratio/format share decodes. The archive
+    is streamed as each image/ratio/format is rendered, so at most one of those is held in memory.
+    """
+    try:
+        request_json = json.loads(request.body.decode("utf-8"))
+    except Exception:
+        message = json.dumps({"message": "Bad JSON"})
+        return HttpResponseBadRequest(message, content_type="application/json")
+
+    try:
+        requested = [(int(crop["id"]),
+                      crop["ratio"],
+                      int(crop["width"]),
+                      crop.get("format", "jpg"))
+                     for crop in request_json["crops"]]
+    except (AttributeError, KeyError, TypeError, ValueError):
+        message = json.dumps({"message": "Bad crops"})
+        return HttpResponseBadRequest(message, content_type="application/json")
+
+    if len(requested) > settings.BETTY_BATCH_CROP_MAX:
+        message = json.dumps({"message": "Too many crops (max {})".format(
+            settings.BETTY_BATCH_CROP_MAX)})
+        return HttpResponseBadRequest(message, content_type="application/json")
+
+    # Group widths, so each image/ratio/format is rendered from a single decode
+    groups = defaultdict(set)
+    for image_id, ratio_slug, width, extension in requested:
+        if ratio_slug != "original" and ratio_slug not in settings.BETTY_RATIOS:
+            message = json.dumps({"message": "No such ratio: {}".format(ratio_slug)})
+            return HttpResponseBadRequest(message, content_type="application/json")
+        if not 0 < width <= settings.BETTY_MAX_WIDTH:
+            message = json.dumps({"message": "Invalid width: {}".format(width)})
+            return HttpResponseBadRequest(message, content_type="application/json")
+        if extension not in CROP_EXTENSIONS:
+            message = json.dumps({"message": "Invalid format: {}".format(extension)})
+            return HttpResponseBadRequest(message, content_type="application/json")
+        groups[(image_id, ratio_slug, extension)].add(width)
+
+    images = Image.objects.in_bulk(set(image_id for image_id, _, _, _ in requested))
+    missing = sorted(set(image_id for image_id, _, _, _ in requested) - set(images))
+    if missing:
+        message = json.dumps({"message": "No such images!", "ids": missing})
+        return HttpResponseNotFound(message, content_type="application/json")
+
+    def render(group):
+        (image_id, ratio_slug, extension), widths = group
+        renditions = images[image_id].crop_renditions(Ratio(ratio_slug), widths, extension)
+        return [("{}/{}/{}.{}".format(image_id, ratio_slug, width, extension), image_data)
+                for width, image_data in sorted(renditions.items())]
+
+    groups = sorted(groups.items())
+    # First group up front, so a failing crop can still be reported as an error. Later errors can
+    # only cut the archive short, since the response is already under way.
+    try:
+        first = render(groups[0]) if groups else []
+    except Exception:
+        logger.exception("Cropping error")
+        message = json.dumps({"message": "Cropping error", "id": groups[0][0][0]})
+        return HttpResponseServerError(message, content_type="application/json")
+
+    def members():
+        for member in first:
+            yield member
+        for group in groups[1:]:
+            try:
+                rendered = render(group)
+            except Exception:
+                logger.exception("Cropping error")
+                raise
+            for member in rendered:
+                yield member
+
+    response = StreamingHttpResponse(_stream_zip(members()), content_type="application/zip")
+    response["Content-Disposition"] = 'attachment; filename="crops.zip"'
+    return response
+
+
+class _ZipStream(object):
+    """Write-only file for ``zipfile``, whose output is taken as it is written"""
+
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def write(self, data):
+        self._chunks.append(data)
+        self._offset += len(data)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _stream_zip(members):
+    """Yields a ZIP archive of ``(name, data)`` members piece by piece, so only the member being
+    written (plus the central directory) is ever held in memory."""
+    out = _ZipStream()
+    # Images are already compressed
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_STORED) as archive:
+        for name, data in members:
+            archive.writestr(name, data)
+            yield out.take()
+    yield out.take()
+
+
+@never_cache
+@csrf_exempt
+@crossdomain(methods=['GET', 'OPTIONS'])
+@betty_token_auth(["server.image_read"])
+def stats(request):
+    """Per-process crop performance counters"""
+
+    data = {
+        "decoded_image_cache": decoded_image_cache.stats(),
+        "source_cache": source_cache.stats(),
+        "crop_coalesce": crop_flight.stats(),
+        "crop_process_pool": crop_executor.stats(),
+        "crop_writer": crop_writer.stats(),
+        "crop_stats": crop_stats.stats(),
+    }
+    return HttpResponse(json.dumps(data), content_type="application/json")
+
+
+@never_cache
+@csrf_exempt
+@crossdomain(methods=['GET', 'OPTIONS'])
+@betty_token_auth(["server.image_read"])
+def popular(request):
+    """Most requested (or most expensive to render) crop renditions, from ``CropStat``.
+
+    Query parameters: "id" (only this image), "order" ("hits", "renders" or "render_ms") and
+    "limit" (default: 100, at most ``POPULAR_MAX_LIMIT``).
+    """
+    order = request.GET.get("order", "hits")
+    if order not in POPULAR_ORDERS:
+        message = json.dumps({"message": "Invalid order: {}".format(order)})
+        return HttpResponseBadRequest(message, content_type="application/json")
+
+    try:
+        limit = min(int(request.GET.get("limit", 100)), POPULAR_MAX_LIMIT)
+        image_id = int(request.GET["id"]) if "id" in request.GET else None
+    except ValueError:
+        message = json.dumps({"message": "Bad limit or id"})
+        return HttpResponseBadRequest(message, content_type="application/json")
+
+    queryset = CropStat.objects.order_by("-" + order, "id")
+    if image_id is not None:
+        queryset = queryset.filter(image_id=image_id)
+    results = [stat.to_native() for stat in queryset[:limit]]
+    return HttpResponse(json.dumps({"results": results}), content_type="application/json")
+
+
 @never_cache
 @csrf_exempt
 @crossdomain(methods=["GET", "PATCH", "OPTIONS", "DELETE"])
@@ -0,0 +1,488 @@
+from collections import OrderedDict
+import errno
+import hashlib
+import io
+import mmap
+import os
+import threading
+import time
+import uuid
+
+from django.core.cache import cache as default_cache, caches
+from django.core.cache.backends.base import InvalidCacheBackendError
+
+from betty.conf.app import settings
+from betty.cropper.utils import write_file_atomic
+
+
+def image_nbytes(img):
+    """Approximate in-memory size of a decoded PIL image"""
+    width, height = img.size
+    bytes_per_band = 4 if img.mode in ("I", "F") else 1
+    return width * height * len(img.getbands()) * bytes_per_band
+
+
+class DecodedImageCache(object):
+    """Per-process LRU cache of decoded PIL images, bounded by total decoded size.
+
+    Cached images are shared between callers, so they must be treated as read-only (``crop()``,
+    ``resize()`` and ``convert()`` all return new images, so normal crop usage is safe).
+
+    If ``max_bytes`` is not provided, ``settings.BETTY_DECODED_IMAGE_CACHE_BYTES`` is used, so the
+    budget can be changed at runtime. A budget of 0 (or None) disables caching.
+    """
+
+    def __init__(self, max_bytes=None):
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def max_bytes(self):
+        if self._max_bytes is not None:
+            return self._max_bytes
+        return settings.BETTY_DECODED_IMAGE_CACHE_BYTES or 0
+
+    def get(self, key):
+        return self.lookup([key])[1]
+
+    def lookup(self, keys):
+        """Returns ``(key, image)`` for the first of ``keys`` present in the cache, else
+        ``(None, None)``. Counts as a single hit or miss."""
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    # Re-insert as most recently used
+                    img, nbytes = self._entries.pop(key)
+                    self._entries[key] = (img, nbytes)
+                    self.hits += 1
+                    return key, img
+            self.misses += 1
+            return None, None
+
+    def set(self, key, img, nbytes=None):
+        """Caches ``img`` (or any value, if its decoded size is given as ``nbytes``)."""
+        if nbytes is None:
+            nbytes = image_nbytes(img)
+        max_bytes = self.max_bytes
+        if nbytes > max_bytes:
+            # Too large to ever fit (or caching disabled)
+            return False
+
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (img, nbytes)
+            self.current_bytes += nbytes
+            while self.current_bytes > max_bytes:
+                _key, (_img, evicted_bytes) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_bytes
+                self.evictions += 1
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+decoded_image_cache = DecodedImageCache()
+
+
+class MappedBuffer(object):
+    """Read-only file-like view of a memory-mapped file, so callers (ex: Pillow) can decode from
+    it without the file being copied into memory.
+
+    The mapping stays valid even if the file is later removed or replaced, and is released when
+    the buffer is closed or garbage collected.
+    """
+
+    def __init__(self, f):
+        self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @classmethod
+    def from_file(cls, f):
+        """Returns a ``MappedBuffer`` for open file ``f``, or None if it can't be mapped (ex: not
+        a real file, or empty)."""
+        try:
+            return cls(f)
+        except (AttributeError, IOError, OSError, ValueError, io.UnsupportedOperation):
+            return None
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self._mmap) - self._mmap.tell()
+        return self._mmap.read(size)
+
+    def readline(self):
+        return self._mmap.readline()
+
+    def seek(self, offset, whence=0):
+        self._mmap.seek(offset, whence)
+        return self._mmap.tell()
+
+    def tell(self):
+        return self._mmap.tell()
+
+    def getvalue(self):
+        """Entire contents as ``bytes`` (a copy)"""
+        return self._mmap[:]
+
+    def close(self):
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self._mmap)
+
+
+def buffer_size(buf):
+    """Size of a ``BytesIO`` or ``MappedBuffer``, without copying its contents"""
+    position = buf.tell()
+    buf.seek(0, os.SEEK_END)
+    size = buf.tell()
+    buf.seek(position)
+    return size
+
+
+def get_storage_cache():
+    """Django cache used for source file bytes: ``caches['storage']`` if configured, else the
+    default cache."""
+    try:
+        return caches['storage']
+    except InvalidCacheBackendError:
+        return default_cache
+
+
+class TierStats(object):
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": float(self.hits) / lookups if lookups else None,
+            "bytes": self.bytes,
+        }
+
+
+class SharedCacheTier(object):
+    """Source bytes in a shared Django cache (``get_storage_cache()``, unless ``cache`` is given).
+
+    Values larger than ``settings.BETTY_CACHE_STORAGE_CHUNK_BYTES`` are split into chunks (memcached
+    silently refuses items over 1MB), indexed by a small manifest stored under the original key.
+    Chunk keys include a per-write token, so a reader never mixes chunks from two different writes.
+    """
+
+    name = "shared"
+
+    def __init__(self, cache=None):
+        self._cache = cache
+
+    @property
+    def cache(self):
+        return self._cache if self._cache is not None else get_storage_cache()
+
+    def get(self, key):
+        return self.load(key, self.cache.get(key))
+
+    def load(self, key, value):
+        """Returns the bytes for ``value``, as already fetched from ``key`` (ex: via
+        ``get_many()``), reading its chunks if it is a manifest. None if any are missing."""
+        if not isinstance(value, dict):
+            return value
+
+        chunk_keys = self._chunk_keys(key, value)
+        chunks = self.cache.get_many(chunk_keys)
+        if len(chunks) != len(chunk_keys):
+            # Some chunks evicted
+            return None
+        data = b''.join(chunks[chunk_key] for chunk_key in chunk_keys)
+        if len(data) != value["length"]:
+            return None
+        return data
+
+    def open(self, key):
+        data = self.get(key)
+        if data is not None:
+            return io.BytesIO(data)
+
+    def set(self, key, data, timeout=None):
+        cache = self.cache
+        if timeout is None:
+            timeout = settings.BETTY_CACHE_STORAGE_SEC
+        chunk_size = settings.BETTY_CACHE_STORAGE_CHUNK_BYTES
+        if not chunk_size or len(data) <= chunk_size:
+            cache.set(key, data, timeout)
+            return
+
+        manifest = {
+            "token": uuid.uuid4().hex[:8],
+            "chunks": (len(data) + chunk_size - 1) // chunk_size,
+            "length": len(data),
+        }
+        chunk_keys = self._chunk_keys(key, manifest)
+        cache.set_many(dict((chunk_key, data[i * chunk_size:(i + 1) * chunk_size])
+                            for i, chunk_key in enumerate(chunk_keys)),
+                       timeout)
+        # Manifest last, so readers only see it once all chunks are in place
+        cache.set(key, manifest, timeout)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def _chunk_keys(self, key, manifest):
+        return ['{}:{}:{}'.format(key, manifest["token"], i) for i in range(manifest["chunks"])]
+
+
+class LocalDiskTier(object):
+    """LRU cache of source bytes in a local directory, bounded by total file size.
+
+    Files are written atomically (see ``write_file_atomic``), so concurrent readers (from any
+    process) never see a partial file. Each file's mtime is its fill time (for expiration via
+    ``settings.BETTY_CACHE_STORAGE_SEC``) and its atime its last use. The LRU index is
+    per-process, seeded from the directory on first use, so the byte budget is approximate when
+    several processes share a directory.
+    """
+
+    name = "disk"
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._index = None
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _load_index(self):
+        entries = []
+        for dirpath, _dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_atime, path, st.st_size))
+        self._index = OrderedDict((path, size) for _atime, path, size in sorted(entries))
+        self.current_bytes = sum(self._index.values())
+
+    def _track(self, path, size):
+        """Marks ``path`` most recently used, evicting least recently used files if over budget.
+        Must hold ``self._lock``."""
+        if self._index is None:
+            self._load_index()
+        if path in self._index:
+            self.current_bytes -= self._index.pop(path)
+        self._index[path] = size
+        self.current_bytes += size
+        while self.current_bytes > self.max_bytes and self._index:
+            evicted_path, evicted_size = self._index.popitem(last=False)
+            self.current_bytes -= evicted_size
+            self._remove(evicted_path)
+
+    def _untrack(self, path):
+        with self._lock:
+            if self._index is not None and path in self._index:
+                self.current_bytes -= self._index.pop(path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def open(self, key):
+        """Returns a ``MappedBuffer`` of the cached file, or None"""
+        path = self.path(key)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+
+        now = time.time()
+        if now - st.st_mtime > settings.BETTY_CACHE_STORAGE_SEC:
+            self._untrack(path)
+            self._remove(path)
+            return None
+
+        try:
+            with open(path, 'rb') as f:
+                buf = MappedBuffer.from_file(f)
+            # Record use in atime (keeping fill time in mtime)
+            os.utime(path, (now, st.st_mtime))
+        except (IOError, OSError):
+            # Evicted by another process
+            self._untrack(path)
+            return None
+        if buf is None:
+            return None
+
+        with self._lock:
+            self._track(path, len(buf))
+        return buf
+
+    def get(self, key):
+        buf = self.open(key)
+        if buf is not None:
+            return buf.getvalue()
+
+    def set(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+
+        path = self.path(key)
+        write_file_atomic(path, data, mtime=time.time())
+
+        with self._lock:
+            self._track(path, len(data))
+
+    def delete(self, key):
+        path = self.path(key)
+        self._untrack(path)
+        self._remove(path)
+
+    def stats(self):
+        return {
+            "root": self.root,
+            "entries": len(self._index or ()),
+            "current_bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+class SourceCache(object):
+    """Tiered cache of source image bytes, checked in order:
+
+    1. Optional local disk tier (``LocalDiskTier``), enabled by setting
+       ``settings.BETTY_SOURCE_CACHE_DISK_ROOT``, bounded by
+       ``settings.BETTY_SOURCE_CACHE_DISK_BYTES``.
+    2. Shared Django cache (``SharedCacheTier``).
+    3. Storage backend.
+
+    A hit in a lower tier fills the tiers above it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._disk_tier = None
+        self._shared_tier = SharedCacheTier()
+        self._stats = {}
+
+    @property
+    def tiers(self):
+        tiers = []
+        root = settings.BETTY_SOURCE_CACHE_DISK_ROOT
+        if root:
+            max_bytes = settings.BETTY_SOURCE_CACHE_DISK_BYTES
+            with self._lock:
+                if (self._disk_tier is None or
+                        (self._disk_tier.root, self._disk_tier.max_bytes) != (root, max_bytes)):
+                    self._disk_tier = LocalDiskTier(root, max_bytes)
+                tiers.append(self._disk_tier)
+        tiers.append(self._shared_tier)
+        return tiers
+
+    def _count(self, name, hit, nbytes=0):
+        with self._lock:
+            tier_stats = self._stats.setdefault(name, TierStats())
+            if hit:
+                tier_stats.hits += 1
+                tier_stats.bytes += nbytes
+            else:
+                tier_stats.misses += 1
+
+    def _map_local_storage(self, file_field):
+        try:
+            file_field.storage.path(file_field.name)
+        except NotImplementedError:
+            return None
+
+        with file_field.storage.open(file_field.name, 'rb') as f:
+            return MappedBuffer.from_file(f)
+
+    def open(self, file_field):
+        """Returns a read-only file-like buffer of the entire contents of ``file_field``, which the
+        caller should close once done with it.
+
+        Files on local disk (either in local storage, if ``settings.BETTY_MMAP_LOCAL_STORAGE``, or
+        in the local disk tier) are memory-mapped rather than read into memory.
+        """
+        if settings.BETTY_MMAP_LOCAL_STORAGE:
+            buf = self._map_local_storage(file_field)
+            if buf is not None:
+                self._count("storage", True, len(buf))
+                return buf
+
+        key = ':'.join(['storage', file_field.name])
+        tiers = self.tiers
+        for i, tier in enumerate(tiers):
+            buf = tier.open(key)
+            if buf is not None:
+                self._count(tier.name, True, buffer_size(buf))
+                for upper_tier in tiers[:i]:
+                    upper_tier.set(key, buf.getvalue())
+                return buf
+            self._count(tier.name, False)
+
+        with file_field as f:
+            data = f.read()
+        self._count("storage", True, len(data))
+        for tier in tiers:
+            tier.set(key, data)
+        return io.BytesIO(data)
+
+    def delete(self, file_field):
+        key = ':'.join(['storage', file_field.name])
+        for tier in self.tiers:
+            tier.delete(key)
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+            self._disk_tier = None
+
+    def stats(self):
+        with self._lock:
+            data = dict((name, tier_stats.stats()) for name, tier_stats in self._stats.items())
+        if self._disk_tier is not None:
+            data.setdefault("disk", TierStats().stats()).update(self._disk_tier.stats())
+        return data
+
+
+source_cache = SourceCache()
@@ -20,75 +20,79 @@ ERROR_THRESHOLD = 1.3
 
 ERROR_THRESHOLD_INACCURACY = 0.01
 
+# Max absolute distortion difference (float32 vs. float64) seen across the test images + qualities
+DISTORTION_TOLERANCE = 1e-4
 
-def compute_ssim(im1, im2, l=255):
-
-    # k1,k2 & c1,c2 depend on L (width of color map)
-    k_1 = 0.01
-    c_1 = (k_1 * l) ** 2
-    k_2 = 0.03
-    c_2 = (k_2 * l) ** 2
 
-    window = np.ones((8, 8)) / 64.0
+# 8x8 box window, as ``convolve(img, np.ones((8, 8)) / 64.0)`` (``uniform_filter`` centers even
+# sized windows one pixel over from ``convolve``, hence the -1 origin)
+WINDOW_SIZE = 8
+WINDOW_ORIGIN = -1
 
-    # Convert image matrices to double precision (like in the Matlab version)
-    im1 = im1.astype(np.float)
-    im2 = im2.astype(np.float)
 
-    # Means obtained by Gaussian filtering of inputs
-    mu_1 = scipy.ndimage.filters.convolve(im1, window)
-    mu_2 = scipy.ndimage.filters.convolve(im2, window)
+def _box_filter(img):
+    """Mean over the window, per channel of a (height, width, channels) array"""
+    return scipy.ndimage.uniform_filter(img,
+                                        size=(WINDOW_SIZE, WINDOW_SIZE, 1),
+                                        origin=(WINDOW_ORIGIN, WINDOW_ORIGIN, 0))
 
-    # Squares of means
-    mu_1_sq = mu_1 ** 2
-    mu_2_sq = mu_2 ** 2
-    mu_1_mu_2 = mu_1 * mu_2
 
-    # Squares of input matrices
-    im1_sq = im1 ** 2
-    im2_sq = im2 ** 2
-    im12 = im1 * im2
+def ssim_moments(img):
+    """Returns the ``(image, mean, variance)`` maps used by SSIM, as float32 (height, width,
+    channels) arrays."""
+    img = np.asarray(img, dtype=np.float32)
+    if img.ndim == 2:
+        img = img[:, :, np.newaxis]
+    mu = _box_filter(img)
+    sigma_sq = _box_filter(img * img)
+    sigma_sq -= mu * mu
+    return img, mu, sigma_sq
 
-    # Variances obtained by Gaussian filtering of inputs' squares
-    sigma_1_sq = scipy.ndimage.filters.convolve(im1_sq, window)
-    sigma_2_sq = scipy.ndimage.filters.convolve(im2_sq, window)
 
-    # Covariance
-    sigma_12 = scipy.ndimage.filters.convolve(im12, window)
+def compute_ssim(im1, im2, l=255):
+    """Returns the mean SSIM of two images (over all channels).
 
-    # Centered squares of variances
-    sigma_1_sq -= mu_1_sq
-    sigma_2_sq -= mu_2_sq
-    sigma_12 -= mu_1_mu_2
+    To compare many images against the same ``im1``, use ``ReferenceImage(im1).ssim()`` instead,
+    which reuses its statistics.
 
-    if (c_1 > 0) & (c_2 > 0):
-        ssim_map = (((2 * mu_1_mu_2 + c_1) * (2 * sigma_12 + c_2)) /
-                    ((mu_1_sq + mu_2_sq + c_1) * (sigma_1_sq + sigma_2_sq + c_2)))
-    else:
-        numerator1 = 2 * mu_1_mu_2 + c_1
-        numerator2 = 2 * sigma_12 + c_2
+    Uses separable box filtering in float32 (the original float64 ``convolve`` version gave the
+    same quality decisions, with distortion within ``DISTORTION_TOLERANCE``).
+    """
+    return ReferenceImage(im1).ssim(im2, l=l)
 
-        denominator1 = mu_1_sq + mu_2_sq + c_1
-        denominator2 = sigma_1_sq + sigma_2_sq + c_2
 
-        ssim_map = np.ones(mu_1.size)
+def unique_colors(img):
+    """Returns the number of distinct colors (or gray levels) in an image array.
 
-        index = (denominator1 * denominator2 > 0)
+    8-bit colors are packed into integers and marked in a bitmap of every possible color (16MB for
+    RGB), so this takes linear time and bounded memory, rather than sorting every pixel.
+    """
+    channels = img.shape[2] if img.ndim == 3 else 1
+    if img.dtype != np.uint8 or channels > 4:
+        return _unique_colors_sort(img)
 
-        ssim_map[index] = ((numerator1[index] * numerator2[index]) /
-                           (denominator1[index] * denominator2[index]))
-        index = (denominator1 != 0) & (denominator2 == 0)
-        ssim_map[index] = numerator1[index] / denominator1[index]
+    if img.ndim == 2:
+        packed = img
+    else:
+        packed = np.zeros(img.shape[:2], dtype=np.uint32)
+        for channel in range(channels):
+            packed <<= 8
+            packed |= img[:, :, channel]
 
-    # return MSSIM
-    index = np.mean(ssim_map)
+    if channels == 4:
+        # A 32-bit bitmap would be 4GB, but sorting integers still beats sorting np.void rows
+        return np.unique(packed).size
 
-    return index
+    seen = np.zeros(1 << (8 * channels), dtype=np.bool_)
+    seen[packed.ravel()] = True
+    return int(np.count_nonzero(seen))
 
 
-def unique_colors(img):
+def _unique_colors_sort(img):
     # For RGB, we need to get unique "rows" basically, as the color dimesion is an array.
     # This is taken from: http://stackoverflow.com/a/16973510
+    if img.ndim == 2:
+        return np.unique(img).size
     color_view = np.ascontiguousarray(img).view(np.dtype((np.void,
                                                           img.dtype.itemsize * img.shape[2])))
     unique = np.unique(color_view)
@@ -111,23 +115,100 @@ def enough_colors(img):
 
 
 def get_distortion(one, two):
-    # This computes the "DSSIM" of the images, using the SSIM of each channel
+    # This computes the "DSSIM" of the images, using the mean SSIM of all channels
+    return ReferenceImage(one).distortion(two)
+
+
+class ReferenceImage(object):
+    """Precomputed statistics of an original image, for comparing many candidates (ex: JPEG
+    quality levels) against it.
+
+    Holds the original ``pixels``, their ``float_image`` and SSIM mean/variance maps, and (lazily)
+    the unique color count.
+    """
 
-    ssims = []
+    def __init__(self, img):
+        self.pixels = img
+        self.float_image, self.mean, self.variance = ssim_moments(img)
+        self._unique_colors = None
 
-    for channel in range(one.shape[2]):
-        one_channeled = np.ascontiguousarray(one[:, :, channel])
-        two_channeled = np.ascontiguousarray(two[:, :, channel])
+    @property
+    def unique_colors(self):
+        if self._unique_colors is None:
+            self._unique_colors = unique_colors(self.pixels)
+        return self._unique_colors
 
-        ssim = compute_ssim(one_channeled, two_channeled)
+    @property
+    def color_density(self):
+        return self.unique_colors / float(self.pixels.shape[0] * self.pixels.shape[1])
 
-        ssims.append(ssim)
+    def ssim(self, img, l=255):
+        """Mean SSIM of ``img`` (same shape) against this image, see ``compute_ssim``"""
+        if img.shape != self.pixels.shape:
+            raise ValueError("Image shape {} doesn't match reference {}".format(
+                img.shape, self.pixels.shape))
 
-    return (1 / np.mean(ssims) - 1) * 20
+        # k1,k2 & c1,c2 depend on L (width of color map)
+        k_1 = 0.01
+        c_1 = (k_1 * l) ** 2
+        k_2 = 0.03
+        c_2 = (k_2 * l) ** 2
 
+        im1, mu_1, sigma_1_sq = self.float_image, self.mean, self.variance
+        im2, mu_2, sigma_2_sq = ssim_moments(img)
 
-def detect_optimal_quality(image_buffer, width=None, verbose=False):
-    """Returns the optimal quality for a given image, at a given width"""
+        mu_1_mu_2 = mu_1 * mu_2
+
+        # Covariance
+        sigma_12 = _box_filter(im1 * im2)
+        sigma_12 -= mu_1_mu_2
+
+        ssim_map = (((2 * mu_1_mu_2 + c_1) * (2 * sigma_12 + c_2)) /
+                    ((mu_1 * mu_1 + mu_2 * mu_2 + c_1) * (sigma_1_sq + sigma_2_sq + c_2)))
+
+        # return MSSIM
+        return float(np.mean(ssim_map, dtype=np.float64))
+
+    def distortion(self, img):
+        """Distortion ("DSSIM") of ``img`` against this image, see ``get_distortion``"""
+        return (1 / self.ssim(img) - 1) * 20
+
+    def density_ratio(self, img):
+        """Relative change in color density of ``img``, compared to this image"""
+        return abs(color_density(img) - self.color_density) / self.color_density
+
+
+def detect_optimal_quality(image_buffer, width=None, verbose=False, quality_range=None):
+    """Returns the optimal quality for a given image, at a given width
+
+    Searches ``quality_range`` (default: ``settings.BETTY_JPEG_QUALITY_RANGE``).
+    """
+    return search_optimal_quality(image_buffer, width=width, verbose=verbose,
+                                  quality_range=quality_range)[0]
+
+
+def _next_quality(lo, hi, lo_error, hi_error, probed, warm, step):
+    """Picks the next quality to probe, strictly between ``lo`` and ``hi``"""
+    if lo_error is not None and hi_error is not None:
+        # Interpolate where the (monotone) error curve crosses the threshold
+        quality = lo + int(round((lo_error - ERROR_THRESHOLD) * (hi - lo) /
+                                 (lo_error - hi_error)))
+    elif len(probed) >= 2 and (probed[-1][0] - probed[-2][0]) * (probed[-1][1] - probed[-2][1]) < 0:
+        # Last two probes on the same side, extrapolate the (falling) error curve through them
+        (q_1, error_1), (q_2, error_2) = probed[-2:]
+        quality = q_2 + int(round((ERROR_THRESHOLD - error_2) * (q_2 - q_1) / (error_2 - error_1)))
+    elif warm and hi_error is not None:
+        # Warm start passed, walk down in growing steps
+        quality = hi - step
+    elif warm and lo_error is not None:
+        quality = lo + step
+    else:
+        quality = int(round((hi + lo) / 2.0))
+    return max(lo + 1, min(hi - 1, quality))
+
+
+def _open_for_search(image_buffer, width=None):
+    """Returns ``(pil_image, icc_profile)``: the image to compress, as JPEG, at ``width``"""
 
     # Open the image...
     pil_original = Image.open(image_buffer)
@@ -151,53 +232,96 @@ def detect_optimal_quality(image_buffer, width=None, verbose=False):
         height = int(math.ceil((pil_original.size[1] * width) / float(pil_original.size[0])))
         pil_original = pil_original.resize((width, height), resample=Image.ANTIALIAS)
 
-    np_original = np.asarray(pil_original)
-    original_density = color_density(np_original)
+    return pil_original, icc_profile
 
-    # Check if there are enough colors (assuming RGB for the moment)
-    if not enough_colors(np_original):
-        return None
 
-    # TODO: Check if the quality is lower than we'd want... (probably impossible)
-    qmin = settings.BETTY_JPEG_QUALITY_RANGE[0]
-    qmax = settings.BETTY_JPEG_QUALITY_RANGE[1]
+def _quality_error(pil_original, reference, quality, icc_profile=None):
+    """Returns ``(error, density_ratio)`` of ``pil_original`` compressed at ``quality``"""
+    tmp = io.BytesIO()
+    pillow_kwargs = {
+        "format": "jpeg",
+        "quality": quality,
+        "subsampling": 2
+    }
 
-    # Do a binary search of image quality...
-    while qmax > qmin + 1:
-        quality = int(round((qmax + qmin) / 2.0))
+    if icc_profile:
+        pillow_kwargs["icc_profile"] = icc_profile
+    pil_original.save(tmp, **pillow_kwargs)
+    tmp.seek(0)
+    pil_compressed = Image.open(tmp)
 
-        tmp = io.BytesIO()
-        pillow_kwargs = {
-            "format": "jpeg",
-            "quality": quality,
-            "subsampling": 2
-        }
+    np_compressed = np.asarray(pil_compressed)
+    density_ratio = reference.density_ratio(np_compressed)
+
+    error = reference.distortion(np_compressed)
+
+    if density_ratio > COLOR_DENSITY_RATIO:
+        error *= 1.25 + density_ratio
+    return error, density_ratio
 
-        if icc_profile:
-            pillow_kwargs["icc_profile"] = icc_profile
-        pil_original.save(tmp, **pillow_kwargs)
-        tmp.seek(0)
-        pil_compressed = Image.open(tmp)
 
-        np_compressed = np.asarray(pil_compressed)
-        density_ratio = abs(color_density(np_compressed) - original_density) / original_density
+def search_optimal_quality(image_buffer, width=None, verbose=False, quality_range=None,
+                           seed=None):
+    """Returns ``(quality, probes)``: the optimal quality for a given image at a given width, and
+    the number of encode + measure probes it took.
 
-        error = get_distortion(np_original, np_compressed)
+    Where the error falls with quality (as it does near the threshold), that is the lowest quality
+    with error within ``ERROR_THRESHOLD``, as found by plain bisection. The search may stop early
+    on a quality with error just (by ``ERROR_THRESHOLD_INACCURACY``) within the threshold, but never
+    on one above it.
 
-        if density_ratio > COLOR_DENSITY_RATIO:
-            error *= 1.25 + density_ratio
+    Starts from ``seed`` (ex: the result for a nearby width) if given, then narrows the range by
+    interpolating measured errors, falling back to bisection whenever that narrows it too slowly.
+    """
+    pil_original, icc_profile = _open_for_search(image_buffer, width)
+
+    np_original = np.asarray(pil_original)
+    # Reused for every quality probe
+    reference = ReferenceImage(np_original)
+
+    # Check if there are enough colors (assuming RGB for the moment)
+    if not enough_colors(np_original):
+        return None, 0
+
+    # TODO: Check if the quality is lower than we'd want... (probably impossible)
+    if quality_range is None:
+        quality_range = settings.BETTY_JPEG_QUALITY_RANGE
+
+    # The optimal quality is always in (lo, hi], with error above the threshold at lo and within it
+    # at hi (where measured, else the range bounds)
+    lo, hi = quality_range[0], quality_range[1]
+    lo_error = hi_error = None
+    probed = []
+    step = 1
+    bisect = False
+
+    while hi > lo + 1:
+        if not probed and seed is not None:
+            quality = max(lo + 1, min(hi - 1, seed))
+        elif bisect:
+            quality = int(round((hi + lo) / 2.0))
+        else:
+            quality = _next_quality(lo, hi, lo_error, hi_error, probed, seed is not None, step)
+            step *= 2
+        interpolated = lo_error is not None and hi_error is not None
+        last_range = hi - lo
+
+        error, density_ratio = _quality_error(pil_original, reference, quality, icc_profile)
+        probed.append((quality, error))
 
         if error > ERROR_THRESHOLD:
-            qmin = quality
+            lo, lo_error = quality, error
         else:
-            qmax = quality
+            hi, hi_error = quality, error
 
         if verbose:
             print("{:.2f}/{:.2f}@{}".format(error, density_ratio, quality))
 
-        if abs(error - ERROR_THRESHOLD) < ERROR_THRESHOLD * ERROR_THRESHOLD_INACCURACY:
+        if 0 <= ERROR_THRESHOLD - error < ERROR_THRESHOLD * ERROR_THRESHOLD_INACCURACY:
             # Close enough!
-            qmax = quality
             break
 
-    return qmax
+        # Interpolation can creep up on one end of a curved error, so make sure of progress
+        bisect = interpolated and (hi - lo) * 2 > last_range
+
+    return hi, len(probed)
@@ -0,0 +1,214 @@
+from collections import namedtuple
+import errno
+import hashlib
+import os
+import re
+import time
+
+from django.core.cache import cache
+
+from betty.conf.app import settings
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # Python 2 backport
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+logger = __import__('logging').getLogger(__name__)
+
+
+CROP_FILENAME_RE = re.compile(r'^(\d+|original)\.(jpg|png|gif|webp|avif)$')
+
+# Leftover temporary files (see ``write_file_atomic``) older than this are removed
+STALE_TMP_SEC = 60 * 60
+
+CropFile = namedtuple('CropFile', ['path', 'size', 'last_used', 'mtime', 'ino'])
+
+
+class _ListdirEntry(object):
+    """Minimal ``os.DirEntry`` stand-in when ``scandir`` is not available"""
+
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+        self._stat = None
+
+    def stat(self, follow_symlinks=False):
+        if self._stat is None:
+            self._stat = os.lstat(self.path)
+        return self._stat
+
+    def is_dir(self, follow_symlinks=False):
+        try:
+            return os.path.isdir(self.path) and not os.path.islink(self.path)
+        except OSError:
+            return False
+
+
+def _scandir(path):
+    try:
+        if scandir is not None:
+            return list(scandir(path))
+        return [_ListdirEntry(path, name) for name in os.listdir(path)]
+    except OSError as e:
+        # Removed by concurrent clear_crops()
+        if e.errno in (errno.ENOENT, errno.ENOTDIR):
+            return []
+        raise
+
+
+def get_crops_root():
+    return settings.BETTY_SAVE_CROPS_TO_DISK_ROOT or settings.BETTY_IMAGE_ROOT
+
+
+def crop_hit_key(path):
+    relpath = os.path.relpath(path, get_crops_root())
+    return "crop-hit-{}".format(hashlib.sha1(relpath.encode('utf-8')).hexdigest()[:20])
+
+
+def record_crop_hit(path):
+    """Records use of a crop in the hit manifest (if ``settings.BETTY_CROP_HIT_MANIFEST``), for
+    servers where atime isn't updated (ex: mounted with "noatime")."""
+    if settings.BETTY_CROP_HIT_MANIFEST:
+        cache.set(crop_hit_key(path), int(time.time()), settings.BETTY_CROP_HIT_MANIFEST_SEC)
+
+
+def _crop_dir_names():
+    return set(list(settings.BETTY_RATIOS) + ['original', 'animated'])
+
+
+def iter_shards(root):
+    """Top-level (image id prefix) directories of the crop tree"""
+    for entry in sorted(_scandir(root), key=lambda entry: entry.name):
+        if entry.is_dir(follow_symlinks=False):
+            yield entry.path
+
+
+def scan_shard(shard_path, crop_dir_names=None, now=None):
+    """Returns ``CropFile`` records for all crops under a shard directory.
+
+    Only crop renditions (``<ratio>/<width>.<ext>`` + ``animated/original.<ext>``) are returned,
+    so source and optimized images stored in the same tree are never touched. Stale temporary files
+    are removed along the way.
+    """
+    if crop_dir_names is None:
+        crop_dir_names = _crop_dir_names()
+    if now is None:
+        now = time.time()
+
+    crops = []
+    pending = [shard_path]
+    while pending:
+        dirpath = pending.pop()
+        is_crop_dir = os.path.basename(dirpath) in crop_dir_names
+        for entry in _scandir(dirpath):
+            if entry.is_dir(follow_symlinks=False):
+                pending.append(entry.path)
+                continue
+
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+
+            if entry.name.startswith('.tmp-'):
+                if now - st.st_mtime > STALE_TMP_SEC:
+                    _remove(entry.path)
+                continue
+
+            if is_crop_dir and CROP_FILENAME_RE.match(entry.name):
+                crops.append(CropFile(entry.path, st.st_size, st.st_atime, st.st_mtime,
+                                      st.st_ino))
+    return crops
+
+
+def _apply_manifest(crops):
+    """Uses hit manifest last use time, where newer than atime"""
+    keys = dict((crop_hit_key(crop.path), crop) for crop in crops)
+    hits = cache.get_many(list(keys))
+    return [crop._replace(last_used=max(crop.last_used, hits.get(key, 0)))
+            for key, crop in keys.items()]
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False
+    return True
+
+
+def evict_crops(root=None, max_bytes=None, max_files=None, target=None, use_manifest=None):
+    """Evicts least recently used crops from the crop tree, until under ``max_bytes`` total size and
+    ``max_files`` files (either may be None for no limit).
+
+    Once over budget, evicts down to ``target`` (fraction of budget), to avoid evicting on every
+    run. Doesn't block concurrent writers: crops are written atomically (temp file + rename), so a
+    crop rewritten since it was scanned has a new inode and is skipped. Modification time alone
+    can't tell, since re-renders of the same image version keep the same mtime.
+
+    Returns a dictionary of counts.
+    """
+    if root is None:
+        root = get_crops_root()
+    if target is None:
+        target = settings.BETTY_CROP_DISK_EVICT_TARGET
+    if use_manifest is None:
+        use_manifest = settings.BETTY_CROP_HIT_MANIFEST
+
+    crops = []
+    crop_dir_names = _crop_dir_names()
+    now = time.time()
+    for shard_path in iter_shards(root):
+        shard_crops = scan_shard(shard_path, crop_dir_names=crop_dir_names, now=now)
+        if use_manifest and shard_crops:
+            shard_crops = _apply_manifest(shard_crops)
+        crops.extend(shard_crops)
+
+    total_bytes = sum(crop.size for crop in crops)
+    total_files = len(crops)
+    stats = {
+        "scanned_files": total_files,
+        "scanned_bytes": total_bytes,
+        "evicted_files": 0,
+        "evicted_bytes": 0,
+    }
+
+    over_bytes = max_bytes is not None and total_bytes > max_bytes
+    over_files = max_files is not None and total_files > max_files
+    if not (over_bytes or over_files):
+        return stats
+
+    target_bytes = int(max_bytes * target) if max_bytes is not None else None
+    target_files = int(max_files * target) if max_files is not None else None
+
+    crops.sort(key=lambda crop: crop.last_used)
+    for crop in crops:
+        if ((target_bytes is None or total_bytes <= target_bytes) and
+                (target_files is None or total_files <= target_files)):
+            break
+
+        try:
+            st = os.stat(crop.path)
+            if st.st_ino != crop.ino or st.st_mtime != crop.mtime:
+                # Re-rendered since scan
+                continue
+        except OSError:
+            # Already gone (ex: clear_crops)
+            total_bytes -= crop.size
+            total_files -= 1
+            continue
+
+        if _remove(crop.path):
+            stats["evicted_files"] += 1
+            stats["evicted_bytes"] += crop.size
+        total_bytes -= crop.size
+        total_files -= 1
+
+    return stats
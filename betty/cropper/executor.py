@@ -0,0 +1,120 @@
+import multiprocessing
+import threading
+
+try:
+    from concurrent.futures import ProcessPoolExecutor, TimeoutError
+except ImportError:
+    # Python 2 requires "futures" backport
+    ProcessPoolExecutor = None
+
+from betty.conf.app import settings
+from betty.cropper.imaging import render_crops
+
+logger = __import__('logging').getLogger(__name__)
+
+
+class CropExecutor(object):
+    """Runs crop pixel work (``imaging.render_crops``) in a persistent pool of worker processes, so
+    that threaded servers aren't serialized on the GIL.
+
+    The pool is created lazily (so after any server worker fork) and sized via
+    ``settings.BETTY_CROP_PROCESS_POOL_SIZE`` (default: CPU count). At most
+    ``settings.BETTY_CROP_PROCESS_POOL_MAX_QUEUE`` crops may be pending at once, past which
+    ``render()`` returns None and the caller should render in-process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pool = None
+        self.pending = 0
+        self.submitted = 0
+        self.overflows = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    @property
+    def pool_size(self):
+        return settings.BETTY_CROP_PROCESS_POOL_SIZE or multiprocessing.cpu_count()
+
+    @property
+    def max_queue(self):
+        max_queue = settings.BETTY_CROP_PROCESS_POOL_MAX_QUEUE
+        if max_queue is None:
+            max_queue = self.pool_size * 4
+        return max_queue
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.pool_size)
+        return self._pool
+
+    def render(self, image_data, selection, sizes, encoder_kwargs, reduces=None):
+        """Returns list of encoded crops (see ``imaging.render_crops``), or None if the pool is
+        unavailable or full.
+
+        Raises ``TimeoutError`` if the crop takes longer than
+        ``settings.BETTY_CROP_PROCESS_POOL_TIMEOUT`` seconds.
+        """
+        if ProcessPoolExecutor is None:
+            return None
+
+        with self._lock:
+            if self.pending >= self.max_queue:
+                self.overflows += 1
+                return None
+            self.pending += 1
+            self.submitted += 1
+            pool = self._get_pool()
+
+        future = None
+        try:
+            future = pool.submit(render_crops, image_data, selection, sizes, encoder_kwargs,
+                                 reduces)
+            # Released once the crop is actually done (or cancelled), since ``cancel()`` can't stop
+            # a timed out crop already running, which keeps its worker busy
+            future.add_done_callback(self._release)
+            return future.result(timeout=settings.BETTY_CROP_PROCESS_POOL_TIMEOUT)
+        except TimeoutError:
+            future.cancel()
+            with self._lock:
+                self.timeouts += 1
+            raise
+        except Exception:
+            with self._lock:
+                self.errors += 1
+                if getattr(pool, '_broken', False):
+                    # Worker process died, start over with a fresh pool
+                    logger.error('Crop process pool broken, restarting')
+                    self._reset_pool(pool)
+            raise
+        finally:
+            if future is None:
+                # Never submitted
+                self._release()
+
+    def _release(self, future=None):
+        with self._lock:
+            self.pending -= 1
+
+    def _reset_pool(self, pool):
+        if self._pool is pool:
+            self._pool = None
+        pool.shutdown(wait=False)
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._reset_pool(self._pool)
+
+    def stats(self):
+        return {
+            "running": self._pool is not None,
+            "pending": self.pending,
+            "submitted": self.submitted,
+            "overflows": self.overflows,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+        }
+
+
+crop_executor = CropExecutor()
@@ -0,0 +1,139 @@
+import io
+
+import PIL
+from PIL import Image as PILImage
+
+try:
+    # Optional AVIF support for Pillow builds without native AVIF
+    import pillow_avif  # NOQA
+except ImportError:
+    pass
+
+
+PILLOW_VERSION = getattr(PIL, "__version__", None) or getattr(PIL, "PILLOW_VERSION", "")
+
+# Scale denominators supported by libjpeg's DCT-domain scaling (via Pillow "draft" mode)
+DRAFT_REDUCTIONS = (8, 4, 2)
+
+
+def has_encoder(format):
+    """Whether this Pillow build can save ``format`` (ex: "webp")"""
+    PILImage.init()
+    return format.upper() in PILImage.SAVE
+
+
+def get_draft_reduce(source_size, target_size):
+    """Returns the largest JPEG DCT reduction (1, 2, 4 or 8) at which ``source_size`` still covers
+    ``target_size``.
+
+    Keeps one extra pixel of headroom so that rounding the scaled-down selection coordinates can
+    never leave us upsampling.
+    """
+    for reduce in DRAFT_REDUCTIONS:
+        if (source_size[0] >= (target_size[0] + 1) * reduce and
+                source_size[1] >= (target_size[1] + 1) * reduce):
+            return reduce
+    return 1
+
+
+def draft(img, reduce):
+    """Configures a lazily-opened JPEG to decode at 1/``reduce`` scale.
+
+    Returns the reduction actually applied, which is 1 for non-JPEG images (or if the image was
+    already loaded).
+    """
+    if reduce <= 1 or img.format != "JPEG":
+        return 1
+
+    full_width, full_height = img.size
+    img.draft(img.mode, (full_width // reduce, full_height // reduce))
+
+    # libjpeg rounds scaled dimensions up
+    for applied in DRAFT_REDUCTIONS:
+        if img.size == ((full_width + applied - 1) // applied,
+                        (full_height + applied - 1) // applied):
+            return applied
+    return 1
+
+
+def decode_image(image_buffer, reduce=1):
+    """Fully decodes an image buffer, using DCT scaling for JPEGs where possible.
+
+    Returns ``(image, applied_reduce)``.
+    """
+    img = PILImage.open(image_buffer)
+    applied = draft(img, reduce)
+    img.load()
+    return img, applied
+
+
+def scale_box(selection, reduce, size):
+    """Converts a full-resolution selection into a crop box for an image decoded at
+    1/``reduce`` scale with dimensions ``size``."""
+    box = (selection['x0'], selection['y0'], selection['x1'], selection['y1'])
+    if reduce == 1:
+        return box
+
+    x0, y0, x1, y1 = [int(round(coord / float(reduce))) for coord in box]
+    return (x0, y0, min(x1, size[0]), min(y1, size[1]))
+
+
+def encode(img, pillow_kwargs, icc_profile=None):
+    """Encodes an image via Pillow ``save()`` keyword arguments, first converting to a mode the
+    format supports."""
+    format = pillow_kwargs["format"]
+    if format == "jpeg" and img.mode != "RGB":
+        img = img.convert("RGB")
+    elif format in ("webp", "avif") and img.mode not in ("RGB", "RGBA"):
+        has_alpha = "A" in img.mode or "transparency" in img.info
+        img = img.convert("RGBA" if has_alpha else "RGB")
+
+    if icc_profile:
+        pillow_kwargs = dict(pillow_kwargs, icc_profile=icc_profile)
+
+    tmp = io.BytesIO()
+    img.save(tmp, **pillow_kwargs)
+    return tmp.getvalue()
+
+
+def group_by_reduce(reduces):
+    """Groups indexes of ``reduces`` by value, so each draft scale is decoded once.
+
+    Returns a list of ``(reduce, indexes)``, finest scale first.
+    """
+    groups = {}
+    for index, reduce in enumerate(reduces):
+        groups.setdefault(reduce, []).append(index)
+    return sorted(groups.items())
+
+
+def resize_and_encode(img, sizes, encoder_kwargs, icc_profile=None):
+    """Resizes an image to each of ``sizes``.
+
+    Every size is resized straight from ``img``, so a rendition doesn't depend on which other sizes
+    were rendered alongside it. Returns a list of encoded image data, one per size (using matching
+    ``encoder_kwargs``).
+    """
+    results = []
+    for size, pillow_kwargs in zip(sizes, encoder_kwargs):
+        resized = img if img.size == size else img.resize(size, PILImage.ANTIALIAS)
+        results.append(encode(resized, pillow_kwargs, icc_profile))
+    return results
+
+
+def render_crops(image_data, selection, sizes, encoder_kwargs, reduces=None):
+    """Decodes, crops and renders an image at several sizes, decoding at 1/``reduces[i]`` scale for
+    ``sizes[i]`` (see ``get_draft_reduce``).
+
+    Depends only on its (picklable) arguments, so can be run in a worker process.
+    """
+    results = [None] * len(sizes)
+    for reduce, indexes in group_by_reduce(reduces or [1] * len(sizes)):
+        img, reduce = decode_image(io.BytesIO(image_data), reduce=reduce)
+        icc_profile = img.info.get("icc_profile")
+        img = img.crop(scale_box(selection, reduce, img.size))
+        encoded = resize_and_encode(img, [sizes[i] for i in indexes],
+                                    [encoder_kwargs[i] for i in indexes], icc_profile)
+        for index, rendition in zip(indexes, encoded):
+            results[index] = rendition
+    return results
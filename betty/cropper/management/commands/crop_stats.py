@@ -0,0 +1,43 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from betty.cropper.models import CropStat
+
+
+class Command(BaseCommand):
+    help = 'Lists the most requested (or most expensive to render) crop renditions'
+
+    # This needs to run on Django 1.7
+    option_list = BaseCommand.option_list + (
+        make_option('--order',
+                    choices=['hits', 'renders', 'render_ms'],
+                    dest='order',
+                    default='hits',
+                    help='Sort by "hits", "renders" or total "render_ms" (default: hits)'),
+        make_option('--limit',
+                    type='int',
+                    dest='limit',
+                    default=20,
+                    help='Number of renditions to list (default: 20)'),
+        make_option('--id',
+                    type='int',
+                    dest='image_id',
+                    default=None,
+                    help='Only list renditions of this image'),
+    )
+
+    def handle(self, *args, **options):
+        queryset = CropStat.objects.order_by('-' + options.get('order', 'hits'), 'id')
+        if options.get('image_id') is not None:
+            queryset = queryset.filter(image_id=options['image_id'])
+
+        self.stdout.write('{:>10} {:>8} {:>8} {:>8}  {}'.format(
+            'hits', 'renders', 'avg_ms', 'total_ms', 'crop'))
+        for stat in queryset[:options.get('limit', 20)]:
+            self.stdout.write('{:>10} {:>8} {:>8} {:>8}  {}/{}/{}.{}'.format(
+                stat.hits,
+                stat.renders,
+                (stat.render_ms // stat.renders) if stat.renders else '-',
+                stat.render_ms,
+                stat.image_id, stat.ratio, stat.width, stat.format))
@@ -0,0 +1,70 @@
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from betty.conf.app import settings
+from betty.cropper.eviction import evict_crops, get_crops_root
+
+
+class Command(BaseCommand):
+    help = 'Evicts least recently used crops saved to disk, down to a size and/or file count budget'
+
+    # This needs to run on Django 1.7
+    option_list = BaseCommand.option_list + (
+        make_option('--max-bytes',
+                    type='int',
+                    dest='max_bytes',
+                    default=None,
+                    help='Crop tree size budget (default: BETTY_CROP_DISK_MAX_BYTES)'),
+        make_option('--max-files',
+                    type='int',
+                    dest='max_files',
+                    default=None,
+                    help='Crop tree file count budget (default: BETTY_CROP_DISK_MAX_FILES)'),
+        make_option('--policy',
+                    choices=['atime', 'manifest'],
+                    dest='policy',
+                    default=None,
+                    help='Order by file access time, or by the crop hit manifest (and access time) '
+                         '(default: "manifest" if BETTY_CROP_HIT_MANIFEST is set, else "atime")'),
+        make_option('--daemon',
+                    action='store_true',
+                    dest='daemon',
+                    default=False,
+                    help='Keep running, evicting every --interval seconds'),
+        make_option('--interval',
+                    type='int',
+                    dest='interval',
+                    default=None,
+                    help='Seconds between daemon runs '
+                         '(default: BETTY_CROP_DISK_EVICT_INTERVAL_SEC)'),
+    )
+
+    def handle(self, *args, **options):
+        max_bytes = options.get('max_bytes')
+        if max_bytes is None:
+            max_bytes = settings.BETTY_CROP_DISK_MAX_BYTES
+        max_files = options.get('max_files')
+        if max_files is None:
+            max_files = settings.BETTY_CROP_DISK_MAX_FILES
+        if max_bytes is None and max_files is None:
+            raise CommandError('No budget set (--max-bytes or --max-files)')
+
+        policy = options.get('policy')
+        if policy is None:
+            use_manifest = settings.BETTY_CROP_HIT_MANIFEST
+        else:
+            use_manifest = (policy == 'manifest')
+
+        interval = options.get('interval') or settings.BETTY_CROP_DISK_EVICT_INTERVAL_SEC
+
+        root = get_crops_root()
+        while True:
+            stats = evict_crops(root=root, max_bytes=max_bytes, max_files=max_files,
+                                use_manifest=use_manifest)
+            self.stdout.write('Scanned {scanned_files} crops ({scanned_bytes} bytes), '
+                              'evicted {evicted_files} ({evicted_bytes} bytes)'.format(**stats))
+            if not options.get('daemon'):
+                break
+            time.sleep(interval)
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cropper', '0002_image_last_modified'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CropStat',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('ratio', models.CharField(max_length=32)),
+                ('width', models.IntegerField()),
+                ('format', models.CharField(max_length=8)),
+                ('hits', models.BigIntegerField(default=0)),
+                ('renders', models.IntegerField(default=0)),
+                ('render_ms', models.BigIntegerField(default=0)),
+                ('last_hit', models.DateTimeField(null=True, blank=True)),
+                ('image', models.ForeignKey(related_name='crop_stats', to='cropper.Image')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='cropstat',
+            unique_together=set([('image', 'ratio', 'width', 'format')]),
+        ),
+    ]
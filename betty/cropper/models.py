@@ -1,22 +1,32 @@
-import errno
 import io
 import os
 import shutil
 
-from django.core.cache import cache as default_cache, caches
-from django.core.cache.backends.base import InvalidCacheBackendError
+from django.core.cache import cache
 from django.core.files import File
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import models, router
 from django.dispatch import receiver
+from django.utils import timezone
 
 from PIL import (Image as PILImage,
                  ImageFile,
                  JpegImagePlugin)
 
 from betty.conf.app import settings
+from betty.cropper.cache import decoded_image_cache, image_nbytes, source_cache
+from betty.cropper.executor import crop_executor
 from betty.cropper.flush import get_cache_flusher
-from betty.cropper.tasks import search_image_quality
+from betty.cropper.imaging import (decode_image,
+                                   draft,
+                                   get_draft_reduce,
+                                   group_by_reduce,
+                                   has_encoder,
+                                   resize_and_encode,
+                                   scale_box)
+from betty.cropper.tasks import queue_prewarm_crops, search_image_quality
+from betty.cropper.utils import seconds_since_epoch
+from betty.cropper.writer import crop_writer
 
 from jsonfield import JSONField
 
@@ -27,7 +37,14 @@ logger = __import__('logging').getLogger(__name__)
 
 
 ANIMATED_EXTENSIONS = ['gif', 'jpg']
-CROP_EXTENSIONS = ["png", "jpg"]
+
+# Bump whenever the cached metadata record layout changes (see Image.to_metadata)
+IMAGE_METADATA_VERSION = 1
+
+# Stored image formats that can be served as-is for crops of these extensions
+PASSTHROUGH_FORMATS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp"}
+
+CROP_EXTENSIONS = ["png", "jpg"] + [ext for ext in ["webp", "avif"] if has_encoder(ext)]
 
 
 def source_upload_to(instance, filename):
@@ -62,7 +79,10 @@ def optimize_image(image_model, image_buffer, filename):
     if im.size[0] > settings.BETTY_MAX_WIDTH:
         # If the image is really large, we'll save a more reasonable version as the "original"
         height = settings.BETTY_MAX_WIDTH * float(im.size[1]) / float(im.size[0])
-        im = im.resize((settings.BETTY_MAX_WIDTH, int(round(height))), PILImage.ANTIALIAS)
+        size = (settings.BETTY_MAX_WIDTH, int(round(height)))
+        if settings.BETTY_JPEG_DRAFT_DECODE:
+            draft(im, get_draft_reduce(im.size, size))
+        im = im.resize(size, PILImage.ANTIALIAS)
 
         out_buffer = io.BytesIO()
         if format == "JPEG" and im.mode == "RGB":
@@ -116,6 +136,20 @@ class Ratio(object):
 
 class ImageManager(models.Manager):
 
+    def get_cached(self, id):
+        """Returns an image from its cached metadata record, so the crop hot path doesn't touch the
+        database. Falls back to (and caches) a database lookup on cache miss.
+
+        Raises ``Image.DoesNotExist`` for missing (or deleted) images.
+        """
+        record = cache.get(self.model.metadata_cache_key(id))
+        image = self.model.from_metadata(record)
+        if image is None:
+            image = self.get(id=id)
+            # Only replace a record of an older format, a miss may race a concurrent save
+            image.cache_metadata(replace=record is not None)
+        return image
+
     def create_from_path(self, path, filename=None, name=None, credit=None):
         """Creates an image object from a TemporaryUploadedFile insance"""
 
@@ -149,48 +183,27 @@ class ImageManager(models.Manager):
         optimize_image(image_model=image, image_buffer=image_buffer, filename=filename)
 
         if settings.BETTY_JPEG_QUALITY_RANGE:
-            search_image_quality.apply_async(args=(image.id,))
+            queue_prewarm_crops(image.id, after=search_image_quality.si(image.id))
+        else:
+            queue_prewarm_crops(image.id)
 
         return image
 
 
-def save_crop_to_disk(image_data, path):
-
-    try:
-        os.makedirs(os.path.dirname(path))
-    except OSError as e:
-        if e.errno != errno.EEXIST:
-            raise e
-
-    with open(path, 'wb+') as out:
-        out.write(image_data)
-
-
 def _read_from_storage(file_field):
     """Convenience wrapper to cache strorage backend and ensure entire file is read and properly
     closed.
 
-    Currently source images are never deleted, so there is no need for a cache.delete() call
-    anywhere. To be safe, cache expriation is set via BETTY_CACHE_STORAGE_SEC.
+    Reads go through the tiered ``source_cache`` (optional local disk, then shared cache). Source
+    files are only removed when their image is deleted, and cache expiration is set via
+    BETTY_CACHE_STORAGE_SEC.
+
+    Returns a read-only file-like buffer (memory-mapped if the file is on local disk), which should
+    be closed once read.
     """
 
     if file_field:
-
-        try:
-            cache = caches['storage']
-        except InvalidCacheBackendError:
-            cache = default_cache
-
-        cache_key = ':'.join(['storage', file_field.name])
-
-        raw_image = cache.get(cache_key)
-        if not raw_image:
-            with file_field as f:
-                raw_image = f.read()
-
-            cache.set(cache_key, raw_image, settings.BETTY_CACHE_STORAGE_SEC)
-
-        return io.BytesIO(raw_image)
+        return source_cache.open(file_field)
 
 
 class Image(models.Model):
@@ -249,6 +262,110 @@ class Image(models.Model):
     def read_optimized_bytes(self):
         return _read_from_storage(self.optimized)
 
+    def read_best_image(self, reduce=1):
+        """Returns the decoded "best" image, shared via the per-process decoded image cache.
+
+        JPEGs are decoded at up to 1/``reduce`` scale (see ``imaging.get_draft_reduce``). Only a
+        cached decode requested with the same ``reduce`` is reused (never a finer one), so crops
+        don't depend on what else this process has rendered. Returns an ``(image, applied_reduce)``
+        tuple, the image must be treated as read-only.
+        """
+        cache_key = (self.id, self.last_modified, self.best.name, reduce)
+        cached = decoded_image_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        with self.read_best_bytes() as image_buffer:
+            img, applied = decode_image(image_buffer, reduce=reduce)
+        decoded_image_cache.set(cache_key, (img, applied), nbytes=image_nbytes(img))
+        return img, applied
+
+    @staticmethod
+    def metadata_cache_key(image_id):
+        return "image-metadata-{}".format(image_id)
+
+    def to_metadata(self):
+        """Returns a compact, versioned record of all fields: ``(version, field values...)``"""
+        values = []
+        for field in self._meta.concrete_fields:
+            value = getattr(self, field.attname)
+            if isinstance(field, models.FileField):
+                value = value.name
+            values.append(value)
+        return (IMAGE_METADATA_VERSION,) + tuple(values)
+
+    @classmethod
+    def from_metadata(cls, record):
+        """Builds an image from a ``to_metadata()`` record, without touching the database.
+
+        Returns None if the record is missing or out of date, and raises ``DoesNotExist`` for the
+        record of a deleted image.
+        """
+        if not record or record[0] != IMAGE_METADATA_VERSION:
+            return None
+        if len(record) == 2:
+            # Deleted, record is just (version, id)
+            raise cls.DoesNotExist("Image matching query does not exist.")
+        values = record[1:]
+        if len(values) != len(cls._meta.concrete_fields):
+            return None
+        # Same as loading the row from the database (Django 1.8+, see requirements)
+        return cls.from_db(router.db_for_read(cls),
+                           [field.attname for field in cls._meta.concrete_fields],
+                           values)
+
+    def cache_metadata(self, replace=True):
+        key = self.metadata_cache_key(self.id)
+        timeout = settings.BETTY_CACHE_IMAGE_METADATA_SEC
+        if replace:
+            cache.set(key, self.to_metadata(), timeout)
+        else:
+            # Don't clobber a newer record from a concurrent save
+            cache.add(key, self.to_metadata(), timeout)
+
+    @staticmethod
+    def stamp_cache_key(image_id):
+        return "image-stamp-{}".format(image_id)
+
+    @property
+    def version(self):
+        """Opaque string that changes whenever the image is saved"""
+        return "{:x}".format(seconds_since_epoch(self.last_modified) * 1000000 +
+                             self.last_modified.microsecond)
+
+    def last_modified_timestamp(self):
+        """``last_modified`` as seconds since epoch (or None), used as the modification time of
+        crops saved to disk, so that crops of an older version are never mistaken for fresh ones"""
+        if self.last_modified:
+            return (seconds_since_epoch(self.last_modified) +
+                    self.last_modified.microsecond / 1e6)
+
+    def is_crop_fresh(self, mtime):
+        """Whether a crop saved to disk with modification time ``mtime`` is of this version"""
+        last_modified = self.last_modified_timestamp()
+        # (Crops are saved with mtime of the image's last_modified, allow for float rounding)
+        return last_modified is None or mtime >= last_modified - 0.001
+
+    def get_stamp(self):
+        """Returns ``(last_modified, version, animated)``, enough to answer conditional requests
+        (see ``get_cached_stamp``)"""
+        return (self.last_modified, self.version, self.animated)
+
+    def cache_stamp(self, replace=True):
+        key = self.stamp_cache_key(self.id)
+        timeout = settings.BETTY_CACHE_IMAGE_METADATA_SEC
+        if replace:
+            cache.set(key, self.get_stamp(), timeout)
+        else:
+            # Don't clobber a newer stamp from a concurrent save
+            cache.add(key, self.get_stamp(), timeout)
+
+    @classmethod
+    def get_cached_stamp(cls, image_id):
+        """Returns the cached ``get_stamp()`` tuple for an image (or None), without touching the
+        database. Removed by ``clear_crops()``, refreshed on save."""
+        return cache.get(cls.stamp_cache_key(image_id))
+
     def get_height(self):
         """Lazily returns the height of the image
 
@@ -268,21 +385,25 @@ class Image(models.Model):
         return self.width
 
     def _refresh_dimensions(self):
-        img = PILImage.open(self.read_source_bytes())
+        with self.read_source_bytes() as image_buffer:
+            img = PILImage.open(image_buffer)
         self.height = img.size[1]
         self.width = img.size[0]
 
+    def _apply_optimized_dimensions(self):
+        # This is kiiiiinda a hack. If we have an optimized image, hack up the height and width.
+        if self.width > settings.BETTY_MAX_WIDTH and self.optimized:
+            height = settings.BETTY_MAX_WIDTH * float(self.height) / float(self.width)
+            self.height = int(round(height))
+            self.width = settings.BETTY_MAX_WIDTH
+
     def get_selection(self, ratio):
         """Returns the image selection for a given ratio
 
         If the selection for this ratio has been set manually, that value
         is returned exactly, otherwise the selection is auto-generated."""
 
-        # This is kiiiiinda a hack. If we have an optimized image, hack up the height and width.
-        if self.width > settings.BETTY_MAX_WIDTH and self.optimized:
-            height = settings.BETTY_MAX_WIDTH * float(self.height) / float(self.width)
-            self.height = int(round(height))
-            self.width = settings.BETTY_MAX_WIDTH
+        self._apply_optimized_dimensions()
 
         selection = None
         if self.selections is not None:
@@ -344,6 +465,9 @@ class Image(models.Model):
             ratios = list(settings.BETTY_RATIOS)
             ratios.append("original")
 
+        # Crops may change, so conditional requests must re-check the image
+        cache.delete(self.stamp_cache_key(self.id))
+
         # Optional cache flush support
         flusher = get_cache_flusher()
         if flusher:
@@ -400,79 +524,235 @@ class Image(models.Model):
 
         assert self.animated
 
-        img_bytes = self.read_best_bytes()
-        if extension == "jpg":
-            # Thumbnail
-            img = PILImage.open(img_bytes)
-            if img.mode != "RGB":
-                img = img.convert("RGB")
-            img_bytes = io.BytesIO()
-            img.save(img_bytes, "JPEG")
-        elif extension != "gif":
-            raise Exception('Unsupported extension')
+        with self.read_best_bytes() as source_buffer:
+            if extension == "jpg":
+                # Thumbnail
+                img = PILImage.open(source_buffer)
+                if img.mode != "RGB":
+                    img = img.convert("RGB")
+                img_bytes = io.BytesIO()
+                img.save(img_bytes, "JPEG")
+                img_data = img_bytes.getvalue()
+            elif extension == "gif":
+                img_data = source_buffer.getvalue()
+            else:
+                raise Exception('Unsupported extension')
 
         if settings.BETTY_SAVE_CROPS_TO_DISK:
-            save_crop_to_disk(img_bytes.getvalue(),
-                              os.path.join(self.path(settings.BETTY_SAVE_CROPS_TO_DISK_ROOT),
-                                           'animated',
-                                           'original.{}'.format(extension)))
+            crop_writer.write(img_data, self.get_animated_path(extension),
+                              mtime=self.last_modified_timestamp())
 
-        return img_bytes.getvalue()
+        return img_data
 
     def crop(self, ratio, width, extension):
-        img = PILImage.open(self.read_best_bytes())
+        return self.crop_renditions(ratio, [width], extension)[width]
+
+    def crop_renditions(self, ratio, widths, extension):
+        """Renders a single ratio at several widths, with one decode + crop per draft scale.
 
-        icc_profile = img.info.get("icc_profile")
+        Each width is resized straight from the crop, so renders exactly the bytes ``crop()`` would.
+        Returns a dictionary of width --> encoded image bytes.
+        """
+        widths = sorted(set(widths), reverse=True)
 
+        self._apply_optimized_dimensions()
         if ratio.string == 'original':
-            ratio.width = img.size[0]
-            ratio.height = img.size[1]
+            ratio.width = self.get_width()
+            ratio.height = self.get_height()
 
-        selection = self.get_selection(ratio)
-        try:
-            img = img.crop((selection['x0'], selection['y0'], selection['x1'], selection['y1']))
-        except ValueError:
-            # Looks like we have bad height and width data. Let's reload that and try again.
-            self.width = img.size[0]
-            self.height = img.size[1]
-            self.save()
+        renditions = {}
+        if ratio.string == 'original' and self.get_width() in widths:
+            image_data = self.get_passthrough_bytes(extension)
+            if image_data is not None:
+                # No pixel work needed
+                renditions[self.get_width()] = image_data
+                widths.remove(self.get_width())
 
-            selection = self.get_selection(ratio)
-            img = img.crop((selection['x0'], selection['y0'], selection['x1'], selection['y1']))
+        if widths:
+            renditions.update(zip(widths, self._render_renditions(ratio, widths, extension)))
 
-        height = int(round(width * float(ratio.height) / float(ratio.width)))
-        img = img.resize((width, height), PILImage.ANTIALIAS)
+        for width in renditions:
+            self._save_crop(ratio, width, extension, renditions[width])
 
+        return renditions
+
+    def _render_renditions(self, ratio, widths, extension):
+        """Returns encoded crops for ``widths`` (largest first)"""
+
+        def get_size(width):
+            return (width, int(round(width * float(ratio.height) / float(ratio.width))))
+
+        selection = self.get_selection(ratio)
+        sizes = [get_size(width) for width in widths]
+        encoder_kwargs = [self.get_encoder_kwargs(width, extension) for width in widths]
+
+        # Large downscales can skip most of the JPEG decode work. Chosen per width, so a width
+        # renders the same bytes whether or not it's part of a batch.
+        reduces = [1] * len(sizes)
+        if settings.BETTY_JPEG_DRAFT_DECODE:
+            reduces = [get_draft_reduce((selection['x1'] - selection['x0'],
+                                         selection['y1'] - selection['y0']),
+                                        size)
+                       for size in sizes]
+
+        results = None
+        if settings.BETTY_CROP_FROM_RENDITION_MIN_OVERSAMPLE:
+            results = self._render_from_rendition(ratio.string, sizes, encoder_kwargs, extension)
+
+        if results is None and settings.BETTY_CROP_PROCESS_POOL:
+            # Pixel work in a worker process, storage + DB access stays here
+            with self.read_best_bytes() as image_buffer:
+                image_data = image_buffer.getvalue()
+            results = crop_executor.render(image_data, selection, sizes, encoder_kwargs, reduces)
+
+        if results is None:
+            results = [None] * len(sizes)
+            for reduce, indexes in group_by_reduce(reduces):
+                img, reduce = self.read_best_image(reduce=reduce)
+
+                icc_profile = img.info.get("icc_profile")
+
+                try:
+                    img = img.crop(scale_box(selection, reduce, img.size))
+                except ValueError:
+                    # Looks like we have bad height and width data. Let's reload that and try again.
+                    img, reduce = self.read_best_image()
+                    self.width = img.size[0]
+                    self.height = img.size[1]
+                    self.last_modified = timezone.now()
+                    # Only update dimensions, this instance may be from (stale) cached metadata
+                    Image.objects.filter(id=self.id).update(width=self.width,
+                                                            height=self.height,
+                                                            last_modified=self.last_modified)
+                    self.cache_metadata()
+                    self.cache_stamp()
+
+                    selection = self.get_selection(ratio)
+                    img = img.crop(scale_box(selection, reduce, img.size))
+
+                encoded = resize_and_encode(img, [sizes[i] for i in indexes],
+                                            [encoder_kwargs[i] for i in indexes], icc_profile)
+                for index, rendition in zip(indexes, encoded):
+                    results[index] = rendition
+
+        return results
+
+    def get_passthrough_bytes(self, extension):
+        """Returns the stored optimized image unchanged, if it already is the "original" crop at its
+        stored width in ``extension`` format, else None.
+
+        Not used when per-width quality settings apply, or for images with EXIF data (which crops
+        otherwise strip).
+        """
+        if not self.optimized or self.jpeg_quality_settings:
+            return None
+
+        self._apply_optimized_dimensions()
+        with self.read_optimized_bytes() as image_buffer:
+            try:
+                img = PILImage.open(image_buffer)
+            except IOError:
+                return None
+
+            if (PASSTHROUGH_FORMATS.get(img.format) != extension or
+                    img.size != (self.get_width(), self.get_height()) or
+                    (img.format == "JPEG" and img.mode not in ("RGB", "L")) or
+                    "exif" in img.info):
+                return None
+
+            return image_buffer.getvalue()
+
+    def find_rendition(self, ratio_slug, width, extension):
+        """Returns ``(width, path)`` of the smallest fresh crop of this ratio saved to disk that is
+        at least ``settings.BETTY_CROP_FROM_RENDITION_MIN_OVERSAMPLE`` times ``width``, or None."""
+        if not settings.BETTY_SAVE_CROPS_TO_DISK:
+            return None
+
+        min_width = width * settings.BETTY_CROP_FROM_RENDITION_MIN_OVERSAMPLE
+        ratio_path = os.path.dirname(self.get_crop_path(ratio_slug, width, extension))
+        try:
+            filenames = os.listdir(ratio_path)
+        except OSError:
+            return None
+
+        candidates = []
+        for filename in filenames:
+            name, ext = os.path.splitext(filename)
+            if ext == "." + extension and name.isdigit():
+                candidate = int(name)
+                if candidate > width and candidate >= min_width:
+                    candidates.append(candidate)
+
+        for candidate in sorted(candidates):
+            path = os.path.join(ratio_path, "%d.%s" % (candidate, extension))
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            if self.is_crop_fresh(mtime):
+                return candidate, path
+        return None
+
+    def _render_from_rendition(self, ratio_slug, sizes, encoder_kwargs, extension):
+        """Resizes (much smaller) crops from a larger one already saved to disk, instead of the
+        original image. Returns None if there is no suitable rendition."""
+        rendition = self.find_rendition(ratio_slug, sizes[0][0], extension)
+        if rendition is None:
+            return None
+
+        try:
+            with open(rendition[1], "rb") as f:
+                image_buffer = io.BytesIO(f.read())
+            img = PILImage.open(image_buffer)
+            draft(img, get_draft_reduce(img.size, sizes[0]))
+            img.load()
+        except (IOError, OSError):
+            # Removed (or evicted) since found
+            return None
+        return resize_and_encode(img, sizes, encoder_kwargs, img.info.get("icc_profile"))
+
+    def get_encoder_kwargs(self, width, extension):
+        """Pillow ``save()`` keyword arguments for a crop"""
         if extension == "jpg":
-            if img.mode != "RGB":
-                img = img.convert("RGB")
             pillow_kwargs = {"format": "jpeg"}
 
             if self.get_jpeg_quality(width):
                 pillow_kwargs["quality"] = self.get_jpeg_quality(width)
-            elif img.format == "JPEG":
-                pillow_kwargs["quality"] = "keep"
             else:
                 pillow_kwargs["quality"] = settings.BETTY_DEFAULT_JPEG_QUALITY
 
         if extension == "png":
             pillow_kwargs = {"format": "png"}
 
-        if icc_profile:
-            pillow_kwargs["icc_profile"] = icc_profile
+        if extension in ("webp", "avif"):
+            pillow_kwargs = {"format": extension}
+
+            # JPEG quality search results don't carry over, quality scales differ per format
+            if extension == "webp":
+                pillow_kwargs["quality"] = settings.BETTY_DEFAULT_WEBP_QUALITY
+            else:
+                pillow_kwargs["quality"] = settings.BETTY_DEFAULT_AVIF_QUALITY
+
+        return pillow_kwargs
+
+    def get_crop_path(self, ratio_slug, width, extension):
+        """Path of a crop saved to disk (if BETTY_SAVE_CROPS_TO_DISK enabled)"""
+        return os.path.join(self.path(settings.BETTY_SAVE_CROPS_TO_DISK_ROOT),
+                            ratio_slug,
+                            "%d.%s" % (width, extension))
 
-        tmp = io.BytesIO()
-        img.save(tmp, **pillow_kwargs)
+    def get_animated_path(self, extension):
+        """Path of an animated "crop" saved to disk (if BETTY_SAVE_CROPS_TO_DISK enabled)"""
+        return os.path.join(self.path(settings.BETTY_SAVE_CROPS_TO_DISK_ROOT),
+                            'animated',
+                            'original.{}'.format(extension))
 
+    def _save_crop(self, ratio, width, extension, image_data):
         if settings.BETTY_SAVE_CROPS_TO_DISK:
             # We only want to save this to the filesystem if it's one of our usual widths.
             if width in settings.BETTY_WIDTHS or not settings.BETTY_WIDTHS:
-                ratio_dir = os.path.join(self.path(settings.BETTY_SAVE_CROPS_TO_DISK_ROOT),
-                                         ratio.string)
-                save_crop_to_disk(tmp.getvalue(),
-                                  os.path.join(ratio_dir, "%d.%s" % (width, extension)))
-
-        return tmp.getvalue()
+                crop_writer.write(image_data, self.get_crop_path(ratio.string, width, extension),
+                                  mtime=self.last_modified_timestamp())
 
     def get_absolute_url(self, ratio="original", width=600, extension="jpg"):
         return reverse("betty.cropper.views.crop", kwargs={
@@ -491,11 +771,7 @@ class Image(models.Model):
     def to_native(self):
         """Returns a Python dictionary, sutiable for Serialization"""
 
-        # This is kiiiiinda a hack. If we have an optimized image, hack up the height and width.
-        if self.width > settings.BETTY_MAX_WIDTH and self.optimized:
-            height = settings.BETTY_MAX_WIDTH * float(self.height) / float(self.width)
-            self.height = int(round(height))
-            self.width = settings.BETTY_MAX_WIDTH
+        self._apply_optimized_dimensions()
 
         data = {
             'id': self.id,
@@ -519,9 +795,53 @@ class Image(models.Model):
         return "image-{}".format(self.id)
 
 
+class CropStat(models.Model):
+    """Aggregated (sampled) request counts and render costs of a crop rendition, recorded by the
+    crop view (see ``betty.cropper.popularity``)."""
+
+    image = models.ForeignKey(Image, related_name="crop_stats", on_delete=models.CASCADE)
+    ratio = models.CharField(max_length=32)
+    width = models.IntegerField()
+    format = models.CharField(max_length=8)
+
+    hits = models.BigIntegerField(default=0)
+    renders = models.IntegerField(default=0)
+    render_ms = models.BigIntegerField(default=0)  # Total render time
+    last_hit = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ("image", "ratio", "width", "format")
+
+    def to_native(self):
+        return {
+            "id": self.image_id,
+            "ratio": self.ratio,
+            "width": self.width,
+            "format": self.format,
+            "hits": self.hits,
+            "renders": self.renders,
+            "render_ms": self.render_ms,
+            "avg_render_ms": (self.render_ms // self.renders) if self.renders else None,
+            "last_hit": self.last_hit.isoformat() if self.last_hit else None,
+        }
+
+
+@receiver(models.signals.post_save, sender=Image)
+def cache_metadata_on_save(sender, instance, **kwargs):
+    instance.cache_metadata()
+    instance.cache_stamp()
+
+
+@receiver(models.signals.post_delete, sender=Image)
+def cache_metadata_on_delete(sender, instance, **kwargs):
+    cache.set(Image.metadata_cache_key(instance.id), (IMAGE_METADATA_VERSION, instance.id),
+              settings.BETTY_CACHE_IMAGE_METADATA_SEC)
+
+
 @receiver(models.signals.post_delete, sender=Image)
 def auto_flush_and_delete_files_on_delete(sender, instance, **kwargs):
     instance.clear_crops()
     for file_field in [instance.source, instance.optimized]:
         if file_field:
+            source_cache.delete(file_field)
             file_field.delete(save=False)
@@ -0,0 +1,193 @@
+import atexit
+from collections import defaultdict
+import os
+import random
+import threading
+import time
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from betty.conf.app import settings
+
+logger = __import__('logging').getLogger(__name__)
+
+# Shortest interval between background flush checks
+FLUSHER_MIN_SEC = 1
+
+
+class CropStatsRecorder(object):
+    """Aggregates crop rendition request counts and render costs in memory, periodically flushing
+    them to the ``CropStat`` table.
+
+    Requests are sampled at ``settings.BETTY_CROP_STATS_SAMPLE_RATE`` (0 to disable), each sampled
+    request counting for ``1 / rate`` hits (rounded to whole hits at random when flushed, so counts
+    stay unbiased). Renders are always recorded, since they are already expensive. Every
+    ``settings.BETTY_CROP_STATS_FLUSH_SEC`` seconds (checked by a background thread, and by each
+    request), once ``settings.BETTY_CROP_STATS_MAX_KEYS`` renditions are pending, and at exit, the
+    counters are handed to the ``flush_crop_stats`` Celery task, so the database writes stay off
+    the request path.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = self._new_pending()
+        self._last_flush = time.time()
+        self._flusher_pid = None
+        self.sampled = 0
+        self.flushes = 0
+        self.errors = 0
+
+    @staticmethod
+    def _new_pending():
+        # (image_id, ratio, width, format) -> [hits (fractional estimate), renders, render_ms]
+        return defaultdict(lambda: [0, 0, 0])
+
+    def record(self, image_id, ratio_slug, width, extension, render_sec=None):
+        rate = settings.BETTY_CROP_STATS_SAMPLE_RATE
+        if not rate:
+            return
+
+        sampled = random.random() < rate
+        if not sampled and render_sec is None:
+            return
+
+        key = (image_id, ratio_slug, width, extension)
+        with self._lock:
+            if self._flusher_pid != os.getpid():
+                self._start_flusher()
+            counters = self._pending[key]
+            if sampled:
+                self.sampled += 1
+                counters[0] += 1.0 / rate
+            if render_sec is not None:
+                counters[1] += 1
+                counters[2] += int(render_sec * 1000)
+
+            flush = (time.time() - self._last_flush >= settings.BETTY_CROP_STATS_FLUSH_SEC or
+                     len(self._pending) >= settings.BETTY_CROP_STATS_MAX_KEYS)
+
+        if flush:
+            self.queue_flush()
+
+    def _start_flusher(self):
+        """Starts the background flush thread (again, if forked). Called with the lock held."""
+        if self._flusher_pid is None:
+            # Registration is inherited by forked children
+            atexit.register(self.queue_flush)
+        self._flusher_pid = os.getpid()
+        thread = threading.Thread(target=self._flush_periodically, name="crop-stats-flusher")
+        thread.daemon = True
+        thread.start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(max(settings.BETTY_CROP_STATS_FLUSH_SEC, FLUSHER_MIN_SEC))
+            with self._lock:
+                due = (self._pending and
+                       time.time() - self._last_flush >= settings.BETTY_CROP_STATS_FLUSH_SEC)
+            if due:
+                self.queue_flush()
+
+    def _take_pending(self):
+        """Returns pending counters as ``(image_id, ratio, width, format, hits, renders,
+        render_ms)`` rows, resetting them"""
+        with self._lock:
+            pending, self._pending = self._pending, self._new_pending()
+            self._last_flush = time.time()
+            self.flushes += 1
+        return [key + (_round_hits(hits), renders, render_ms)
+                for key, (hits, renders, render_ms) in pending.items()]
+
+    def queue_flush(self):
+        """Hands pending counters to the ``flush_crop_stats`` task"""
+        from betty.cropper.tasks import flush_crop_stats
+
+        rows = self._take_pending()
+        if not rows:
+            return
+        try:
+            flush_crop_stats.delay(rows)
+        except Exception:
+            # Sampled stats, better lost than failing the request
+            logger.exception('Error queueing crop stats flush')
+            with self._lock:
+                self.errors += 1
+
+    def flush(self):
+        """Writes pending counters to the database now. Returns number of renditions written."""
+        try:
+            return write_crop_stats(self._take_pending())
+        except Exception:
+            logger.exception('Error flushing crop stats')
+            with self._lock:
+                self.errors += 1
+            return 0
+
+    def stats(self):
+        return {
+            "sample_rate": settings.BETTY_CROP_STATS_SAMPLE_RATE,
+            "pending": len(self._pending),
+            "sampled": self.sampled,
+            "flushes": self.flushes,
+            "errors": self.errors,
+        }
+
+    def reset(self):
+        with self._lock:
+            self._pending = self._new_pending()
+            self._last_flush = time.time()
+            self.sampled = 0
+            self.flushes = 0
+            self.errors = 0
+
+
+def _round_hits(hits):
+    """Rounds a fractional hit estimate up or down at random, in proportion to the fraction"""
+    whole = int(hits)
+    return whole + (1 if random.random() < hits - whole else 0)
+
+
+crop_stats = CropStatsRecorder()
+
+
+def _upsert(now, image_id, ratio_slug, width, extension, hits, renders, render_ms):
+    from betty.cropper.models import CropStat
+
+    lookup = dict(image_id=image_id, ratio=ratio_slug, width=width, format=extension)
+    updates = dict(hits=F('hits') + hits,
+                   renders=F('renders') + renders,
+                   render_ms=F('render_ms') + render_ms)
+    if hits:
+        updates['last_hit'] = now
+
+    if CropStat.objects.filter(**lookup).update(**updates):
+        return
+    try:
+        with transaction.atomic():
+            CropStat.objects.create(hits=hits, renders=renders, render_ms=render_ms,
+                                    last_hit=now if hits else None, **lookup)
+    except IntegrityError:
+        # Created concurrently by another process
+        CropStat.objects.filter(**lookup).update(**updates)
+
+
+def write_crop_stats(rows):
+    """Adds ``(image_id, ratio, width, format, hits, renders, render_ms)`` rows to the ``CropStat``
+    table. Returns number of renditions written."""
+    from betty.cropper.models import Image
+
+    if not rows:
+        return 0
+
+    now = timezone.now()
+    # Images deleted in the meantime are dropped
+    image_ids = set(Image.objects.filter(id__in=set(row[0] for row in rows))
+                                 .values_list('id', flat=True))
+    written = 0
+    for row in rows:
+        if row[0] in image_ids:
+            _upsert(now, *row)
+            written += 1
+    return written
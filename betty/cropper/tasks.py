@@ -1,13 +1,22 @@
 from __future__ import absolute_import
 
 import io
+import multiprocessing
 
 from celery import shared_task
 from PIL import Image as PILImage
 
 from betty.conf.app import settings
+from betty.cropper.cache import buffer_size
+
+from .dssim import search_optimal_quality
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    # Python 2 requires "futures" backport
+    ProcessPoolExecutor = None
 
-from .dssim import detect_optimal_quality
 try:
     # Legacy check: Try import here to determine if we should enable IMGMIN
     import numpy  # NOQA
@@ -16,6 +25,8 @@ try:
 except ImportError:
     IMGMIN_DISABLED = True
 
+logger = __import__('logging').getLogger(__name__)
+
 
 def is_optimized(image_field):
     """Checks if the image is already optimized
@@ -23,28 +34,112 @@ def is_optimized(image_field):
     For our purposes, we check to see if the existing file will be smaller than
     a version saved at the default quality (80)."""
 
-    source_buffer = image_field.read_source_bytes()
-
-    im = PILImage.open(source_buffer)
-    icc_profile = im.info.get("icc_profile")
-
-    # First, let's check to make sure that this image isn't already an optimized JPEG
-    if im.format == "JPEG":
-        optimized_buffer = io.BytesIO()
-        im.save(
-            optimized_buffer,
-            format="JPEG",
-            quality=settings.BETTY_DEFAULT_JPEG_QUALITY,
-            icc_profile=icc_profile,
-            optimize=True)
-        # Note: .getbuffer().nbytes is preferred, but not supported in Python 2.7
-        if len(source_buffer.getvalue()) < len(optimized_buffer.getvalue()):
-            # Looks like the original was already compressed, let's bail.
-            return True
+    with image_field.read_source_bytes() as source_buffer:
+        im = PILImage.open(source_buffer)
+        icc_profile = im.info.get("icc_profile")
+
+        # First, let's check to make sure that this image isn't already an optimized JPEG
+        if im.format == "JPEG":
+            optimized_buffer = io.BytesIO()
+            im.save(
+                optimized_buffer,
+                format="JPEG",
+                quality=settings.BETTY_DEFAULT_JPEG_QUALITY,
+                icc_profile=icc_profile,
+                optimize=True)
+            if buffer_size(source_buffer) < buffer_size(optimized_buffer):
+                # Looks like the original was already compressed, let's bail.
+                return True
 
     return False
 
 
+def get_quality_search_widths():
+    """Breakpoint widths to search JPEG quality at, largest first"""
+    widths = []
+    last_width = 0
+    for width in sorted(settings.BETTY_WIDTHS, reverse=True):
+
+        if abs(last_width - width) < 100:
+            # Sometimes the widths are really too close. We only need to check every 100 px
+            continue
+
+        if width > 0:
+            widths.append(width)
+
+        last_width = width
+    return widths
+
+
+def _search_optimal_quality(image_data, width, quality_range):
+    return search_optimal_quality(io.BytesIO(image_data), width, quality_range=quality_range)
+
+
+def _start_quality_search_pool(image_buffer, widths):
+    """Returns ``(pool, futures)`` searching each width in a worker process, or ``(None, None)`` if
+    disabled or unavailable."""
+    workers = min(settings.BETTY_QUALITY_SEARCH_WORKERS or 1, len(widths))
+    if workers <= 1 or ProcessPoolExecutor is None:
+        return None, None
+    if multiprocessing.current_process().daemon:
+        # Ex: Celery prefork workers, which can't start child processes
+        logger.debug('Quality search running in a daemonic process, searching sequentially')
+        return None, None
+
+    pool = None
+    try:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        image_data = image_buffer.getvalue()
+        quality_range = tuple(settings.BETTY_JPEG_QUALITY_RANGE)
+        # Submitted largest first, so workers pick up widths in the order results are needed
+        futures = [pool.submit(_search_optimal_quality, image_data, width, quality_range)
+                   for width in widths]
+    except Exception:
+        logger.warning('Quality search process pool unavailable, searching sequentially',
+                       exc_info=True)
+        if pool is not None:
+            pool.shutdown(wait=False)
+        return None, None
+    return pool, futures
+
+
+def search_qualities(image_buffer, widths):
+    """Returns ``({width: quality}, probes)``: the optimal JPEG quality at each width (largest
+    first), and the total number of encode + measure probes.
+
+    Stops after the first width already at max quality. Searched in order, each width's search
+    starts from the previous width's result. Widths are instead searched concurrently (without
+    warm start) in ``settings.BETTY_QUALITY_SEARCH_WORKERS`` processes if set, in which case
+    results are still consumed in order. On early exit, searches not yet started are cancelled and
+    any still running finish in the background, without holding up the caller.
+    """
+    pool, futures = _start_quality_search_pool(image_buffer, widths)
+
+    qualities = {}
+    probes = 0
+    quality = None
+    try:
+        for index, width in enumerate(widths):
+            if futures is not None:
+                quality, width_probes = futures[index].result()
+            else:
+                image_buffer.seek(0)
+                quality, width_probes = search_optimal_quality(image_buffer, width, seed=quality)
+            qualities[width] = quality
+            probes += width_probes
+
+            if quality == settings.BETTY_JPEG_QUALITY_RANGE[-1]:
+                # We'are already at max...
+                break
+    finally:
+        if pool is not None:
+            for future in futures:
+                future.cancel()
+            pool.shutdown(wait=False)
+
+    return qualities, probes
+
+
 @shared_task
 def search_image_quality(image_id):
     if IMGMIN_DISABLED:
@@ -59,25 +154,90 @@ def search_image_quality(image_id):
         return
 
     # Read buffer from storage once and reset on each iteration
-    optimized_buffer = image.read_optimized_bytes()
-    image.jpeg_quality_settings = {}
-    last_width = 0
-    for width in sorted(settings.BETTY_WIDTHS, reverse=True):
+    with image.read_optimized_bytes() as optimized_buffer:
+        image.jpeg_quality_settings, probes = search_qualities(optimized_buffer,
+                                                               get_quality_search_widths())
+    logger.info('Searched JPEG quality of image %s at %d widths in %d probes',
+                image.id, len(image.jpeg_quality_settings), probes)
 
-        if abs(last_width - width) < 100:
-            # Sometimes the widths are really too close. We only need to check every 100 px
-            continue
+    image.save()
+    image.clear_crops()
 
-        if width > 0:
-            optimized_buffer.seek(0)
-            quality = detect_optimal_quality(optimized_buffer, width)
-            image.jpeg_quality_settings[width] = quality
 
-            if quality == settings.BETTY_JPEG_QUALITY_RANGE[-1]:
-                # We'are already at max...
-                break
+@shared_task
+def render_renditions(image_id, ratio_slug, extension="jpg", widths=None):
+    """Renders all breakpoint widths (or ``widths``) of a ratio from a single decode.
 
-        last_width = width
+    Renditions are saved to disk (if BETTY_SAVE_CROPS_TO_DISK enabled). To avoid pushing image
+    data through the result backend, only the rendered widths are returned.
+    """
+    from betty.cropper.models import Image, Ratio
 
-    image.save()
-    image.clear_crops()
+    if widths is None:
+        widths = settings.BETTY_WIDTHS
+    widths = [width for width in widths if 0 < width <= settings.BETTY_MAX_WIDTH]
+    if not widths:
+        return []
+
+    image = Image.objects.get(id=image_id)
+    renditions = image.crop_renditions(Ratio(ratio_slug), widths, extension)
+    return sorted(renditions)
+
+
+def get_prewarm_task_options():
+    """``apply_async()`` options routing pre-warm tasks away from interactive work"""
+    options = {}
+    if settings.BETTY_PREWARM_QUEUE:
+        options["queue"] = settings.BETTY_PREWARM_QUEUE
+    if settings.BETTY_PREWARM_PRIORITY is not None:
+        options["priority"] = settings.BETTY_PREWARM_PRIORITY
+    return options
+
+
+@shared_task
+def prewarm_crops(image_id, ratios=None):
+    """Queues rendering of all ``ratios`` (default: BETTY_PREWARM_RATIOS) at every breakpoint width,
+    in each of BETTY_PREWARM_FORMATS.
+
+    One ``render_renditions`` task is queued per ratio + format, so each is rendered from a single
+    decode. Renditions are saved to disk, so pre-warming does nothing unless
+    BETTY_SAVE_CROPS_TO_DISK is enabled.
+    """
+    from betty.cropper.models import CROP_EXTENSIONS
+
+    if not (settings.BETTY_PREWARM and settings.BETTY_SAVE_CROPS_TO_DISK):
+        return
+
+    if ratios is None:
+        ratios = settings.BETTY_PREWARM_RATIOS
+        if ratios is None:
+            ratios = ["original"] + list(settings.BETTY_RATIOS)
+
+    options = get_prewarm_task_options()
+    for ratio_slug in ratios:
+        for extension in settings.BETTY_PREWARM_FORMATS:
+            if extension in CROP_EXTENSIONS:
+                render_renditions.apply_async(args=(image_id, ratio_slug, extension), **options)
+
+
+def queue_prewarm_crops(image_id, ratios=None, after=None):
+    """Queues ``prewarm_crops`` (if BETTY_PREWARM enabled), optionally only once task signature
+    ``after`` completes (since quality search clears existing crops)."""
+    if not settings.BETTY_PREWARM:
+        if after is not None:
+            after.apply_async()
+        return
+
+    prewarm = prewarm_crops.si(image_id, ratios).set(**get_prewarm_task_options())
+    if after is not None:
+        after.apply_async(link=prewarm)
+    else:
+        prewarm.apply_async()
+
+
+@shared_task
+def flush_crop_stats(rows):
+    """Writes crop stats counters handed over by a web process's ``CropStatsRecorder``"""
+    from betty.cropper.popularity import write_crop_stats
+
+    return write_crop_stats(rows)
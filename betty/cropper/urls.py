@@ -1,11 +1,13 @@
 from django.conf.urls import patterns, url, include
 
+CROP_PATH = r'(?P<ratio_slug>[a-z0-9]+)/(?P<width>\d+)\.(?P<extension>(jpg|png|webp|avif))$'
+
 urlpatterns = patterns(
     'betty.cropper.views',
     url(r'^image\.js$', "image_js"),
-    url(r'^(?P<id>\d{5,})/(?P<ratio_slug>[a-z0-9]+)/(?P<width>\d+)\.(?P<extension>(jpg|png))$',
+    url(r'^(?P<id>\d{5,})/' + CROP_PATH,
         'redirect_crop'),
-    url(r'^(?P<id>[0-9/]+)/(?P<ratio_slug>[a-z0-9]+)/(?P<width>\d+)\.(?P<extension>(jpg|png))$',
+    url(r'^(?P<id>[0-9/]+)/' + CROP_PATH,
         'crop'),
     url(r'^(?P<id>[0-9/]+)/animated/original\.(?P<extension>(jpg|gif))$',
         'animated'),
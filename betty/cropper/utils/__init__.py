@@ -1,6 +1,38 @@
+import errno
+import os
 import time
+import uuid
 
 
 # Necessary b/c Python<3.3 doesn't support datetime.timestamp()
 def seconds_since_epoch(when):
     return int(time.mktime(when.timetuple()))
+
+
+def write_file_atomic(path, data, mtime=None):
+    """Writes a file via a temporary file + rename, so concurrent readers never see a partial file.
+
+    Optionally sets the file's modification time to ``mtime`` (seconds since epoch).
+    """
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    # Same directory (so same filesystem), hidden from web server "try_files" lookups
+    tmp_path = os.path.join(os.path.dirname(path),
+                            '.tmp-{}-{}'.format(os.path.basename(path), uuid.uuid4().hex[:8]))
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        if mtime is not None:
+            os.utime(tmp_path, (time.time(), mtime))
+        os.rename(tmp_path, path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
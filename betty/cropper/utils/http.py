@@ -1,16 +1,30 @@
-from django.utils.http import parse_http_date_safe
+from django.utils.http import parse_etags, parse_http_date_safe
 
 from betty.cropper.utils import seconds_since_epoch
 
 
-def check_not_modified(request, last_modified):
-    """Handle 304/If-Modified-Since
+def check_not_modified(request, last_modified, etag=None):
+    """Handle 304/If-Modified-Since (and If-None-Match, if the response has an (unquoted) ``etag``)
 
     With Django v1.9.5+ could just use "django.utils.cache.get_conditional_response", but v1.9 is
     not supported by "logan" dependancy (yet).
     """
 
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if etag and if_none_match:
+        # If-None-Match takes precedence over If-Modified-Since (RFC 7232)
+        if if_none_match.strip() == '*':
+            return True
+        # Note: weak comparison, parse_etags() drops any "W/" prefix
+        return etag in parse_etags(if_none_match)
+
     if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE'))
     return (last_modified and
             if_modified_since and
             seconds_since_epoch(last_modified) <= if_modified_since)
+
+
+def is_conditional(request):
+    """Whether the request carries any validators answered by ``check_not_modified``"""
+    return bool(request.META.get('HTTP_IF_NONE_MATCH') or
+                request.META.get('HTTP_IF_MODIFIED_SINCE'))
@@ -28,6 +28,8 @@ def placeholder(ratio, width, extension):
         pillow_kwargs = {"format": "jpeg", "quality": 80}
     if extension == 'png':
         pillow_kwargs = {"format": "png"}
+    if extension in ('webp', 'avif'):
+        pillow_kwargs = {"format": extension, "quality": 80}
 
     tmp = io.BytesIO()
     img.save(tmp, **pillow_kwargs)
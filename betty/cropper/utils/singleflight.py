@@ -0,0 +1,146 @@
+import threading
+import time
+
+from betty.cropper.cache import SharedCacheTier
+
+logger = __import__('logging').getLogger(__name__)
+
+
+# How often followers check a shared cache for the leader's result, backing off exponentially
+CACHE_POLL_SEC = 0.05
+CACHE_POLL_MAX_SEC = 0.4
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls for the same key, so that only one caller (the "leader") does the
+    work while the rest ("followers") wait for and share its result.
+
+    Calls are always coalesced between threads of the same process. If a Django ``cache`` is passed
+    to ``do()``, the leader also takes a lock in that cache, which coalesces calls across
+    processes/servers sharing the cache. Followers there flag that they are waiting, and only then
+    does the leader publish its result (which must be bytes) to the cache, in chunks if large (see
+    ``SharedCacheTier``). If the leader finishes without a result for them, one of the followers
+    takes over the lock and does the work.
+
+    Followers that wait longer than ``timeout`` seconds give up and do the work themselves.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.followers = 0
+        self.shared = 0
+        self.timeouts = 0
+        self.wait_sec = 0.0
+
+    def do(self, key, fn, timeout, cache=None):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if leader:
+            try:
+                if cache is not None:
+                    call.result = self._do_cached(key, fn, timeout, cache)
+                else:
+                    self._count(leaders=1)
+                    call.result = fn()
+            except Exception as e:
+                call.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+            return call.result
+
+        start = time.time()
+        finished = call.done.wait(timeout)
+        self._count(followers=1, wait_sec=time.time() - start)
+        if not finished:
+            logger.warning('Timed out waiting on "%s", doing work instead', key)
+            self._count(timeouts=1)
+            return fn()
+        if call.error is not None:
+            raise call.error
+        self._count(shared=1)
+        return call.result
+
+    def _do_cached(self, key, fn, timeout, cache):
+        lock_key = 'singleflight:lock:' + key
+        waiting_key = 'singleflight:waiting:' + key
+        result_key = 'singleflight:result:' + key
+        results = SharedCacheTier(cache)
+
+        start = time.time()
+        poll_sec = CACHE_POLL_SEC
+        waiting = False
+        while True:
+            # Single round trip per check
+            values = cache.get_many([result_key, lock_key])
+            if result_key in values:
+                result = results.load(result_key, values[result_key])
+                if result is not None:
+                    self._count(followers=1, shared=1, wait_sec=time.time() - start)
+                    return result
+
+            if lock_key not in values and cache.add(lock_key, 1, timeout):
+                # Leader (possibly taking over from one that failed)
+                self._count(leaders=1)
+                try:
+                    result = fn()
+                    if cache.get(waiting_key):
+                        results.set(result_key, result, timeout)
+                        cache.delete(waiting_key)
+                finally:
+                    cache.delete(lock_key)
+                return result
+
+            if not waiting:
+                cache.set(waiting_key, 1, timeout)
+                waiting = True
+
+            remaining = timeout - (time.time() - start)
+            if remaining <= 0:
+                logger.warning('Timed out waiting on "%s", doing work instead', key)
+                self._count(timeouts=1)
+                break
+            time.sleep(min(poll_sec, remaining))
+            poll_sec = min(poll_sec * 2, CACHE_POLL_MAX_SEC)
+
+        self._count(followers=1, wait_sec=time.time() - start)
+        return fn()
+
+    def _count(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def stats(self):
+        return {
+            "in_flight": len(self._calls),
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "shared": self.shared,
+            "timeouts": self.timeouts,
+            "wait_sec": self.wait_sec,
+        }
+
+    def reset(self):
+        with self._lock:
+            self.leaders = 0
+            self.followers = 0
+            self.shared = 0
+            self.timeouts = 0
+            self.wait_sec = 0.0
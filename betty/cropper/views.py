@@ -1,18 +1,27 @@
+import hashlib
 import json
+import os
+import time
+
 from betty.conf.app import settings
 
-from django.http import (Http404, HttpResponse, HttpResponseNotModified,
+from django.core.cache import cache
+from django.http import (FileResponse, Http404, HttpResponse, HttpResponseNotModified,
                          HttpResponseServerError, HttpResponseRedirect)
 from django.shortcuts import render
-from django.utils.cache import patch_cache_control
-from django.utils.http import http_date
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
 
 from django.views.decorators.cache import cache_control
 from six.moves import urllib
 
-from .models import Image, Ratio
-from .utils.http import check_not_modified
+from .eviction import record_crop_hit
+from .imaging import PILLOW_VERSION
+from .models import CROP_EXTENSIONS, Image, Ratio
+from .popularity import crop_stats
+from .utils.http import check_not_modified, is_conditional
 from .utils.placeholder import placeholder
+from .utils.singleflight import SingleFlight
 
 logger = __import__('logging').getLogger(__name__)
 
@@ -30,8 +39,19 @@ EXTENSION_MAP = {
         "format": "png",
         "mime_type": "image/png"
     },
+    "webp": {
+        "format": "webp",
+        "mime_type": "image/webp"
+    },
+    "avif": {
+        "format": "avif",
+        "mime_type": "image/avif"
+    },
 }
 
+# Coalesces identical concurrent crop requests (see BETTY_CROP_COALESCE)
+crop_flight = SingleFlight()
+
 
 @cache_control(max_age=settings.BETTY_CACHE_IMAGEJS_SEC)
 def image_js(request):
@@ -87,10 +107,165 @@ def _image_response(image_blob, extension):
     return resp
 
 
+def _fresh_disk_crop_stat(image, path):
+    """Returns ``os.stat()`` of a crop previously saved to disk, if it is newer than the image's
+    last modification, else None."""
+    if not settings.BETTY_SAVE_CROPS_TO_DISK:
+        return None
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    if not image.is_crop_fresh(stat.st_mtime):
+        return None
+
+    return stat
+
+
+def _disk_crop_response(image, path, extension):
+    """Serves a crop previously saved to disk, if it is newer than the image's last modification.
+
+    Returns None if there is no fresh crop on disk.
+    """
+    if not settings.BETTY_SERVE_CROPS_FROM_DISK:
+        return None
+
+    stat = _fresh_disk_crop_stat(image, path)
+    if stat is None:
+        return None
+
+    record_crop_hit(path)
+
+    if settings.BETTY_SENDFILE_HEADER:
+        # Let the frontend server (nginx/Apache) stream the file
+        if settings.BETTY_SENDFILE_PREFIX:
+            crops_root = settings.BETTY_SAVE_CROPS_TO_DISK_ROOT or settings.BETTY_IMAGE_ROOT
+            location = (settings.BETTY_SENDFILE_PREFIX.rstrip('/') + '/' +
+                        os.path.relpath(path, crops_root).replace(os.sep, '/'))
+        else:
+            location = path
+        resp = HttpResponse()
+        resp[settings.BETTY_SENDFILE_HEADER] = location
+    else:
+        try:
+            resp = FileResponse(open(path, 'rb'))
+        except (IOError, OSError):
+            # Removed since stat
+            return None
+        resp['Content-Length'] = stat.st_size
+
+    resp["Content-Type"] = EXTENSION_MAP[extension]["mime_type"]
+    resp['Last-Modified'] = http_date()
+    return resp
+
+
+def _crop_size_key(etag):
+    return "crop-size-{}".format(etag)
+
+
+def _head_response(image, path, extension, etag):
+    """Response headers for a HEAD request, without rendering.
+
+    Content-Length is included if known, from a fresh crop saved to disk or the cached size of an
+    earlier render.
+    """
+    resp = HttpResponse()
+    resp["Content-Type"] = EXTENSION_MAP[extension]["mime_type"]
+    resp['Last-Modified'] = http_date()
+
+    stat = _fresh_disk_crop_stat(image, path)
+    if stat is not None:
+        resp['Content-Length'] = stat.st_size
+    else:
+        size = cache.get(_crop_size_key(etag))
+        if size is not None:
+            resp['Content-Length'] = size
+    return resp
+
+
+def _rendered_response(image_blob, extension, etag):
+    # Remember size for later HEAD requests
+    cache.set(_crop_size_key(etag), len(image_blob), settings.BETTY_CACHE_CROP_SEC)
+    return _image_response(image_blob, extension=extension)
+
+
+def encoder_fingerprint():
+    """Global settings (and library version) that affect rendered crop bytes"""
+    return ':'.join(str(value) for value in [PILLOW_VERSION,
+                                             settings.BETTY_DEFAULT_JPEG_QUALITY,
+                                             settings.BETTY_DEFAULT_WEBP_QUALITY,
+                                             settings.BETTY_DEFAULT_AVIF_QUALITY,
+                                             settings.BETTY_JPEG_DRAFT_DECODE,
+                                             settings.BETTY_CROP_FROM_RENDITION_MIN_OVERSAMPLE])
+
+
+def crop_etag(version, ratio_slug, width, extension):
+    """Entity tag for a crop, computed without loading or rendering the image.
+
+    ``version`` (see ``Image.version``) changes whenever the image is saved, so covers the
+    resolved selection and per-width quality settings; ``encoder_fingerprint()`` covers the global
+    encoder settings. Strong unless crops may be resized from renditions on disk (see
+    ``quote_crop_etag``): otherwise crop bytes depend only on the URL, whether rendered on demand,
+    in a batch or pre-warmed to disk (see ``Image.crop_renditions``).
+    """
+    key = ':'.join([version, ratio_slug, str(width), extension, encoder_fingerprint()])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+
+
+def quote_crop_etag(etag):
+    """Crops resized from a (lossy) rendition on disk, with
+    ``settings.BETTY_CROP_FROM_RENDITION_MIN_OVERSAMPLE``, differ byte-for-byte from crops rendered
+    from the original, depending on which renditions are on disk. So the tag is then weak."""
+    if settings.BETTY_CROP_FROM_RENDITION_MIN_OVERSAMPLE:
+        return "W/" + quote_etag(etag)
+    return quote_etag(etag)
+
+
+def placeholder_etag(ratio_slug, width, extension):
+    """Entity tag for a placeholder crop, only usable for weak comparison since each placeholder
+    gets a random color"""
+    return crop_etag("placeholder", ratio_slug, width, extension)
+
+
+def _render_crop(image, ratio, width, extension):
+    if not settings.BETTY_CROP_COALESCE:
+        return image.crop(ratio, width, extension)
+
+    key = ':'.join(['crop',
+                    str(image.id),
+                    str(image.last_modified),
+                    ratio.string,
+                    str(width),
+                    extension]).replace(' ', '_')
+    return crop_flight.do(key,
+                          lambda: image.crop(ratio, width, extension),
+                          timeout=settings.BETTY_CROP_COALESCE_TIMEOUT,
+                          cache=cache if settings.BETTY_CROP_COALESCE == "cache" else None)
+
+
+def _negotiate_extension(request, extension):
+    """Optionally upgrade JPEG crops to WebP for clients that support it"""
+    if (extension == "jpg" and
+            settings.BETTY_WEBP_NEGOTIATION and
+            "webp" in CROP_EXTENSIONS and
+            "image/webp" in request.META.get("HTTP_ACCEPT", "")):
+        return "webp"
+    return extension
+
+
 def crop(request, id, ratio_slug, width, extension):
     if ratio_slug != "original" and ratio_slug not in settings.BETTY_RATIOS:
         raise Http404
 
+    if extension not in CROP_EXTENSIONS:
+        # Format not supported by this Pillow build
+        raise Http404
+
+    negotiate = extension == "jpg" and settings.BETTY_WEBP_NEGOTIATION
+    extension = _negotiate_extension(request, extension)
+
     try:
         ratio = Ratio(ratio_slug)
     except ValueError:
@@ -103,31 +278,72 @@ def crop(request, id, ratio_slug, width, extension):
 
     image_id = int(id.replace("/", ""))
 
-    try:
-        image = Image.objects.get(id=image_id)
-    except Image.DoesNotExist:
-        if settings.BETTY_PLACEHOLDER:
-            img_blob = placeholder(ratio, width, extension)
-            resp = HttpResponse(img_blob)
-            resp["Cache-Control"] = "no-cache, no-store, must-revalidate"
-            resp["Pragma"] = "no-cache"
-            resp["Expires"] = "0"
-            resp["Content-Type"] = EXTENSION_MAP[extension]["mime_type"]
-            return resp
-        else:
-            raise Http404
-
-    if check_not_modified(request=request, last_modified=image.last_modified):
-        # Avoid hitting storage backend on cache update
-        resp = HttpResponseNotModified()
-    else:
+    resp = None
+    render_sec = None
+    # Plain requests skip the stamp, saving a cache round-trip
+    conditional = is_conditional(request)
+    stamp = Image.get_cached_stamp(image_id) if conditional else None
+    if stamp is not None:
+        # Fast path for revalidation, without loading the image
+        last_modified, version, _animated = stamp
+        etag = crop_etag(version, ratio.string, width, extension)
+        if check_not_modified(request=request, last_modified=last_modified, etag=etag):
+            resp = HttpResponseNotModified()
+
+    if resp is None:
         try:
-            image_blob = image.crop(ratio, width, extension)
-        except Exception:
-            logger.exception("Cropping error")
-            return HttpResponseServerError("Cropping error")
-
-        resp = _image_response(image_blob, extension=extension)
+            image = Image.objects.get_cached(image_id)
+        except Image.DoesNotExist:
+            if settings.BETTY_PLACEHOLDER:
+                etag = placeholder_etag(ratio.string, width, extension)
+                if check_not_modified(request=request, last_modified=None, etag=etag):
+                    resp = HttpResponseNotModified()
+                else:
+                    if request.method == "HEAD":
+                        resp = HttpResponse()
+                    else:
+                        resp = HttpResponse(placeholder(ratio, width, extension))
+                    resp["Content-Type"] = EXTENSION_MAP[extension]["mime_type"]
+                resp["Cache-Control"] = "no-cache, no-store, must-revalidate"
+                resp["Pragma"] = "no-cache"
+                resp["Expires"] = "0"
+                resp["ETag"] = "W/" + quote_etag(etag)
+                if negotiate:
+                    patch_vary_headers(resp, ["Accept"])
+                return resp
+            else:
+                raise Http404
+
+        if conditional and stamp is None:
+            image.cache_stamp(replace=False)
+
+        etag = crop_etag(image.version, ratio.string, width, extension)
+        if check_not_modified(request=request, last_modified=image.last_modified, etag=etag):
+            # Avoid hitting storage backend on cache update
+            resp = HttpResponseNotModified()
+        elif request.method == "HEAD":
+            resp = _head_response(image, image.get_crop_path(ratio.string, width, extension),
+                                  extension, etag)
+        else:
+            resp = _disk_crop_response(image,
+                                       image.get_crop_path(ratio.string, width, extension),
+                                       extension=extension)
+            if resp is None:
+                start = time.time()
+                try:
+                    image_blob = _render_crop(image, ratio, width, extension)
+                except Exception:
+                    logger.exception("Cropping error")
+                    return HttpResponseServerError("Cropping error")
+                render_sec = time.time() - start
+
+                resp = _rendered_response(image_blob, extension, etag)
+
+    resp['ETag'] = quote_crop_etag(etag)
+
+    if request.method == "GET" and resp.status_code == 200:
+        # Not HEAD or 304 revalidations, which send no image
+        crop_stats.record(image_id, ratio.string, width, extension, render_sec=render_sec)
 
     # Optionally specify alternate cache duration for non-breakpoint widths.
     # This is useful b/c cache flush callback only receives paths for known breakpoints, so this
@@ -138,6 +354,8 @@ def crop(request, id, ratio_slug, width, extension):
         if width not in (settings.BETTY_WIDTHS + settings.BETTY_CLIENT_ONLY_WIDTHS):
             max_age = settings.BETTY_CACHE_CROP_NON_BREAKPOINT_SEC
     patch_cache_control(resp, max_age=max_age)
+    if negotiate:
+        patch_vary_headers(resp, ["Accept"])
     return resp
 
 
@@ -147,25 +365,47 @@ def animated(request, id, extension):
 
     image_id = int(id.replace("/", ""))
 
+    conditional = is_conditional(request)
+    stamp = Image.get_cached_stamp(image_id) if conditional else None
+    if stamp is not None:
+        # Fast path for revalidation, without loading the image
+        last_modified, version, is_animated = stamp
+        etag = crop_etag(version, "animated", "original", extension)
+        if is_animated and check_not_modified(request=request, last_modified=last_modified,
+                                              etag=etag):
+            resp = HttpResponseNotModified()
+            resp['ETag'] = quote_etag(etag)
+            patch_cache_control(resp, max_age=settings.BETTY_CACHE_CROP_SEC)
+            return resp
+
     try:
-        image = Image.objects.get(id=image_id)
+        image = Image.objects.get_cached(image_id)
     except Image.DoesNotExist:
         raise Http404
 
     if not image.animated:
         raise Http404
 
-    if check_not_modified(request=request, last_modified=image.last_modified):
+    if conditional and stamp is None:
+        image.cache_stamp(replace=False)
+
+    etag = crop_etag(image.version, "animated", "original", extension)
+    if check_not_modified(request=request, last_modified=image.last_modified, etag=etag):
         # Avoid hitting storage backend on cache update
         resp = HttpResponseNotModified()
+    elif request.method == "HEAD":
+        resp = _head_response(image, image.get_animated_path(extension), extension, etag)
     else:
-        try:
-            image_blob = image.get_animated(extension=extension)
-        except Exception:
-            logger.exception("Animated error")
-            return HttpResponseServerError("Animated error")
+        resp = _disk_crop_response(image, image.get_animated_path(extension), extension=extension)
+        if resp is None:
+            try:
+                image_blob = image.get_animated(extension=extension)
+            except Exception:
+                logger.exception("Animated error")
+                return HttpResponseServerError("Animated error")
 
-        resp = _image_response(image_blob, extension=extension)
+            resp = _rendered_response(image_blob, extension, etag)
 
+    resp['ETag'] = quote_etag(etag)
     patch_cache_control(resp, max_age=settings.BETTY_CACHE_CROP_SEC)
     return resp
@@ -0,0 +1,101 @@
+import os
+import threading
+
+from six.moves import queue
+
+from betty.conf.app import settings
+from betty.cropper.utils import write_file_atomic
+
+logger = __import__('logging').getLogger(__name__)
+
+
+class CropWriter(object):
+    """Saves rendered crops to disk, optionally from a pool of background threads so that disk
+    latency stays out of the request.
+
+    Background writes are enabled via ``settings.BETTY_CROP_WRITER_THREADS``. At most
+    ``settings.BETTY_CROP_WRITER_MAX_QUEUE`` writes may be pending, past which new writes are
+    dropped (the crop is simply re-rendered on a later request) rather than blocking the response.
+
+    Threads are started lazily, and restarted after a fork.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue = None
+        self._pid = None
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def _get_queue(self):
+        with self._lock:
+            if self._queue is None or self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=settings.BETTY_CROP_WRITER_MAX_QUEUE)
+                self._pid = os.getpid()
+                for _ in range(settings.BETTY_CROP_WRITER_THREADS):
+                    thread = threading.Thread(target=self._run, args=(self._queue,),
+                                              name='betty-crop-writer')
+                    thread.daemon = True
+                    thread.start()
+            return self._queue
+
+    def _write(self, image_data, path, mtime):
+        try:
+            write_file_atomic(path, image_data, mtime=mtime)
+        except Exception:
+            logger.exception('Error saving crop "%s"', path)
+            with self._lock:
+                self.errors += 1
+            return False
+        with self._lock:
+            self.written += 1
+        return True
+
+    def _run(self, write_queue):
+        while True:
+            image_data, path, mtime = write_queue.get()
+            try:
+                self._write(image_data, path, mtime)
+            finally:
+                write_queue.task_done()
+
+    def write(self, image_data, path, mtime=None):
+        """Saves a crop to disk, or queues it to be saved in the background.
+
+        Returns False if the write was dropped (or failed, if synchronous).
+        """
+        if not settings.BETTY_CROP_WRITER_THREADS:
+            return self._write(image_data, path, mtime)
+
+        try:
+            self._get_queue().put_nowait((image_data, path, mtime))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+        return True
+
+    def join(self):
+        """Blocks until all queued writes are done"""
+        if self._queue is not None:
+            self._queue.join()
+
+    def stats(self):
+        return {
+            "threads": settings.BETTY_CROP_WRITER_THREADS,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "max_queue": settings.BETTY_CROP_WRITER_MAX_QUEUE,
+            "written": self.written,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
+
+    def reset(self):
+        with self._lock:
+            self.written = 0
+            self.dropped = 0
+            self.errors = 0
+
+
+crop_writer = CropWriter()
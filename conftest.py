@@ -23,4 +23,13 @@ def clean_image_root(request):
 def clear_cache(request):
     """Clear test cache between runs"""
     from django.core.cache import cache
+    from betty.cropper.cache import decoded_image_cache, source_cache
+    from betty.cropper.popularity import crop_stats
+    from betty.cropper.views import crop_flight
+    from betty.cropper.writer import crop_writer
     cache.clear()
+    decoded_image_cache.clear()
+    source_cache.reset()
+    crop_flight.reset()
+    crop_writer.reset()
+    crop_stats.reset()
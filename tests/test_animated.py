@@ -1,6 +1,7 @@
 import os
 
 from freezegun import freeze_time
+from mock import patch
 import pytest
 
 from django.core.files import File
@@ -84,3 +85,29 @@ def test_if_modified_since(settings, client, image):
     assert res.status_code == 304
     assert res['Cache-Control'] == 'max-age=600'
     assert not res.content  # Empty content
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_animated_not_modified_fast_path(client, image):
+    url = '/images/{}/animated/original.gif'.format(image.id)
+    with patch.object(Image, 'get_cached_stamp') as mock_get_stamp:
+        res = client.get(url)
+        assert res.status_code == 200
+        assert not mock_get_stamp.called
+
+    with patch.object(Image.objects, 'get_cached') as mock_get:
+        res = client.get(url, HTTP_IF_NONE_MATCH=res['ETag'])
+        assert res.status_code == 304
+        assert not mock_get.called
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_animated_head(client, image):
+    url = '/images/{}/animated/original.gif'.format(image.id)
+    with patch.object(Image, 'get_animated') as mock_get_animated:
+        res = client.head(url)
+        assert res.status_code == 200
+        assert res['Content-Type'] == 'image/gif'
+        assert not mock_get_animated.called
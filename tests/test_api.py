@@ -1,7 +1,11 @@
+import io
 import os
 import json
+import zipfile
 
+from django.core.files import File
 from mock import call, patch
+from PIL import Image as PILImage
 import pytest
 
 from betty.cropper.models import Image
@@ -260,3 +264,113 @@ def test_bad_image_data(admin_client):
         id_string += char
     res = admin_client.get('/images/{0}/1x1/400.jpg'.format(id_string))
     assert res.status_code == 200
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_stats(admin_client):
+    image = Image.objects.create(name="Testing", width=512, height=512)
+    with open(os.path.join(TEST_DATA_PATH, 'Lenna.png'), "rb") as lenna:
+        image.source.save('Lenna.png', File(lenna))
+
+    for _ in range(2):
+        assert admin_client.get('/images/{}/1x1/100.jpg'.format(image.id)).status_code == 200
+
+    res = admin_client.get('/images/api/stats')
+    assert res.status_code == 200
+    data = json.loads(res.content.decode("utf-8"))
+    assert data['decoded_image_cache']['misses'] == 1
+    assert data['decoded_image_cache']['hits'] == 1
+    assert data['crop_coalesce']['leaders'] == 2
+    assert data['source_cache']['storage']['hits'] == 1
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_batch_crops(admin_client):
+    image_id = create_test_image(admin_client)['id']
+
+    crops = [
+        {"id": image_id, "ratio": "1x1", "width": 100, "format": "jpg"},
+        {"id": image_id, "ratio": "1x1", "width": 200, "format": "jpg"},
+        {"id": image_id, "ratio": "16x9", "width": 160, "format": "png"},
+        {"id": image_id, "ratio": "original", "width": 50},
+    ]
+    with patch.object(Image, 'read_best_bytes', autospec=True,
+                      side_effect=Image.read_best_bytes) as mock_read:
+        res = admin_client.post('/images/api/crops',
+                                data=json.dumps({"crops": crops}),
+                                content_type="application/json")
+        # First image/ratio/format rendered up front
+        assert mock_read.call_count == 1
+        assert res.status_code == 200
+        assert res['Content-Type'] == 'application/zip'
+        # Streamed, rendering as it goes
+        content = b''.join(res.streaming_content)
+    # One storage read + decode per draft scale (1/2, 1/4 and 1/8)
+    assert mock_read.call_count == 3
+
+    archive = zipfile.ZipFile(io.BytesIO(content))
+    expected = {
+        '{}/1x1/100.jpg'.format(image_id): ('JPEG', (100, 100)),
+        '{}/1x1/200.jpg'.format(image_id): ('JPEG', (200, 200)),
+        '{}/16x9/160.png'.format(image_id): ('PNG', (160, 90)),
+        '{}/original/50.jpg'.format(image_id): ('JPEG', (50, 50)),
+    }
+    assert sorted(archive.namelist()) == sorted(expected)
+    for name, (format, size) in expected.items():
+        img = PILImage.open(io.BytesIO(archive.read(name)))
+        assert (img.format, img.size) == (format, size)
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_batch_crops_errors(admin_client, settings):
+    image_id = create_test_image(admin_client)['id']
+
+    def post(data):
+        return admin_client.post('/images/api/crops', data=data,
+                                 content_type="application/json")
+
+    assert post('not json').status_code == 400
+    assert post(json.dumps({"crops": [{"id": image_id}]})).status_code == 400
+    assert post(json.dumps({"crops": [{"id": image_id, "ratio": "5x1",
+                                       "width": 100}]})).status_code == 400
+    assert post(json.dumps({"crops": [{"id": image_id, "ratio": "1x1",
+                                       "width": 0}]})).status_code == 400
+    assert post(json.dumps({"crops": [{"id": image_id, "ratio": "1x1", "width": 100,
+                                       "format": "gif"}]})).status_code == 400
+
+    res = post(json.dumps({"crops": [{"id": 1000001, "ratio": "1x1", "width": 100}]}))
+    assert res.status_code == 404
+    assert json.loads(res.content.decode("utf-8"))["ids"] == [1000001]
+
+    settings.BETTY_BATCH_CROP_MAX = 1
+    crop = {"id": image_id, "ratio": "1x1", "width": 100}
+    assert post(json.dumps({"crops": [crop, crop]})).status_code == 400
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_batch_crops_cropping_error(admin_client):
+    image_id = create_test_image(admin_client)['id']
+
+    with patch.object(Image, 'crop_renditions', side_effect=IOError):
+        res = admin_client.post('/images/api/crops',
+                                data=json.dumps({"crops": [{"id": image_id, "ratio": "1x1",
+                                                            "width": 100}]}),
+                                content_type="application/json")
+    assert res.status_code == 500
+    assert json.loads(res.content.decode("utf-8"))["id"] == image_id
+
+    res = admin_client.post('/images/api/crops', data=json.dumps({"crops": []}),
+                            content_type="application/json")
+    assert res.status_code == 200
+    archive = zipfile.ZipFile(io.BytesIO(b''.join(res.streaming_content)))
+    assert archive.namelist() == []
+
+
+def test_batch_crops_auth(client):
+    res = client.post('/images/api/crops', data='{"crops": []}',
+                      content_type="application/json")
+    assert res.status_code == 403
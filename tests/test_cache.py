@@ -0,0 +1,251 @@
+import os
+import shutil
+import tempfile
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db.models.fields.files import FieldFile
+from freezegun import freeze_time
+from mock import patch
+from PIL import Image as PILImage
+import pytest
+
+from betty.cropper.cache import (DecodedImageCache,
+                                 LocalDiskTier,
+                                 MappedBuffer,
+                                 SharedCacheTier,
+                                 buffer_size,
+                                 image_nbytes,
+                                 source_cache)
+from betty.cropper.models import Image
+
+
+def make_image(width, height, mode="RGB"):
+    return PILImage.new(mode, (width, height))
+
+
+def test_image_nbytes():
+    assert image_nbytes(make_image(10, 10)) == 300
+    assert image_nbytes(make_image(10, 10, mode="L")) == 100
+    assert image_nbytes(make_image(10, 10, mode="RGBA")) == 400
+
+
+def test_decoded_image_cache_hit_miss():
+    cache = DecodedImageCache(max_bytes=1000)
+    img = make_image(10, 10)
+
+    assert cache.get("a") is None
+    assert cache.set("a", img)
+    assert cache.get("a") is img
+
+    assert cache.stats() == {
+        "entries": 1,
+        "bytes": 300,
+        "max_bytes": 1000,
+        "hits": 1,
+        "misses": 1,
+        "evictions": 0,
+    }
+
+
+def test_decoded_image_cache_lru_eviction():
+    cache = DecodedImageCache(max_bytes=700)
+    cache.set("a", make_image(10, 10))
+    cache.set("b", make_image(10, 10))
+
+    # Touch "a" so "b" is least recently used
+    assert cache.get("a") is not None
+    cache.set("c", make_image(10, 10))
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+    assert cache.current_bytes == 600
+    assert cache.evictions == 1
+
+
+def test_decoded_image_cache_too_large():
+    cache = DecodedImageCache(max_bytes=100)
+    assert not cache.set("a", make_image(10, 10))
+    assert len(cache) == 0
+
+
+def test_decoded_image_cache_disabled(settings):
+    settings.BETTY_DECODED_IMAGE_CACHE_BYTES = 0
+    cache = DecodedImageCache()
+    assert not cache.set("a", make_image(1, 1))
+    assert cache.get("a") is None
+
+
+def test_decoded_image_cache_clear():
+    cache = DecodedImageCache(max_bytes=1000)
+    cache.set("a", make_image(10, 10))
+    cache.get("a")
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.stats()["hits"] == 0
+    assert cache.current_bytes == 0
+
+
+@pytest.fixture()
+def source_cache_root(request, settings):
+    root = tempfile.mkdtemp("bettysourcecache")
+    request.addfinalizer(lambda: shutil.rmtree(root, ignore_errors=True))
+    settings.BETTY_SOURCE_CACHE_DISK_ROOT = root
+    settings.BETTY_SOURCE_CACHE_DISK_BYTES = 1000
+    return root
+
+
+def test_shared_cache_tier_chunking(settings):
+    settings.BETTY_CACHE_STORAGE_CHUNK_BYTES = 10
+    tier = SharedCacheTier()
+    data = bytes(bytearray(range(25)))
+
+    tier.set("storage:big", data)
+    manifest = cache.get("storage:big")
+    assert manifest["chunks"] == 3
+    assert manifest["length"] == 25
+    assert tier.get("storage:big") == data
+
+    # Small values are stored as-is
+    tier.set("storage:small", b"abc")
+    assert cache.get("storage:small") == b"abc"
+    assert tier.get("storage:small") == b"abc"
+
+
+def test_shared_cache_tier_missing_chunk(settings):
+    settings.BETTY_CACHE_STORAGE_CHUNK_BYTES = 10
+    tier = SharedCacheTier()
+    tier.set("storage:big", b"x" * 25)
+
+    manifest = cache.get("storage:big")
+    cache.delete("storage:big:{}:1".format(manifest["token"]))
+    assert tier.get("storage:big") is None
+
+
+def test_local_disk_tier_lru_eviction(source_cache_root):
+    tier = LocalDiskTier(source_cache_root, max_bytes=250)
+    tier.set("a", b"a" * 100)
+    tier.set("b", b"b" * 100)
+
+    # Touch "a" so "b" is least recently used
+    assert tier.get("a") == b"a" * 100
+    tier.set("c", b"c" * 100)
+
+    assert tier.get("b") is None
+    assert not os.path.exists(tier.path("b"))
+    assert tier.get("a") == b"a" * 100
+    assert tier.get("c") == b"c" * 100
+    assert tier.current_bytes == 200
+
+    # No temporary files left behind
+    for dirpath, _dirnames, filenames in os.walk(source_cache_root):
+        assert not [f for f in filenames if f.startswith(".tmp")]
+
+    # Fresh index (ex: new process) picks up existing files
+    tier = LocalDiskTier(source_cache_root, max_bytes=250)
+    tier.set("d", b"d" * 100)
+    assert tier.current_bytes == 200
+
+
+def test_local_disk_tier_expiration(source_cache_root, settings):
+    settings.BETTY_CACHE_STORAGE_SEC = 3600
+    tier = LocalDiskTier(source_cache_root, max_bytes=1000)
+    with freeze_time('2016-07-06 00:00'):
+        tier.set("a", b"abc")
+        assert tier.get("a") == b"abc"
+    with freeze_time('2016-07-06 01:01'):
+        assert tier.get("a") is None
+        assert not os.path.exists(tier.path("a"))
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root", "clear_cache")
+def test_source_cache_tiers(source_cache_root, settings):
+    settings.BETTY_CACHE_STORAGE_CHUNK_BYTES = 1000 * 1000
+    settings.BETTY_MMAP_LOCAL_STORAGE = False
+    image = Image.objects.create(name="Testing", width=512, height=512)
+    image.source.save('Lenna.png', ContentFile(b"x" * 300))
+
+    with patch.object(FieldFile, 'read') as mock_read:
+        mock_read.side_effect = lambda: b"x" * 300
+        # Storage read fills both tiers
+        assert source_cache.open(image.source).getvalue() == b"x" * 300
+        assert mock_read.call_count == 1
+        assert cache.get("storage:" + image.source.name) == b"x" * 300
+
+        # Disk tier hit (memory-mapped)
+        assert isinstance(source_cache.open(image.source), MappedBuffer)
+        assert source_cache.open(image.source).getvalue() == b"x" * 300
+
+        # Shared tier hit refills disk tier
+        source_cache.tiers[0].delete("storage:" + image.source.name)
+        assert source_cache.open(image.source).getvalue() == b"x" * 300
+        assert source_cache.open(image.source).getvalue() == b"x" * 300
+        assert mock_read.call_count == 1
+
+    stats = source_cache.stats()
+    assert stats["disk"]["hits"] == 3
+    assert stats["disk"]["misses"] == 2
+    assert stats["disk"]["hit_ratio"] == 0.6
+    assert stats["disk"]["bytes"] == 900
+    assert stats["disk"]["entries"] == 1
+    assert stats["shared"]["hits"] == 1
+    assert stats["shared"]["misses"] == 1
+    assert stats["storage"]["hits"] == 1
+    assert stats["storage"]["bytes"] == 300
+
+    # Deleting image removes cached copies
+    name = image.source.name
+    image.delete()
+    assert cache.get("storage:" + name) is None
+    assert not os.path.exists(source_cache.tiers[0].path("storage:" + name))
+
+
+def test_mapped_buffer(tmpdir):
+    path = str(tmpdir.join("data"))
+    with open(path, "wb") as f:
+        f.write(b"0123456789")
+
+    with open(path, "rb") as f:
+        buf = MappedBuffer.from_file(f)
+    assert len(buf) == 10
+    assert buf.read(3) == b"012"
+    assert buf.tell() == 3
+    assert buf.seek(-2, os.SEEK_END) == 8
+    assert buf.read() == b"89"
+    assert buf.read() == b""
+    buf.seek(0)
+    assert buf.getvalue() == b"0123456789"
+    assert buffer_size(buf) == 10
+    assert buf.tell() == 0
+
+    # Empty files can't be mapped
+    with open(path, "wb"):
+        pass
+    with open(path, "rb") as f:
+        assert MappedBuffer.from_file(f) is None
+
+
+def test_mapped_buffer_decode():
+    path = os.path.join(os.path.dirname(__file__), 'images', 'Lenna.png')
+    with open(path, "rb") as f:
+        buf = MappedBuffer.from_file(f)
+    img = PILImage.open(buf)
+    img.load()
+    assert img.size == (512, 512)
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root", "clear_cache")
+def test_source_cache_mmap_local_storage(settings):
+    settings.BETTY_MMAP_LOCAL_STORAGE = True
+    image = Image.objects.create(name="Testing", width=512, height=512)
+    image.source.save('Lenna.png', ContentFile(b"x" * 300))
+
+    buf = image.read_source_bytes()
+    assert isinstance(buf, MappedBuffer)
+    assert buf.getvalue() == b"x" * 300
+    # Not copied into caches
+    assert cache.get("storage:" + image.source.name) is None
+    assert source_cache.stats()["storage"]["bytes"] == 300
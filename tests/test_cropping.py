@@ -6,9 +6,13 @@ from PIL import Image as PILImage
 import pytest
 
 from django.core.files import File
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 from betty.conf.app import settings
+from betty.cropper.cache import decoded_image_cache
 from betty.cropper.models import Image, Ratio
+from betty.cropper.tasks import render_renditions
 
 from mock import patch
 
@@ -303,3 +307,445 @@ def test_if_modified_since(settings, client, image):
     assert res.status_code == 304
     assert res['Cache-Control'] == 'max-age=600'
     assert not res.content  # Empty content
+
+
+def response_content(res):
+    if res.streaming:
+        return b''.join(res.streaming_content)
+    return res.content
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_serve_crop_from_disk(settings, client, image):
+    settings.BETTY_SAVE_CROPS_TO_DISK = True
+    settings.BETTY_SERVE_CROPS_FROM_DISK = True
+
+    res = client.get('/images/{}/1x1/240.jpg'.format(image.id))
+    assert res.status_code == 200
+    rendered = response_content(res)
+
+    with patch.object(Image, 'crop') as mock_crop:
+        res = client.get('/images/{}/1x1/240.jpg'.format(image.id))
+        assert res.status_code == 200
+        assert res['Content-Type'] == 'image/jpeg'
+        assert int(res['Content-Length']) == len(rendered)
+        assert response_content(res) == rendered
+        assert not mock_crop.called
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_serve_crop_from_disk_stale(settings, client, image):
+    settings.BETTY_SAVE_CROPS_TO_DISK = True
+
+    res = client.get('/images/{}/1x1/240.jpg'.format(image.id))
+    assert res.status_code == 200
+
+    # Image modified after crop was saved
+    with freeze_time('2100-01-01'):
+        image.save()
+
+    with patch.object(Image, 'crop', return_value=b'rerendered') as mock_crop:
+        res = client.get('/images/{}/1x1/240.jpg'.format(image.id))
+        assert res.status_code == 200
+        assert response_content(res) == b'rerendered'
+        assert mock_crop.called
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_serve_crop_from_disk_disabled(settings, client, image):
+    settings.BETTY_SAVE_CROPS_TO_DISK = True
+    settings.BETTY_SERVE_CROPS_FROM_DISK = False
+
+    client.get('/images/{}/1x1/240.jpg'.format(image.id))
+
+    with patch.object(Image, 'crop', return_value=b'rerendered') as mock_crop:
+        res = client.get('/images/{}/1x1/240.jpg'.format(image.id))
+        assert response_content(res) == b'rerendered'
+        assert mock_crop.called
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_serve_crop_from_disk_sendfile(settings, client, image):
+    settings.BETTY_SAVE_CROPS_TO_DISK = True
+
+    client.get('/images/{}/1x1/240.jpg'.format(image.id))
+    path = image.get_crop_path('1x1', 240, 'jpg')
+
+    settings.BETTY_SENDFILE_HEADER = 'X-Sendfile'
+    res = client.get('/images/{}/1x1/240.jpg'.format(image.id))
+    assert res.status_code == 200
+    assert res['X-Sendfile'] == path
+    assert not res.content
+
+    settings.BETTY_SENDFILE_HEADER = 'X-Accel-Redirect'
+    settings.BETTY_SENDFILE_PREFIX = '/crops/'
+    res = client.get('/images/{}/1x1/240.jpg'.format(image.id))
+    assert res.status_code == 200
+    assert res['Content-Type'] == 'image/jpeg'
+    assert res['X-Accel-Redirect'] == '/crops/{}/1x1/240.jpg'.format(image.id)
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_webp_crop(client, image):
+    res = client.get('/images/{}/1x1/240.webp'.format(image.id))
+    assert res.status_code == 200
+    assert res['Content-Type'] == 'image/webp'
+    img = PILImage.open(io.BytesIO(res.content))
+    assert img.format == 'WEBP'
+    assert img.size == (240, 240)
+    assert os.path.exists(os.path.join(image.path(), '1x1', '240.webp'))
+
+
+@pytest.mark.django_db
+def test_webp_quality(settings, image):
+    settings.BETTY_DEFAULT_WEBP_QUALITY = 75
+    settings.BETTY_DEFAULT_AVIF_QUALITY = 55
+    image.jpeg_quality_settings = {"240": 92}
+    assert image.get_encoder_kwargs(240, "jpg") == {"format": "jpeg", "quality": 92}
+    # JPEG quality search results aren't on the same scale
+    assert image.get_encoder_kwargs(240, "webp") == {"format": "webp", "quality": 75}
+    assert image.get_encoder_kwargs(240, "avif") == {"format": "avif", "quality": 55}
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_webp_negotiation(settings, client, image):
+    settings.BETTY_SAVE_CROPS_TO_DISK = False
+    settings.BETTY_WEBP_NEGOTIATION = True
+
+    res = client.get('/images/{}/1x1/240.jpg'.format(image.id),
+                     HTTP_ACCEPT='image/webp,image/*,*/*;q=0.8')
+    assert res.status_code == 200
+    assert res['Content-Type'] == 'image/webp'
+    assert res['Vary'] == 'Accept'
+
+    res = client.get('/images/{}/1x1/240.jpg'.format(image.id), HTTP_ACCEPT='image/*')
+    assert res.status_code == 200
+    assert res['Content-Type'] == 'image/jpeg'
+    assert res['Vary'] == 'Accept'
+
+    # Explicit extensions are never negotiated
+    res = client.get('/images/{}/1x1/240.png'.format(image.id), HTTP_ACCEPT='image/webp')
+    assert res['Content-Type'] == 'image/png'
+    assert not res.has_header('Vary')
+
+    settings.BETTY_WEBP_NEGOTIATION = False
+    res = client.get('/images/{}/1x1/240.jpg'.format(image.id), HTTP_ACCEPT='image/webp')
+    assert res['Content-Type'] == 'image/jpeg'
+    assert not res.has_header('Vary')
+
+
+@pytest.mark.django_db
+def test_unsupported_extension(client, image):
+    with patch('betty.cropper.views.CROP_EXTENSIONS', ['jpg', 'png']):
+        res = client.get('/images/{}/1x1/240.avif'.format(image.id))
+        assert res.status_code == 404
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_crop_no_database_queries(settings, client, image):
+    settings.BETTY_SAVE_CROPS_TO_DISK = False
+    with CaptureQueriesContext(connection) as queries:
+        res = client.get('/images/{}/1x1/200.jpg'.format(image.id))
+    assert res.status_code == 200
+    assert len(queries) == 0
+
+    image_id = image.id
+    image.delete()
+    assert client.get('/images/{}/1x1/200.jpg'.format(image_id)).status_code == 404
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_not_modified_fast_path(settings, client, image):
+    settings.BETTY_CACHE_CROP_SEC = 600
+    url = '/images/{}/1x1/300.jpg'.format(image.id)
+
+    with patch.object(Image, 'get_cached_stamp') as mock_get_stamp:
+        res = client.get(url)
+        assert res.status_code == 200
+        # Stamp only read for conditional requests
+        assert not mock_get_stamp.called
+    etag = res['ETag']
+
+    with CaptureQueriesContext(connection) as queries:
+        with patch.object(Image.objects, 'get_cached') as mock_get:
+            res = client.get(url, HTTP_IF_NONE_MATCH=etag)
+            assert res.status_code == 304
+            assert res['ETag'] == etag
+            assert res['Cache-Control'] == 'max-age=600'
+
+            res = client.get(url, HTTP_IF_MODIFIED_SINCE="Sat, 01 May 2100 00:00:00 GMT")
+            assert res.status_code == 304
+            assert not mock_get.called
+    assert len(queries) == 0
+
+    # ETag differs per crop
+    res = client.get('/images/{}/1x1/400.jpg'.format(image.id), HTTP_IF_NONE_MATCH=etag)
+    assert res.status_code == 200
+    assert res['ETag'] != etag
+
+    # If-None-Match takes precedence
+    res = client.get(url, HTTP_IF_NONE_MATCH='"other"',
+                     HTTP_IF_MODIFIED_SINCE="Sat, 01 May 2100 00:00:00 GMT")
+    assert res.status_code == 200
+
+    # Saving changes the version
+    with freeze_time('2100-06-01'):
+        image.selections = {"1x1": {"x0": 0, "y0": 0, "x1": 200, "y1": 200}}
+        image.save()
+    res = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert res.status_code == 200
+    assert res['ETag'] != etag
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_not_modified_stamp_cleared(client, image):
+    url = '/images/{}/1x1/300.jpg'.format(image.id)
+    assert client.get(url).status_code == 200
+    assert Image.get_cached_stamp(image.id) == image.get_stamp()
+
+    image.clear_crops()
+    assert Image.get_cached_stamp(image.id) is None
+
+    # Refilled on next (full) request
+    res = client.get(url, HTTP_IF_MODIFIED_SINCE="Sat, 01 May 2100 00:00:00 GMT")
+    assert res.status_code == 304
+    assert Image.get_cached_stamp(image.id) == image.get_stamp()
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_etag(settings, client, image):
+    settings.BETTY_SAVE_CROPS_TO_DISK = False
+    url = '/images/{}/1x1/300.jpg'.format(image.id)
+    res = client.get(url)
+    etag = res['ETag']
+    assert not etag.startswith('W/')
+
+    # Deterministic
+    assert client.get(url)['ETag'] == etag
+
+    # Checked before rendering, even without cached stamp
+    image.clear_crops()
+    with patch.object(Image, 'crop') as mock_crop:
+        res = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert res.status_code == 304
+        assert not mock_crop.called
+
+    # Encoder settings are part of the tag
+    settings.BETTY_DEFAULT_JPEG_QUALITY = 50
+    res = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert res.status_code == 200
+    assert res['ETag'] != etag
+
+    # Format too
+    assert client.get('/images/{}/1x1/300.png'.format(image.id))['ETag'] != res['ETag']
+
+
+@pytest.mark.django_db
+def test_placeholder_etag(settings, client):
+    settings.BETTY_PLACEHOLDER = True
+    with patch('betty.cropper.views.placeholder', return_value=b'image') as mock_placeholder:
+        res = client.get('/images/666/1x1/256.jpg')
+        assert res.status_code == 200
+        assert res['ETag'].startswith('W/"')
+
+        res = client.get('/images/666/1x1/256.jpg', HTTP_IF_NONE_MATCH=res['ETag'])
+        assert res.status_code == 304
+        assert res['Cache-Control'] == "no-cache, no-store, must-revalidate"
+        assert mock_placeholder.call_count == 1
+
+        # Negotiated placeholders vary too
+        settings.BETTY_WEBP_NEGOTIATION = True
+        res = client.get('/images/666/1x1/256.jpg', HTTP_ACCEPT='image/webp')
+        assert res['Content-Type'] == 'image/webp'
+        assert res['Vary'] == 'Accept'
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_head(settings, client, image):
+    settings.BETTY_SAVE_CROPS_TO_DISK = False
+    url = '/images/{}/1x1/300.jpg'.format(image.id)
+
+    with patch.object(Image, 'crop') as mock_crop:
+        res = client.head(url)
+        assert res.status_code == 200
+        assert res['Content-Type'] == 'image/jpeg'
+        assert res['ETag']
+        assert not res.has_header('Content-Length')
+        assert not res.content
+        assert not mock_crop.called
+
+    # Size known after rendering
+    content = client.get(url).content
+    with patch.object(Image, 'crop') as mock_crop:
+        res = client.head(url)
+        assert int(res['Content-Length']) == len(content)
+        assert not mock_crop.called
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_head_disk_crop(settings, client, image):
+    settings.BETTY_SAVE_CROPS_TO_DISK = True
+    url = '/images/{}/1x1/240.jpg'.format(image.id)
+    content = client.get(url).content
+
+    from django.core.cache import cache
+    cache.clear()
+    with patch.object(Image, 'crop') as mock_crop:
+        res = client.head(url)
+        assert res.status_code == 200
+        assert int(res['Content-Length']) == len(content)
+        assert not mock_crop.called
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_crop_saved_with_image_mtime(settings, client, image):
+    settings.BETTY_SAVE_CROPS_TO_DISK = True
+    with freeze_time('2016-05-02 01:02:03.5'):
+        image.save()
+    client.get('/images/{}/1x1/240.jpg'.format(image.id))
+
+    # A render of an older version finishing late still looks stale
+    path = image.get_crop_path('1x1', 240, 'jpg')
+    assert abs(os.stat(path).st_mtime - image.last_modified_timestamp()) < 0.001
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_crop_from_rendition(settings, client, image):
+    settings.BETTY_SAVE_CROPS_TO_DISK = True
+    settings.BETTY_CROP_FROM_RENDITION_MIN_OVERSAMPLE = 2
+    assert client.get('/images/{}/1x1/960.jpg'.format(image.id)).status_code == 200
+    assert image.find_rendition('1x1', 640, 'jpg') is None
+    assert image.find_rendition('1x1', 240, 'jpg') == (960, image.get_crop_path('1x1', 960, 'jpg'))
+    assert image.find_rendition('1x1', 240, 'png') is None
+
+    with patch.object(Image, 'read_best_image') as mock_read:
+        res = client.get('/images/{}/1x1/240.jpg'.format(image.id))
+        assert res.status_code == 200
+        assert not mock_read.called
+    assert PILImage.open(io.BytesIO(res.content)).size == (240, 240)
+
+    # Not enough oversampling
+    with patch.object(Image, 'read_best_image', wraps=image.read_best_image) as mock_read:
+        assert client.get('/images/{}/1x1/640.jpg'.format(image.id)).status_code == 200
+        assert mock_read.called
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_strong_etag_same_bytes(settings, client):
+    settings.BETTY_SAVE_CROPS_TO_DISK = True
+    settings.BETTY_JPEG_DRAFT_DECODE = True
+    settings.BETTY_DECODED_IMAGE_CACHE_BYTES = 64 * 1024 * 1024
+    settings.BETTY_WIDTHS = [1200, 820, 240]
+    image = Image.objects.create_from_path(os.path.join(TEST_DATA_PATH, 'Sam_Hat1.jpg'))
+    url = '/images/{}/16x9/240.jpg'.format(image.id)
+
+    def get_crop():
+        res = client.get(url)
+        assert res.status_code == 200
+        content = b''.join(res.streaming_content) if res.streaming else res.content
+        return res['ETag'], content
+
+    # Rendered on demand
+    decoded_image_cache.clear()
+    etag, content = get_crop()
+    assert not etag.startswith('W/')
+
+    # Rendered in a batch, then served from disk
+    image.clear_crops()
+    decoded_image_cache.clear()
+    render_renditions.apply(args=(image.id, '16x9', 'jpg'))
+    assert get_crop() == (etag, content)
+
+    # Rendered after a finer decode of the same image was cached
+    image.clear_crops()
+    decoded_image_cache.clear()
+    client.get('/images/{}/16x9/1200.jpg'.format(image.id))
+    image.clear_crops()
+    assert get_crop() == (etag, content)
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_crop_from_rendition_etag(settings, client, image):
+    settings.BETTY_SAVE_CROPS_TO_DISK = True
+    url = '/images/{}/1x1/240.jpg'.format(image.id)
+
+    # Strong tag: same bytes whenever rendered
+    res = client.get(url)
+    strong_etag, original_bytes = res['ETag'], res.content
+    assert not strong_etag.startswith('W/')
+    image.clear_crops()
+    client.get('/images/{}/1x1/960.jpg'.format(image.id))
+    res = client.get(url)
+    assert res['ETag'] == strong_etag
+    assert res.content == original_bytes
+
+    # Bytes depend on renditions on disk, so only weak
+    settings.BETTY_CROP_FROM_RENDITION_MIN_OVERSAMPLE = 2
+    image.clear_crops()
+    res = client.get(url)
+    weak_etag = res['ETag']
+    assert weak_etag.startswith('W/"')
+    assert res.content == original_bytes
+    image.clear_crops()
+    client.get('/images/{}/1x1/960.jpg'.format(image.id))
+    res = client.get(url)
+    assert res['ETag'] == weak_etag
+    assert res.content != original_bytes
+    assert client.get(url, HTTP_IF_NONE_MATCH=weak_etag).status_code == 304
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_crop_from_stale_rendition(settings, client, image):
+    settings.BETTY_SAVE_CROPS_TO_DISK = True
+    settings.BETTY_CROP_FROM_RENDITION_MIN_OVERSAMPLE = 2
+    client.get('/images/{}/1x1/960.jpg'.format(image.id))
+    path = image.get_crop_path('1x1', 960, 'jpg')
+    os.utime(path, (0, 0))
+    assert image.find_rendition('1x1', 240, 'jpg') is None
+
+    # Disabled by default
+    client.get('/images/{}/1x1/960.jpg'.format(image.id))
+    settings.BETTY_CROP_FROM_RENDITION_MIN_OVERSAMPLE = None
+    with patch.object(Image, 'read_best_image', wraps=image.read_best_image) as mock_read:
+        assert client.get('/images/{}/1x1/240.jpg'.format(image.id)).status_code == 200
+        assert mock_read.called
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_original_passthrough(settings, client):
+    settings.BETTY_SAVE_CROPS_TO_DISK = False
+    image = Image.objects.create_from_path(os.path.join(TEST_DATA_PATH, "Lenna.png"))
+    with open(image.optimized.path, "rb") as f:
+        optimized = f.read()
+
+    with patch.object(Image, 'read_best_image') as mock_read:
+        res = client.get('/images/{}/original/512.png'.format(image.id))
+        assert res.status_code == 200
+        assert res.content == optimized
+        assert not mock_read.called
+
+    # Needs pixel work: different format or width
+    assert client.get('/images/{}/original/512.jpg'.format(image.id)).content != optimized
+    assert client.get('/images/{}/original/500.png'.format(image.id)).content != optimized
+
+    # Per-width quality settings apply
+    image.jpeg_quality_settings = {"512": 70}
+    assert image.get_passthrough_bytes("png") is None
@@ -0,0 +1,176 @@
+import io
+import os
+
+import numpy as np
+from PIL import Image as PILImage
+import pytest
+import scipy.ndimage as scipy_ndimage
+
+from betty.cropper.dssim import (DISTORTION_TOLERANCE, ERROR_THRESHOLD, ReferenceImage,
+                                 _next_quality, _open_for_search, _quality_error,
+                                 _unique_colors_sort, color_density, compute_ssim, get_distortion,
+                                 search_optimal_quality, unique_colors)
+
+TEST_DATA_PATH = os.path.join(os.path.dirname(__file__), 'images')
+
+
+def reference_ssim(im1, im2, l=255):
+    """Original float64, 2-D convolve version"""
+    c_1 = (0.01 * l) ** 2
+    c_2 = (0.03 * l) ** 2
+    window = np.ones((8, 8)) / 64.0
+    im1 = im1.astype(np.float64)
+    im2 = im2.astype(np.float64)
+    mu_1 = scipy_ndimage.convolve(im1, window)
+    mu_2 = scipy_ndimage.convolve(im2, window)
+    sigma_1_sq = scipy_ndimage.convolve(im1 ** 2, window) - mu_1 ** 2
+    sigma_2_sq = scipy_ndimage.convolve(im2 ** 2, window) - mu_2 ** 2
+    sigma_12 = scipy_ndimage.convolve(im1 * im2, window) - mu_1 * mu_2
+    ssim_map = (((2 * mu_1 * mu_2 + c_1) * (2 * sigma_12 + c_2)) /
+                ((mu_1 ** 2 + mu_2 ** 2 + c_1) * (sigma_1_sq + sigma_2_sq + c_2)))
+    return np.mean(ssim_map)
+
+
+def reference_distortion(one, two):
+    ssims = [reference_ssim(one[:, :, channel], two[:, :, channel])
+             for channel in range(one.shape[2])]
+    return (1 / np.mean(ssims) - 1) * 20
+
+
+def load_pair(name, quality, width=320, mode="RGB"):
+    img = PILImage.open(os.path.join(TEST_DATA_PATH, name)).convert(mode)
+    img = img.resize((width, int(img.size[1] * width / float(img.size[0]))), PILImage.ANTIALIAS)
+    tmp = io.BytesIO()
+    img.save(tmp, format="jpeg", quality=quality)
+    tmp.seek(0)
+    return np.asarray(img), np.asarray(PILImage.open(tmp))
+
+
+@pytest.mark.parametrize("name", ["Lenna.png", "Simpsons-Week_a.jpg", "Sam_Hat1.jpg"])
+@pytest.mark.parametrize("quality", [60, 80, 92])
+def test_distortion_matches_reference(name, quality):
+    original, compressed = load_pair(name, quality)
+    expected = reference_distortion(original, compressed)
+    assert abs(get_distortion(original, compressed) - expected) < DISTORTION_TOLERANCE
+
+    # Reused reference statistics
+    reference = ReferenceImage(original)
+    assert abs(reference.distortion(compressed) - expected) < DISTORTION_TOLERANCE
+
+
+def test_ssim_grayscale():
+    original, compressed = load_pair("Sam_Hat1.jpg", 70, mode="L")
+    assert original.ndim == 2
+    assert abs(compute_ssim(original, compressed) -
+               reference_ssim(original, compressed)) < 1e-6
+
+
+def test_ssim_identical():
+    original, _ = load_pair("Lenna.png", 80)
+    assert abs(compute_ssim(original, original) - 1) < 1e-6
+    assert abs(get_distortion(original, original)) < DISTORTION_TOLERANCE
+
+
+def test_reference_image():
+    original, compressed = load_pair("Lenna.png", 60)
+    reference = ReferenceImage(original)
+    assert reference.unique_colors == unique_colors(original)
+    assert reference.color_density == color_density(original)
+    assert reference.density_ratio(compressed) == (
+        abs(color_density(compressed) - color_density(original)) / color_density(original))
+    assert reference.ssim(compressed) == compute_ssim(original, compressed)
+    assert reference.distortion(compressed) == get_distortion(original, compressed)
+
+    # Mismatched pair
+    with pytest.raises(ValueError):
+        reference.ssim(compressed[:-1])
+
+
+@pytest.mark.parametrize("mode", ["RGB", "L", "RGBA", "P"])
+def test_unique_colors(mode):
+    img = np.asarray(PILImage.open(os.path.join(TEST_DATA_PATH, "Lenna.png")).convert(mode))
+    assert unique_colors(img) == _unique_colors_sort(img)
+
+
+def test_unique_colors_synthetic():
+    img = np.zeros((4, 4, 3), dtype=np.uint8)
+    assert unique_colors(img) == 1
+    img[0, 0] = (255, 255, 255)
+    img[0, 1] = (0, 0, 1)
+    img[0, 2] = (1, 0, 0)
+    img[0, 3] = (1, 0, 0)
+    assert unique_colors(img) == 4
+
+    # Not 8-bit
+    assert unique_colors(img.astype(np.uint16) * 256) == 4
+
+
+def test_next_quality():
+    # Bisect without measurements
+    assert _next_quality(60, 92, None, None, [], False, 1) == 76
+    # Interpolate between measured bracket ends
+    assert _next_quality(60, 80, ERROR_THRESHOLD + 1, ERROR_THRESHOLD - 1, [], False, 1) == 70
+    # ...but always strictly inside the bracket
+    assert _next_quality(60, 80, ERROR_THRESHOLD + 0.01, ERROR_THRESHOLD - 10, [], False, 1) == 61
+    # Extrapolate through two probes on one side
+    probed = [(70, ERROR_THRESHOLD + 0.4), (72, ERROR_THRESHOLD + 0.2)]
+    assert _next_quality(72, 92, ERROR_THRESHOLD + 0.2, None, probed, False, 1) == 74
+    # Walk from a warm start
+    assert _next_quality(60, 85, None, ERROR_THRESHOLD - 0.1, [(85, 1)], True, 1) == 84
+    assert _next_quality(85, 92, ERROR_THRESHOLD + 0.1, None, [(85, 2)], True, 2) == 87
+
+
+def reference_bisection(data, width, quality_range):
+    """Plain bisection for the lowest quality within the error threshold, without early exit"""
+    pil_original, icc_profile = _open_for_search(io.BytesIO(data), width)
+    reference = ReferenceImage(np.asarray(pil_original))
+    qmin, qmax = quality_range
+    while qmax > qmin + 1:
+        quality = int(round((qmax + qmin) / 2.0))
+        if _quality_error(pil_original, reference, quality, icc_profile)[0] > ERROR_THRESHOLD:
+            qmin = quality
+        else:
+            qmax = quality
+    return qmax
+
+
+@pytest.mark.parametrize("name,width,quality_range", [
+    ("Sam_Hat1.jpg", 200, (50, 95)),
+    ("Sam_Hat1.jpg", 200, (60, 92)),
+    ("Sam_Hat1.jpg", 640, (60, 92)),
+    ("Header-Just_How.jpg", 200, (0, 100)),
+    ("Header-Just_How.jpg", 400, (50, 95)),
+    ("tumblr.jpg", 400, (70, 90)),
+    ("Lenna.png", 400, (0, 100)),
+])
+def test_search_optimal_quality_matches_bisection(name, width, quality_range):
+    with open(os.path.join(TEST_DATA_PATH, name), "rb") as f:
+        data = f.read()
+    expected = reference_bisection(data, width, quality_range)
+
+    quality, probes = search_optimal_quality(io.BytesIO(data), width, quality_range=quality_range)
+    assert quality == expected
+
+    # Warm started near, at and far from the result, or at the range bounds
+    for seed in set([expected - 2, expected, expected + 3] + list(quality_range)):
+        assert search_optimal_quality(io.BytesIO(data), width, quality_range=quality_range,
+                                      seed=seed)[0] == expected
+
+
+@pytest.mark.parametrize("name,width,seed", [
+    ("Sam_Hat1.jpg", 640, 87),
+    ("Sam_Hat1.jpg", 640, 60),
+    ("Simpsons-Week_a.jpg", 640, 92),
+])
+def test_search_optimal_quality_warm_start(settings, name, width, seed):
+    settings.BETTY_JPEG_QUALITY_RANGE = (60, 92)
+    with open(os.path.join(TEST_DATA_PATH, name), "rb") as f:
+        data = f.read()
+    quality, probes = search_optimal_quality(io.BytesIO(data), width)
+    assert quality == reference_bisection(data, width, (60, 92))
+    assert 60 < quality <= 92
+
+    warm_quality, warm_probes = search_optimal_quality(io.BytesIO(data), width, seed=seed)
+    assert warm_quality == quality
+    if abs(seed - quality) <= 1:
+        assert warm_probes < probes
@@ -0,0 +1,176 @@
+import os
+import time
+
+from django.core import management
+from django.core.management.base import CommandError
+from django.utils.six import StringIO
+from mock import patch
+import pytest
+
+from betty.cropper import eviction
+from betty.cropper.eviction import crop_hit_key, evict_crops, record_crop_hit, scan_shard
+from betty.cropper.utils import write_file_atomic
+
+
+def _make_file(root, relpath, size=100, atime=None):
+    path = os.path.join(root, relpath)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    if atime is not None:
+        os.utime(path, (atime, os.stat(path).st_mtime))
+    return path
+
+
+@pytest.fixture()
+def crop_root(settings, tmpdir):
+    root = str(tmpdir)
+    settings.BETTY_SAVE_CROPS_TO_DISK_ROOT = root
+    return root
+
+
+def test_scan_shard_only_crops(crop_root):
+    now = time.time()
+    crop = _make_file(crop_root, "1/1/original/240.jpg")
+    animated = _make_file(crop_root, "1/1/animated/original.gif")
+    _make_file(crop_root, "1/1/source.jpg")
+    _make_file(crop_root, "1/1/optimized.jpg")
+    _make_file(crop_root, "1/1/1x1/notes.txt")
+    stale_tmp = _make_file(crop_root, "1/1/1x1/.tmp-240.jpg-abc")
+    os.utime(stale_tmp, (now - 2 * 60 * 60, now - 2 * 60 * 60))
+    fresh_tmp = _make_file(crop_root, "1/1/1x1/.tmp-640.jpg-abc")
+
+    crops = scan_shard(os.path.join(crop_root, "1"), now=now)
+    assert sorted(c.path for c in crops) == sorted([animated, crop])
+    assert not os.path.exists(stale_tmp)
+    assert os.path.exists(fresh_tmp)
+
+
+def test_evict_by_atime(crop_root):
+    now = time.time()
+    oldest = _make_file(crop_root, "1/1/original/240.jpg", atime=now - 300)
+    older = _make_file(crop_root, "2/2/1x1/640.jpg", atime=now - 200)
+    newer = _make_file(crop_root, "3/3/16x9/820.png", atime=now - 100)
+    source = _make_file(crop_root, "1/1/source.jpg", size=1000)
+
+    # Under budget
+    stats = evict_crops(max_bytes=300)
+    assert stats["scanned_files"] == 3
+    assert stats["scanned_bytes"] == 300
+    assert stats["evicted_files"] == 0
+
+    # Evicts down to target fraction of budget
+    stats = evict_crops(max_bytes=250, target=0.5)
+    assert stats["evicted_files"] == 2
+    assert stats["evicted_bytes"] == 200
+    assert not os.path.exists(oldest)
+    assert not os.path.exists(older)
+    assert os.path.exists(newer)
+    assert os.path.exists(source)
+
+
+def test_evict_by_file_count(crop_root):
+    now = time.time()
+    paths = [_make_file(crop_root, "1/1/original/{}.jpg".format(width), atime=now - width)
+             for width in (240, 640, 820, 960)]
+    stats = evict_crops(max_files=3, target=0.7)
+    assert stats["evicted_files"] == 2
+    assert [os.path.exists(p) for p in paths] == [True, True, False, False]
+
+
+def test_evict_by_manifest(settings, crop_root):
+    settings.BETTY_CROP_HIT_MANIFEST = True
+    now = time.time()
+    popular = _make_file(crop_root, "1/1/original/240.jpg", atime=now - 1000)
+    unpopular = _make_file(crop_root, "2/2/original/240.jpg", atime=now - 100)
+    record_crop_hit(popular)
+
+    stats = evict_crops(max_files=1, target=1)
+    assert stats["evicted_files"] == 1
+    assert os.path.exists(popular)
+    assert not os.path.exists(unpopular)
+
+    # Ignored with atime policy
+    _make_file(crop_root, "2/2/original/240.jpg", atime=now - 100)
+    evict_crops(max_files=1, target=1, use_manifest=False)
+    assert not os.path.exists(popular)
+
+
+def test_record_crop_hit_disabled(settings, crop_root):
+    settings.BETTY_CROP_HIT_MANIFEST = False
+    path = os.path.join(crop_root, "1/1/original/240.jpg")
+    record_crop_hit(path)
+    from django.core.cache import cache
+    assert cache.get(crop_hit_key(path)) is None
+
+
+def test_evict_skips_rewritten_crop(crop_root):
+    now = time.time()
+    path = _make_file(crop_root, "1/1/original/240.jpg", atime=now - 100)
+
+    real_stat = os.stat
+
+    def rewritten_stat(p, *args, **kwargs):
+        st = real_stat(p, *args, **kwargs)
+        if p == path:
+            # Simulate concurrent writer replacing the crop after scan
+            return os.stat_result((st.st_mode, st.st_ino, st.st_dev, st.st_nlink, st.st_uid,
+                                   st.st_gid, st.st_size, st.st_atime, st.st_mtime + 10,
+                                   st.st_ctime))
+        return st
+
+    with patch.object(eviction.os, "stat", side_effect=rewritten_stat):
+        stats = evict_crops(max_files=0)
+    assert stats["evicted_files"] == 0
+    assert os.path.exists(path)
+
+
+def test_evict_skips_rerendered_crop(crop_root):
+    now = time.time()
+    path = _make_file(crop_root, "1/1/original/240.jpg", atime=now - 100)
+    mtime = os.stat(path).st_mtime
+
+    real_scan_shard = eviction.scan_shard
+
+    def scan_then_rerender(*args, **kwargs):
+        crops = real_scan_shard(*args, **kwargs)
+        # Re-rendered for the same image version (so same mtime) after scan
+        write_file_atomic(path, b"y" * 100, mtime=mtime)
+        return crops
+
+    with patch.object(eviction, "scan_shard", side_effect=scan_then_rerender):
+        stats = evict_crops(max_files=0)
+    assert os.stat(path).st_mtime == mtime
+    assert stats["evicted_files"] == 0
+    assert os.path.exists(path)
+
+
+def test_evict_without_scandir(crop_root):
+    now = time.time()
+    old = _make_file(crop_root, "1/1/original/240.jpg", atime=now - 100)
+    new = _make_file(crop_root, "1/1/original/640.jpg", atime=now)
+    with patch.object(eviction, "scandir", None):
+        stats = evict_crops(max_files=1, target=1)
+    assert stats["scanned_files"] == 2
+    assert not os.path.exists(old)
+    assert os.path.exists(new)
+
+
+def test_evict_crops_command(crop_root):
+    now = time.time()
+    old = _make_file(crop_root, "1/1/original/240.jpg", atime=now - 200)
+    older = _make_file(crop_root, "1/1/original/640.jpg", atime=now - 100)
+    new = _make_file(crop_root, "1/1/original/820.jpg", atime=now)
+
+    out = StringIO()
+    management.call_command("evict_crops", max_files=2, policy="atime", stdout=out)
+    assert "evicted 2 " in out.getvalue()
+    assert not os.path.exists(old)
+    assert not os.path.exists(older)
+    assert os.path.exists(new)
+
+
+def test_evict_crops_command_no_budget(crop_root):
+    with pytest.raises(CommandError):
+        management.call_command("evict_crops")
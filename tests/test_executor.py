@@ -0,0 +1,116 @@
+import io
+import os
+
+from concurrent.futures import Future, TimeoutError
+from mock import patch
+from PIL import Image as PILImage
+import pytest
+
+from betty.cropper.executor import CropExecutor
+from betty.cropper.imaging import render_crops
+
+
+TEST_DATA_PATH = os.path.join(os.path.dirname(__file__), 'images')
+
+SELECTION = {'x0': 0, 'y0': 0, 'x1': 512, 'y1': 512}
+SIZES = [(200, 200), (100, 100)]
+ENCODER_KWARGS = [{"format": "jpeg", "quality": 80}, {"format": "png"}]
+
+
+@pytest.fixture()
+def lenna_data():
+    with open(os.path.join(TEST_DATA_PATH, 'Lenna.png'), 'rb') as lenna:
+        return lenna.read()
+
+
+@pytest.fixture()
+def executor(request, settings):
+    settings.BETTY_CROP_PROCESS_POOL_SIZE = 1
+    executor = CropExecutor()
+    request.addfinalizer(executor.shutdown)
+    return executor
+
+
+def test_render_crops(lenna_data):
+    results = render_crops(lenna_data, SELECTION, SIZES, ENCODER_KWARGS)
+    images = [PILImage.open(io.BytesIO(data)) for data in results]
+    assert [(img.format, img.size) for img in images] == [('JPEG', (200, 200)),
+                                                          ('PNG', (100, 100))]
+
+
+def test_executor_render(executor, lenna_data):
+    results = executor.render(lenna_data, SELECTION, SIZES, ENCODER_KWARGS)
+    assert results == render_crops(lenna_data, SELECTION, SIZES, ENCODER_KWARGS)
+    assert executor.stats() == {
+        "running": True,
+        "pending": 0,
+        "submitted": 1,
+        "overflows": 0,
+        "timeouts": 0,
+        "errors": 0,
+    }
+
+
+def test_executor_overflow(executor, settings, lenna_data):
+    settings.BETTY_CROP_PROCESS_POOL_MAX_QUEUE = 0
+    assert executor.render(lenna_data, SELECTION, SIZES, ENCODER_KWARGS) is None
+    assert executor.overflows == 1
+    assert not executor.stats()['running']
+
+
+def test_executor_timeout(executor, settings, lenna_data):
+    settings.BETTY_CROP_PROCESS_POOL_TIMEOUT = 0
+    with pytest.raises(TimeoutError):
+        executor.render(lenna_data, SELECTION, SIZES, ENCODER_KWARGS)
+    assert executor.timeouts == 1
+
+
+def test_executor_timeout_still_pending(executor, settings, lenna_data):
+    settings.BETTY_CROP_PROCESS_POOL_TIMEOUT = 0
+    settings.BETTY_CROP_PROCESS_POOL_MAX_QUEUE = 1
+    running = Future()
+    running.set_running_or_notify_cancel()
+
+    with patch.object(executor, '_get_pool') as mock_get_pool:
+        mock_get_pool.return_value.submit.return_value = running
+        with pytest.raises(TimeoutError):
+            executor.render(lenna_data, SELECTION, SIZES, ENCODER_KWARGS)
+
+        # Can't be cancelled once running, so still counts against the queue
+        assert executor.pending == 1
+        assert executor.render(lenna_data, SELECTION, SIZES, ENCODER_KWARGS) is None
+        assert executor.overflows == 1
+
+    running.set_result([])
+    assert executor.pending == 0
+
+
+def test_executor_error(executor):
+    with pytest.raises(IOError):
+        executor.render(b'not an image', SELECTION, SIZES, ENCODER_KWARGS)
+    assert executor.errors == 1
+    assert executor.pending == 0
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_crop_process_pool(executor, settings):
+    from betty.cropper.models import Image, Ratio
+
+    settings.BETTY_CROP_PROCESS_POOL = True
+    image = Image.objects.create_from_path(os.path.join(TEST_DATA_PATH, 'Sam_Hat1.jpg'))
+
+    with patch('betty.cropper.models.crop_executor', executor):
+        image_data = image.crop(ratio=Ratio('16x9'), width=300, extension='jpg')
+
+    assert executor.submitted == 1
+    assert PILImage.open(io.BytesIO(image_data)).size == (300, 169)
+
+    # Same bytes as rendering in-process, batched or not
+    with patch('betty.cropper.models.crop_executor', executor):
+        renditions = image.crop_renditions(ratio=Ratio('16x9'), widths=[1200, 300],
+                                           extension='jpg')
+    assert renditions[300] == image_data
+    settings.BETTY_CROP_PROCESS_POOL = False
+    assert image.crop(ratio=Ratio('16x9'), width=1200, extension='jpg') == renditions[1200]
+    assert image.crop(ratio=Ratio('16x9'), width=300, extension='jpg') == image_data
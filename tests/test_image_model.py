@@ -1,3 +1,4 @@
+import io
 import os
 
 from freezegun import freeze_time
@@ -6,10 +7,16 @@ import pytest
 
 from django.core.cache import cache
 from django.core.files import File
+from django.db import connection
 from django.db.models.fields.files import FieldFile
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
+from PIL import Image as PILImage
 
-from betty.cropper.models import Image, Ratio
+from betty.cropper.cache import decoded_image_cache
+from betty.cropper.imaging import decode_image
+from betty.cropper.models import CROP_EXTENSIONS, Image, Ratio
+from betty.cropper.tasks import render_renditions
 
 
 TEST_DATA_PATH = os.path.join(os.path.dirname(__file__), 'images')
@@ -61,7 +68,7 @@ def test_image_clear_crops(image, settings, save_crops):
                                                                         ratio=ratio,
                                                                         extension=extension)
                 for ratio in ['1x1', '3x1', '16x9', 'original']
-                for extension in ['png', 'jpg']
+                for extension in CROP_EXTENSIONS
                 for width in [200, 400, 1200]])
 
             assert mock_rmtree.called == save_crops
@@ -156,6 +163,7 @@ def test_last_modified_auto_now():
 def test_read_from_storage_cache(image, settings):
 
     settings.BETTY_CACHE_STORAGE_SEC = 3600
+    settings.BETTY_MMAP_LOCAL_STORAGE = False
 
     cache_key = 'storage:' + image.source.name
 
@@ -181,3 +189,169 @@ def test_read_from_storage_cache(image, settings):
             assert image.read_source_bytes().getvalue() == expected_bytes
             assert 2 == mock_read.call_count
             assert cache.get(cache_key) == expected_bytes
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_crop_uses_decoded_image_cache(image, settings):
+
+    settings.BETTY_DECODED_IMAGE_CACHE_BYTES = 10 * 1024 * 1024
+
+    with patch.object(Image, 'read_best_bytes', wraps=image.read_best_bytes) as mock_read:
+        # All decoded at 1/4 scale
+        for width in [100, 110, 120]:
+            image.crop(ratio=Ratio('1x1'), width=width, extension='jpg')
+        assert mock_read.call_count == 1
+        assert decoded_image_cache.stats()['hits'] == 2
+
+        # Finer decode is cached separately, and never reused for coarser crops
+        image.crop(ratio=Ratio('1x1'), width=300, extension='jpg')
+        assert mock_read.call_count == 2
+        image.crop(ratio=Ratio('1x1'), width=100, extension='jpg')
+        assert mock_read.call_count == 2
+        assert decoded_image_cache.stats()['hits'] == 3
+
+        # Modifying image invalidates cache
+        with freeze_time('2100-01-01'):
+            image.save()
+        image.crop(ratio=Ratio('1x1'), width=100, extension='jpg')
+        assert mock_read.call_count == 3
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_crop_draft_decode(settings):
+
+    settings.BETTY_JPEG_DRAFT_DECODE = True
+    image = Image.objects.create_from_path(os.path.join(TEST_DATA_PATH, 'Sam_Hat1.jpg'))
+
+    with patch('betty.cropper.models.decode_image', wraps=decode_image) as mock_decode:
+        cropped = PILImage.open(io.BytesIO(image.crop(ratio=Ratio('16x9'), width=300,
+                                                      extension='jpg')))
+        assert cropped.size == (300, 169)
+        assert mock_decode.call_args[1]['reduce'] == 8
+        full_cropped = PILImage.open(io.BytesIO(image.crop(ratio=Ratio('16x9'), width=1200,
+                                                           extension='jpg')))
+        assert full_cropped.size == (1200, 675)
+        assert mock_decode.call_args[1]['reduce'] == 2
+
+    # Cached decode is reused for other crops at the same scale
+    with patch('betty.cropper.models.decode_image') as mock_decode:
+        image.crop(ratio=Ratio('original'), width=200, extension='png')
+        assert not mock_decode.called
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_crop_renditions(image, settings):
+
+    settings.BETTY_SAVE_CROPS_TO_DISK = True
+    settings.BETTY_WIDTHS = [100, 200, 400]
+
+    with patch('betty.cropper.models.decode_image', wraps=decode_image) as mock_decode:
+        renditions = image.crop_renditions(ratio=Ratio('16x9'), widths=[400, 100, 200],
+                                           extension='jpg')
+        # One decode per draft scale
+        assert [c[1]['reduce'] for c in mock_decode.call_args_list] == [1, 2, 4]
+
+    assert sorted(renditions) == [100, 200, 400]
+    for width, image_data in renditions.items():
+        img = PILImage.open(io.BytesIO(image_data))
+        assert img.size == (width, int(round(width * 9 / 16.0)))
+        with open(image.get_crop_path('16x9', width, 'jpg'), 'rb') as saved:
+            assert saved.read() == image_data
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_crop_renditions_match_crop(settings):
+
+    settings.BETTY_JPEG_DRAFT_DECODE = True
+    settings.BETTY_DECODED_IMAGE_CACHE_BYTES = 64 * 1024 * 1024
+    image = Image.objects.create_from_path(os.path.join(TEST_DATA_PATH, 'Sam_Hat1.jpg'))
+    widths = [1200, 820, 640, 240]
+
+    renditions = image.crop_renditions(ratio=Ratio('16x9'), widths=widths, extension='jpg')
+    decoded_image_cache.clear()
+    for width in widths:
+        assert image.crop(ratio=Ratio('16x9'), width=width, extension='jpg') == renditions[width]
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_render_renditions_task(image, settings):
+
+    settings.BETTY_SAVE_CROPS_TO_DISK = True
+    settings.BETTY_MAX_WIDTH = 1000
+    settings.BETTY_WIDTHS = [0, 100, 200, 1001]
+
+    assert render_renditions.apply(args=(image.id, '1x1', 'png')).get() == [100, 200]
+    for width in [100, 200]:
+        assert os.path.exists(image.get_crop_path('1x1', width, 'png'))
+
+
+@pytest.mark.django_db
+def test_image_metadata_cache(image):
+    image.selections = {"1x1": {"x0": 1, "y0": 2, "x1": 3, "y1": 4}}
+    image.jpeg_quality_settings = {"200": 70}
+    image.save()
+
+    with CaptureQueriesContext(connection) as queries:
+        cached = Image.objects.get_cached(image.id)
+    assert len(queries) == 0
+
+    assert cached.pk == image.pk
+    assert cached.name == image.name
+    assert cached.source.name == image.source.name
+    assert not cached.optimized
+    assert cached.selections == image.selections
+    assert cached.jpeg_quality_settings == image.jpeg_quality_settings
+    assert cached.last_modified == image.last_modified
+    assert not cached._state.adding
+
+    # Cache miss falls back to database, and refills cache
+    cache.delete(Image.metadata_cache_key(image.id))
+    with CaptureQueriesContext(connection) as queries:
+        assert Image.objects.get_cached(image.id).pk == image.pk
+    assert len(queries) == 1
+    assert (cache.get(Image.metadata_cache_key(image.id)) ==
+            Image.objects.get(id=image.id).to_metadata())
+
+
+@pytest.mark.django_db
+def test_image_metadata_cache_miss_race(image):
+    stale = Image.objects.get(id=image.id)
+    cache.delete(Image.metadata_cache_key(image.id))
+
+    def get_then_save(**kwargs):
+        # Concurrent save lands after the cache miss read its (now stale) row
+        image.name = "Renamed"
+        image.save()
+        return stale
+
+    with patch.object(Image.objects, 'get', side_effect=get_then_save):
+        assert Image.objects.get_cached(image.id).name != "Renamed"
+    assert Image.objects.get_cached(image.id).name == "Renamed"
+
+
+@pytest.mark.django_db
+def test_image_metadata_cache_version(image):
+    record = image.to_metadata()
+    cache.set(Image.metadata_cache_key(image.id), (record[0] + 1,) + record[1:])
+    with CaptureQueriesContext(connection) as queries:
+        assert Image.objects.get_cached(image.id).pk == image.pk
+    assert len(queries) == 1
+    # Outdated record replaced
+    assert (cache.get(Image.metadata_cache_key(image.id)) ==
+            Image.objects.get(id=image.id).to_metadata())
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_image_metadata_cache_delete(image):
+    image_id = image.id
+    image.delete()
+    with CaptureQueriesContext(connection) as queries:
+        with pytest.raises(Image.DoesNotExist):
+            Image.objects.get_cached(image_id)
+    assert len(queries) == 0
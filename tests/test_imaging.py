@@ -0,0 +1,66 @@
+import io
+import os
+
+from mock import patch
+from PIL import Image as PILImage
+
+from betty.cropper.imaging import (decode_image, draft, get_draft_reduce, resize_and_encode,
+                                   scale_box)
+
+
+TEST_DATA_PATH = os.path.join(os.path.dirname(__file__), 'images')
+
+
+def open_test_image(name):
+    with open(os.path.join(TEST_DATA_PATH, name), 'rb') as f:
+        return io.BytesIO(f.read())
+
+
+def test_get_draft_reduce():
+    assert get_draft_reduce((3200, 1800), (3200, 1800)) == 1
+    assert get_draft_reduce((3200, 1800), (1200, 675)) == 2
+    assert get_draft_reduce((3200, 1800), (600, 338)) == 4
+    assert get_draft_reduce((3200, 1800), (300, 169)) == 8
+    # Keeps headroom for rounding
+    assert get_draft_reduce((3200, 1800), (400, 225)) == 4
+    # Limited by either dimension
+    assert get_draft_reduce((3200, 100), (300, 100)) == 1
+
+
+def test_draft_jpeg():
+    img = PILImage.open(open_test_image('Sam_Hat1.jpg'))
+    assert draft(img, 4) == 4
+    img.load()
+    assert img.size == (816, 612)
+
+
+def test_draft_non_jpeg():
+    img = PILImage.open(open_test_image('Lenna.png'))
+    assert draft(img, 4) == 1
+    img.load()
+    assert img.size == (512, 512)
+
+
+def test_decode_image():
+    img, reduce = decode_image(open_test_image('Sam_Hat1.jpg'), reduce=8)
+    assert reduce == 8
+    assert img.size == (408, 306)
+
+    img, reduce = decode_image(open_test_image('Sam_Hat1.jpg'))
+    assert reduce == 1
+    assert img.size == (3264, 2448)
+
+
+def test_scale_box():
+    selection = {'x0': 10, 'y0': 20, 'x1': 3263, 'y1': 2448}
+    assert scale_box(selection, 1, (3264, 2448)) == (10, 20, 3263, 2448)
+    assert scale_box(selection, 4, (816, 612)) == (2, 5, 816, 612)
+
+
+def test_resize_and_encode_skips_noop_resize():
+    img = PILImage.new("RGB", (100, 50))
+    with patch.object(PILImage.Image, "resize", wraps=img.resize) as mock_resize:
+        results = resize_and_encode(img, [(100, 50), (50, 25)],
+                                    [{"format": "png"}, {"format": "png"}])
+    assert mock_resize.call_count == 1
+    assert [PILImage.open(io.BytesIO(data)).size for data in results] == [(100, 50), (50, 25)]
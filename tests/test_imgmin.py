@@ -1,7 +1,11 @@
+import io
 import os
 import psutil
 
+from mock import patch
+
 from betty.cropper.models import Image
+from betty.cropper.tasks import get_quality_search_widths, search_qualities
 
 import pytest
 
@@ -78,3 +82,62 @@ def test_imgmin_upload_lowquality(settings):
     process = psutil.Process(os.getpid())
     print(get_open_files(process))
     assert len(get_open_files(process)) == 0
+
+
+def test_imgmin_parallel(settings):
+    settings.BETTY_JPEG_QUALITY_RANGE = (60, 92)
+    with open(os.path.join(TEST_DATA_PATH, "Lenna.png"), "rb") as f:
+        lenna = io.BytesIO(f.read())
+
+    settings.BETTY_QUALITY_SEARCH_WORKERS = 2
+    parallel, _probes = search_qualities(lenna, [320, 240])
+    settings.BETTY_QUALITY_SEARCH_WORKERS = 1
+    assert search_qualities(lenna, [320, 240])[0] == parallel
+
+    # Early exit at max quality
+    settings.BETTY_QUALITY_SEARCH_WORKERS = 3
+    with open(os.path.join(TEST_DATA_PATH, "Simpsons-Week_a.jpg"), "rb") as f:
+        simpsons = io.BytesIO(f.read())
+    assert search_qualities(simpsons, [320, 300, 240])[0] == {320: 92}
+
+
+def test_search_qualities_early_exit(settings):
+    settings.BETTY_JPEG_QUALITY_RANGE = (60, 92)
+    settings.BETTY_QUALITY_SEARCH_WORKERS = 1
+    with patch("betty.cropper.tasks.search_optimal_quality",
+               side_effect=[(80, 5), (92, 2), (70, 5)]) as search:
+        assert search_qualities(io.BytesIO(b"image"), [1200, 960, 640]) == (
+            {1200: 80, 960: 92}, 7)
+    assert search.call_count == 2
+    # Warm started from previous width
+    assert search.call_args_list[1][1]["seed"] == 80
+
+
+def test_search_qualities_pool_unavailable(settings):
+    settings.BETTY_JPEG_QUALITY_RANGE = (60, 92)
+    settings.BETTY_QUALITY_SEARCH_WORKERS = 2
+    with patch("betty.cropper.tasks.ProcessPoolExecutor",
+               side_effect=AssertionError("daemonic processes are not allowed to have children")):
+        with patch("betty.cropper.tasks.search_optimal_quality", return_value=(80, 3)):
+            assert search_qualities(io.BytesIO(b"image"), [1200, 640]) == (
+                {1200: 80, 640: 80}, 6)
+
+
+def test_search_qualities_daemonic_process(settings):
+    settings.BETTY_JPEG_QUALITY_RANGE = (60, 92)
+    settings.BETTY_QUALITY_SEARCH_WORKERS = 2
+    with patch("multiprocessing.current_process") as current_process:
+        current_process.return_value.daemon = True
+        with patch("betty.cropper.tasks.ProcessPoolExecutor") as pool:
+            with patch("betty.cropper.tasks.logger") as logger:
+                with patch("betty.cropper.tasks.search_optimal_quality", return_value=(80, 3)):
+                    assert search_qualities(io.BytesIO(b"image"), [1200, 640]) == (
+                        {1200: 80, 640: 80}, 6)
+    # Skipped quietly, without trying to start a pool
+    assert not pool.called
+    assert not logger.warning.called
+
+
+def test_quality_search_widths(settings):
+    settings.BETTY_WIDTHS = [240, 300, 640, 820, 960, 1200]
+    assert get_quality_search_widths() == [1200, 960, 820, 640, 300]
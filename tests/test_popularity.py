@@ -0,0 +1,198 @@
+import json
+import os
+import threading
+
+from django.core import management
+from django.core.files import File
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.six import StringIO
+from mock import patch
+import pytest
+
+from betty.cropper import popularity
+from betty.cropper.models import CropStat, Image
+from betty.cropper.popularity import CropStatsRecorder
+
+TEST_DATA_PATH = os.path.join(os.path.dirname(__file__), 'images')
+
+
+@pytest.fixture()
+def image(request):
+    image = Image.objects.create(name="Lenna.png", width=512, height=512)
+    with open(os.path.join(TEST_DATA_PATH, "Lenna.png"), "rb") as lenna:
+        image.source.save("Lenna.png", File(lenna))
+    return image
+
+
+def test_record_disabled(settings):
+    settings.BETTY_CROP_STATS_SAMPLE_RATE = 0
+    recorder = CropStatsRecorder()
+    recorder.record(1, "1x1", 240, "jpg", render_sec=0.1)
+    assert recorder.stats()["pending"] == 0
+
+
+@pytest.mark.django_db
+def test_record_and_flush(settings):
+    settings.BETTY_CROP_STATS_SAMPLE_RATE = 0.5
+    settings.BETTY_CROP_STATS_FLUSH_SEC = 3600
+    image = Image.objects.create(name="Testing", width=512, height=512)
+    recorder = CropStatsRecorder()
+
+    with patch("random.random", return_value=0.1):
+        recorder.record(image.id, "1x1", 240, "jpg", render_sec=0.25)
+        recorder.record(image.id, "1x1", 240, "jpg")
+    with patch("random.random", return_value=0.9):
+        # Not sampled
+        recorder.record(image.id, "1x1", 240, "jpg")
+        recorder.record(image.id, "16x9", 640, "png")
+        # ...but renders always are
+        recorder.record(image.id, "16x9", 640, "png", render_sec=0.5)
+    # Deleted image
+    recorder.record(image.id + 1, "1x1", 240, "jpg", render_sec=0.1)
+
+    assert recorder.stats()["pending"] == 3
+    assert not CropStat.objects.exists()
+
+    assert recorder.flush() == 2
+    assert recorder.stats()["pending"] == 0
+
+    stat = CropStat.objects.get(image=image, ratio="1x1", width=240, format="jpg")
+    assert stat.hits == 4  # 2 samples, each counting for 2 hits
+    assert stat.renders == 1
+    assert stat.render_ms == 250
+    assert stat.last_hit is not None
+
+    stat = CropStat.objects.get(image=image, ratio="16x9", width=640, format="png")
+    assert stat.hits == 0
+    assert stat.renders == 1
+    assert stat.last_hit is None
+
+    # Increments existing rows
+    with patch("random.random", return_value=0.1):
+        recorder.record(image.id, "1x1", 240, "jpg")
+    recorder.flush()
+    assert CropStat.objects.get(image=image, ratio="1x1", width=240, format="jpg").hits == 6
+
+
+@pytest.mark.django_db
+def test_flush_on_max_keys(settings):
+    settings.BETTY_CROP_STATS_SAMPLE_RATE = 1
+    settings.BETTY_CROP_STATS_FLUSH_SEC = 3600
+    settings.BETTY_CROP_STATS_MAX_KEYS = 2
+    image = Image.objects.create(name="Testing", width=512, height=512)
+    recorder = CropStatsRecorder()
+
+    recorder.record(image.id, "1x1", 240, "jpg")
+    assert not CropStat.objects.exists()
+    recorder.record(image.id, "1x1", 640, "jpg")
+    assert CropStat.objects.count() == 2
+    assert recorder.stats()["flushes"] == 1
+
+
+@pytest.mark.django_db
+def test_flush_queued_off_request(settings):
+    settings.BETTY_CROP_STATS_SAMPLE_RATE = 1
+    settings.BETTY_CROP_STATS_FLUSH_SEC = 0
+    recorder = CropStatsRecorder()
+
+    with patch("betty.cropper.tasks.flush_crop_stats.delay") as flush_task:
+        with CaptureQueriesContext(connection) as queries:
+            recorder.record(1, "1x1", 240, "jpg", render_sec=0.25)
+        assert len(queries) == 0
+    flush_task.assert_called_once_with([(1, "1x1", 240, "jpg", 1, 1, 250)])
+    assert recorder.stats()["pending"] == 0
+
+    # Counters dropped if the task can't be queued
+    with patch("betty.cropper.tasks.flush_crop_stats.delay", side_effect=IOError):
+        recorder.record(1, "1x1", 240, "jpg")
+    assert recorder.stats()["errors"] == 1
+    assert recorder.stats()["pending"] == 0
+
+
+def test_fractional_sample_rate(settings):
+    settings.BETTY_CROP_STATS_SAMPLE_RATE = 0.4
+    settings.BETTY_CROP_STATS_FLUSH_SEC = 3600
+    recorder = CropStatsRecorder()
+
+    with patch("random.random", return_value=0.1):
+        recorder.record(1, "1x1", 240, "jpg")
+        recorder.record(1, "1x1", 240, "jpg")
+        recorder.record(1, "1x1", 640, "jpg")
+    with patch("betty.cropper.tasks.flush_crop_stats.delay") as flush_task:
+        # 2.5 hits per sample, rounded once per flush
+        with patch("random.random", return_value=0.4):
+            recorder.queue_flush()
+    rows = sorted(flush_task.call_args[0][0])
+    assert rows == [(1, "1x1", 240, "jpg", 5, 0, 0), (1, "1x1", 640, "jpg", 3, 0, 0)]
+
+
+def test_flush_in_background(settings):
+    settings.BETTY_CROP_STATS_SAMPLE_RATE = 1
+    settings.BETTY_CROP_STATS_FLUSH_SEC = 0.05
+    recorder = CropStatsRecorder()
+    flushed = threading.Event()
+
+    with patch.object(popularity, "FLUSHER_MIN_SEC", 0.01):
+        with patch("atexit.register") as register:
+            with patch("betty.cropper.tasks.flush_crop_stats.delay",
+                       side_effect=lambda rows: flushed.set()) as flush_task:
+                recorder.record(1, "1x1", 240, "jpg")
+                # Flushed without any further requests
+                assert flushed.wait(2)
+    flush_task.assert_called_once_with([(1, "1x1", 240, "jpg", 1, 0, 0)])
+    # ...and at exit
+    register.assert_called_once_with(recorder.queue_flush)
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_crop_view_records(settings, client, admin_client, image):
+    settings.BETTY_CROP_STATS_SAMPLE_RATE = 1
+    settings.BETTY_CROP_STATS_FLUSH_SEC = 0
+
+    for _ in range(3):
+        res = client.get("/images/{}/1x1/240.jpg".format(image.id))
+        assert res.status_code == 200
+    assert client.get("/images/{}/16x9/640.png".format(image.id)).status_code == 200
+
+    # HEAD and revalidation aren't counted
+    assert client.head("/images/{}/1x1/240.jpg".format(image.id)).status_code == 200
+    assert client.get("/images/{}/1x1/240.jpg".format(image.id),
+                      HTTP_IF_NONE_MATCH=res["ETag"]).status_code == 304
+
+    stat = CropStat.objects.get(image=image, ratio="1x1", width=240, format="jpg")
+    assert stat.hits == 3
+    assert stat.renders == 1  # Then served from disk
+
+    res = admin_client.get("/images/api/popular")
+    assert res.status_code == 200
+    results = json.loads(res.content.decode("utf-8"))["results"]
+    assert [(r["ratio"], r["width"], r["format"], r["hits"]) for r in results] == [
+        ("1x1", 240, "jpg", 3),
+        ("16x9", 640, "png", 1),
+    ]
+
+    res = admin_client.get("/images/api/popular?order=renders&limit=1&id={}".format(image.id))
+    results = json.loads(res.content.decode("utf-8"))["results"]
+    assert len(results) == 1
+
+    with patch("betty.cropper.api.views.POPULAR_MAX_LIMIT", 1):
+        res = admin_client.get("/images/api/popular?limit=5")
+        assert len(json.loads(res.content.decode("utf-8"))["results"]) == 1
+
+    assert admin_client.get("/images/api/popular?order=bogus").status_code == 400
+    assert admin_client.get("/images/api/popular?limit=bogus").status_code == 400
+
+    out = StringIO()
+    management.call_command("crop_stats", limit=1, stdout=out)
+    assert "{}/1x1/240.jpg".format(image.id) in out.getvalue()
+    assert "16x9" not in out.getvalue()
+
+
+@pytest.mark.django_db
+def test_stats_deleted_with_image():
+    image = Image.objects.create(name="Testing", width=512, height=512)
+    CropStat.objects.create(image=image, ratio="1x1", width=240, format="jpg", hits=1)
+    image.delete()
+    assert not CropStat.objects.exists()
@@ -0,0 +1,96 @@
+import json
+import os
+
+from mock import patch
+import pytest
+
+from betty.cropper.models import Image
+from betty.cropper.tasks import prewarm_crops
+
+TEST_DATA_PATH = os.path.join(os.path.dirname(__file__), 'images')
+
+
+@pytest.fixture()
+def prewarm_settings(settings):
+    settings.BETTY_PREWARM = True
+    settings.BETTY_PREWARM_RATIOS = ["1x1", "16x9"]
+    settings.BETTY_PREWARM_FORMATS = ["jpg"]
+    settings.BETTY_WIDTHS = [240, 640]
+    settings.BETTY_SAVE_CROPS_TO_DISK = True
+    return settings
+
+
+def _saved_crops(image):
+    saved = []
+    for ratio_slug in ["original", "1x1", "16x9"]:
+        for width in [240, 640]:
+            if os.path.exists(image.get_crop_path(ratio_slug, width, "jpg")):
+                saved.append((ratio_slug, width))
+    return saved
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_prewarm_on_upload(prewarm_settings):
+    image = Image.objects.create_from_path(os.path.join(TEST_DATA_PATH, "Lenna.png"))
+    assert _saved_crops(image) == [("1x1", 240), ("1x1", 640), ("16x9", 240), ("16x9", 640)]
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_prewarm_disabled(prewarm_settings):
+    prewarm_settings.BETTY_PREWARM = False
+    image = Image.objects.create_from_path(os.path.join(TEST_DATA_PATH, "Lenna.png"))
+    assert _saved_crops(image) == []
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_prewarm_after_quality_search(prewarm_settings):
+    prewarm_settings.BETTY_JPEG_QUALITY_RANGE = (60, 92)
+    with patch("betty.cropper.tasks.search_image_quality.run") as search:
+        # Quality search clears crops, so must run first
+        search.side_effect = lambda image_id: Image.objects.get(id=image_id).clear_crops()
+        image = Image.objects.create_from_path(os.path.join(TEST_DATA_PATH, "Lenna.png"))
+    assert search.called
+    assert len(_saved_crops(image)) == 4
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("clean_image_root")
+def test_prewarm_on_update_selection(prewarm_settings, admin_client):
+    image = Image.objects.create_from_path(os.path.join(TEST_DATA_PATH, "Lenna.png"))
+
+    with patch("betty.cropper.tasks.render_renditions.apply_async") as render:
+        res = admin_client.post(
+            "/images/api/{0}/1x1".format(image.id),
+            data=json.dumps({"x0": 1, "y0": 1, "x1": 510, "y1": 510}),
+            content_type="application/json",
+        )
+    assert res.status_code == 200
+    render.assert_called_once_with(args=(image.id, "1x1", "jpg"), queue="betty_prewarm")
+
+
+@pytest.mark.django_db
+def test_prewarm_task_options(prewarm_settings):
+    prewarm_settings.BETTY_PREWARM_RATIOS = None
+    prewarm_settings.BETTY_RATIOS = ["1x1"]
+    prewarm_settings.BETTY_PREWARM_FORMATS = ["jpg", "png", "bogus"]
+    prewarm_settings.BETTY_PREWARM_QUEUE = "low"
+    prewarm_settings.BETTY_PREWARM_PRIORITY = 9
+    with patch("betty.cropper.tasks.render_renditions.apply_async") as render:
+        prewarm_crops(1)
+    assert sorted(call[1]["args"] for call in render.call_args_list) == [
+        (1, "1x1", "jpg"),
+        (1, "1x1", "png"),
+        (1, "original", "jpg"),
+        (1, "original", "png"),
+    ]
+    assert all(call[1]["queue"] == "low" and call[1]["priority"] == 9
+               for call in render.call_args_list)
+
+    # Nothing to warm if crops aren't saved
+    prewarm_settings.BETTY_SAVE_CROPS_TO_DISK = False
+    with patch("betty.cropper.tasks.render_renditions.apply_async") as render:
+        prewarm_crops(1)
+    assert not render.called
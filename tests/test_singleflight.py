@@ -0,0 +1,154 @@
+import threading
+import time
+
+from django.core.cache import cache
+import pytest
+
+from betty.cropper.utils.singleflight import SingleFlight
+
+
+def run_concurrently(count, target):
+    threads = [threading.Thread(target=target) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def test_single_flight_coalesces():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def work():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return b'image'
+
+    leader = run_concurrently(1, lambda: results.append(flight.do('key', work, timeout=5)))
+    started.wait(5)
+    followers = run_concurrently(4, lambda: results.append(flight.do('key', work, timeout=5)))
+
+    # Give followers time to queue up on the leader
+    time.sleep(0.2)
+    release.set()
+    for thread in leader + followers:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert results == [b'image'] * 5
+    stats = flight.stats()
+    assert stats['leaders'] == 1
+    assert stats['followers'] == 4
+    assert stats['shared'] == 4
+    assert stats['in_flight'] == 0
+
+
+def test_single_flight_follower_timeout():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        started.set()
+        release.wait(5)
+        return 'leader'
+
+    leader = run_concurrently(1, lambda: flight.do('key', slow, timeout=5))
+    started.wait(5)
+    assert flight.do('key', lambda: 'follower', timeout=0.01) == 'follower'
+    release.set()
+    leader[0].join(5)
+
+    assert flight.stats()['timeouts'] == 1
+
+
+def test_single_flight_error():
+    flight = SingleFlight()
+
+    def fail():
+        raise ValueError('Bad')
+
+    with pytest.raises(ValueError):
+        flight.do('key', fail, timeout=1)
+
+    # Errors are not remembered
+    assert flight.do('key', lambda: 1, timeout=1) == 1
+
+
+def test_single_flight_cache():
+    flight = SingleFlight()
+    other_process = SingleFlight()
+
+    # Nobody waiting, so result isn't published
+    assert flight.do('key', lambda: b'image', timeout=5, cache=cache) == b'image'
+    assert cache.get('singleflight:result:key') is None
+    assert other_process.do('key', lambda: b'other', timeout=5, cache=cache) == b'other'
+    assert other_process.stats()['leaders'] == 1
+
+    # Published for waiting followers, who then share it
+    cache.set('singleflight:waiting:key', 1, 5)
+    assert flight.do('key', lambda: b'image', timeout=5, cache=cache) == b'image'
+    assert cache.get('singleflight:waiting:key') is None
+    assert other_process.do('key', lambda: b'other', timeout=5, cache=cache) == b'image'
+    assert other_process.stats()['shared'] == 1
+
+
+def test_single_flight_cache_follower(settings):
+    # Chunked, so large results fit in memcached
+    settings.BETTY_CACHE_STORAGE_CHUNK_BYTES = 10
+    image = bytes(bytearray(range(25)))
+    flight = SingleFlight()
+    other_process = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    results = []
+
+    def work():
+        started.set()
+        release.wait(5)
+        return image
+
+    leader = run_concurrently(1, lambda: results.append(
+        flight.do('key', work, timeout=5, cache=cache)))
+    started.wait(5)
+    follower = run_concurrently(1, lambda: results.append(
+        other_process.do('key', lambda: b'other', timeout=5, cache=cache)))
+    time.sleep(0.2)
+    release.set()
+    for thread in leader + follower:
+        thread.join(5)
+
+    assert isinstance(cache.get('singleflight:result:key'), dict)
+    assert results == [image, image]
+    assert other_process.stats()['shared'] == 1
+
+
+def test_single_flight_cache_waits_on_lock():
+    flight = SingleFlight()
+
+    cache.add('singleflight:lock:key', 1, 5)
+    # Lock held elsewhere, but never published, so times out + does work itself
+    assert flight.do('key', lambda: b'image', timeout=0.1, cache=cache) == b'image'
+    assert flight.stats()['timeouts'] == 1
+
+
+def test_single_flight_cache_takes_over():
+    flight = SingleFlight()
+    cache.add('singleflight:lock:key', 1, 5)
+
+    def release_lock():
+        time.sleep(0.1)
+        # Leader failed (or its result was evicted)
+        cache.delete('singleflight:lock:key')
+
+    thread = run_concurrently(1, release_lock)
+    assert flight.do('key', lambda: b'image', timeout=5, cache=cache) == b'image'
+    thread[0].join(5)
+
+    # Took over as leader instead of timing out
+    stats = flight.stats()
+    assert stats['leaders'] == 1
+    assert stats['timeouts'] == 0
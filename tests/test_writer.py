@@ -0,0 +1,84 @@
+import os
+import threading
+
+from mock import patch
+import pytest
+
+from betty.cropper.utils import write_file_atomic
+from betty.cropper.writer import CropWriter
+
+
+def test_write_file_atomic(tmpdir):
+    path = str(tmpdir.join("a", "b", "crop.jpg"))
+    write_file_atomic(path, b"data", mtime=1000000000.5)
+    with open(path, "rb") as f:
+        assert f.read() == b"data"
+    assert abs(os.stat(path).st_mtime - 1000000000.5) < 0.001
+
+    # Replaces existing file
+    write_file_atomic(path, b"new")
+    with open(path, "rb") as f:
+        assert f.read() == b"new"
+    assert os.listdir(os.path.dirname(path)) == ["crop.jpg"]
+
+
+def test_write_file_atomic_error(tmpdir):
+    path = str(tmpdir.join("crop.jpg"))
+    with patch("os.rename", side_effect=OSError("Boom")):
+        with pytest.raises(OSError):
+            write_file_atomic(path, b"data")
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_crop_writer_sync(settings, tmpdir):
+    settings.BETTY_CROP_WRITER_THREADS = 0
+    writer = CropWriter()
+    path = str(tmpdir.join("crop.jpg"))
+    assert writer.write(b"data", path)
+    assert os.path.exists(path)
+    assert writer.stats()["written"] == 1
+
+    with patch("betty.cropper.writer.write_file_atomic", side_effect=OSError("Boom")):
+        assert not writer.write(b"data", path)
+    assert writer.stats()["errors"] == 1
+
+
+def test_crop_writer_background(settings, tmpdir):
+    settings.BETTY_CROP_WRITER_THREADS = 2
+    settings.BETTY_CROP_WRITER_MAX_QUEUE = 10
+    writer = CropWriter()
+    paths = [str(tmpdir.join("{}.jpg".format(i))) for i in range(5)]
+    for path in paths:
+        assert writer.write(b"data", path)
+    writer.join()
+    assert all(os.path.exists(path) for path in paths)
+    assert writer.stats()["written"] == 5
+    assert writer.stats()["queue_depth"] == 0
+
+
+def test_crop_writer_backpressure(settings, tmpdir):
+    settings.BETTY_CROP_WRITER_THREADS = 1
+    settings.BETTY_CROP_WRITER_MAX_QUEUE = 2
+    writer = CropWriter()
+
+    started = threading.Event()
+    unblock = threading.Event()
+
+    def slow_write(path, data, mtime=None):
+        started.set()
+        unblock.wait(5)
+
+    with patch("betty.cropper.writer.write_file_atomic", side_effect=slow_write):
+        # First write occupies the thread, next two fill the queue
+        assert writer.write(b"data", str(tmpdir.join("0.jpg")))
+        assert started.wait(5)
+        assert writer.write(b"data", str(tmpdir.join("1.jpg")))
+        assert writer.write(b"data", str(tmpdir.join("2.jpg")))
+        assert writer.stats()["queue_depth"] == 2
+
+        assert not writer.write(b"data", str(tmpdir.join("3.jpg")))
+        assert writer.stats()["dropped"] == 1
+
+        unblock.set()
+        writer.join()
+    assert writer.stats()["written"] == 3